@@ -24,8 +24,10 @@ from hscommon import desktop
 from . import se, me, pe
 from .pe.photo import get_delta_dimensions
 from .util import cmp_value, fix_surrogate_encoding
-from . import directories, results, export, fs, prioritize
+from . import directories, results, export, fs, prioritize, engine
 from .ignore import IgnoreList
+from .inventory import Inventory
+from .watcher import Watcher, POLL_INTERVAL
 from .scanner import ScanType
 from .gui.deletion_options import DeletionOptions
 from .gui.details_panel import DetailsPanel
@@ -132,6 +134,10 @@ class DupeGuru(Broadcaster):
         self.directories = directories.Directories()
         self.results = results.Results(self)
         self.ignore_list = IgnoreList()
+        # When watching folders, files collected by the last scan and what they were collected with
+        self._watcher = None
+        self._watcher_config = None
+        self._last_files = None
         # In addition to "app-level" options, this dictionary also holds options that will be
         # sent to the scanner. They don't have default values because those defaults values are
         # defined in the scanner class.
@@ -140,7 +146,12 @@ class DupeGuru(Broadcaster):
             'clean_empty_dirs': False,
             'ignore_hardlink_matches': False,
             'copymove_dest_type': DestType.Relative,
-            'picture_cache_type': self.PICTURE_CACHE_TYPE
+            'picture_cache_type': self.PICTURE_CACHE_TYPE,
+            'hash_algorithm': 'md5',
+            'incremental_scan': False,
+            'watch_directories': False,
+            'poll_directories': False,
+            'hash_thread_count': engine.HASH_THREAD_COUNT,
         }
         self.selected_dupes = []
         self.details_panel = DetailsPanel(self)
@@ -173,6 +184,44 @@ class DupeGuru(Broadcaster):
         cache_name = 'cached_pictures.shelve' if cache_type == 'shelve' else 'cached_pictures.db'
         return op.join(self.appdata, cache_name)
 
+    def _get_hash_cache_path(self):
+        return op.join(self.appdata, 'hash_cache.db')
+
+    def _get_inventory_path(self):
+        return op.join(self.appdata, 'inventory.db')
+
+    def _get_files_to_scan(self, j):
+        # When a watcher runs since the last scan, only folders where something changed since then
+        # are listed again. Otherwise, we walk all folders and, if we watch folders, start
+        # watching each of them before it's listed so that we don't miss changes happening during
+        # the walk.
+        if not self.options['watch_directories']:
+            self._stop_watcher()
+            return list(self.directories.get_files(fileclasses=self.fileclasses, j=j))
+        config = (
+            tuple(self.directories), tuple(sorted(self.directories.states.items())), self.app_mode,
+            fs.get_hash_algorithm(), self.options['poll_directories'],
+        )
+        if self._watcher is not None and self._watcher_config == config and self._last_files is not None:
+            journal = self._watcher.take_journal()
+            if not journal.overflow:
+                logging.info(
+                    "Updating files from %d changed and %d new folders", len(journal.dirty), len(journal.added)
+                )
+                files = self.directories.update_files(self._last_files, journal, fileclasses=self.fileclasses, j=j)
+                self._last_files = files
+                return list(files)
+        self._stop_watcher()
+        poll_interval = POLL_INTERVAL if self.options['poll_directories'] else None
+        self._watcher = Watcher(self.directories, poll_interval=poll_interval)
+        self._watcher_config = config
+        self._watcher.start()
+        files = list(self.directories.get_files(
+            fileclasses=self.fileclasses, j=j, on_folder=self._watcher.watch_folder
+        ))
+        self._last_files = files
+        return list(files)
+
     def _get_dupe_sort_key(self, dupe, get_group, key, delta):
         if self.app_mode in (AppMode.Music, AppMode.Picture):
             if key == 'folder_path':
@@ -289,6 +338,13 @@ class DupeGuru(Broadcaster):
             )
             self.view.show_message(msg)
 
+    def _stop_watcher(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+        self._watcher = None
+        self._watcher_config = None
+        self._last_files = None
+
     def _job_completed(self, jobid):
         if jobid == JobType.Scan:
             self._results_changed()
@@ -417,6 +473,16 @@ class DupeGuru(Broadcaster):
         except FileNotFoundError:
             pass # we don't care
 
+    def clear_hash_cache(self):
+        fs.filesdb.close()
+        # The inventory of the last scan is made of cached info too. Without it, the next scan is
+        # a full one.
+        for path in [self._get_hash_cache_path(), self._get_inventory_path()]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # we don't care
+
     def copy_or_move(self, dupe, copy: bool, destination: str, dest_type: DestType):
         source_path = dupe.path
         location_path = first(p for p in self.directories if dupe.path in p)
@@ -727,6 +793,11 @@ class DupeGuru(Broadcaster):
         msg = tr("{} duplicate groups were changed by the re-prioritization.").format(count)
         self.view.show_message(msg)
 
+    def close(self):
+        """Stops what still runs in the background. Call it when the application quits.
+        """
+        self._stop_watcher()
+
     def reveal_selected(self):
         if self.selected_dupes:
             desktop.reveal_path(self.selected_dupes[0].path)
@@ -768,17 +839,40 @@ class DupeGuru(Broadcaster):
         self._recreate_result_table()
         self._results_changed()
 
+        try:
+            fs.set_hash_algorithm(self.options['hash_algorithm'])
+        except ValueError:
+            # Preferences saved by a version of Python (or of dupeGuru) that had more algorithms
+            logging.warning("Hash algorithm %r isn't available, using md5", self.options['hash_algorithm'])
+            fs.set_hash_algorithm('md5')
+
         def do(j):
             j.set_progress(0, tr("Collecting files to scan"))
-            if scanner.scan_type == ScanType.Folders:
-                files = list(self.directories.get_folders(folderclass=se.fs.Folder, j=j))
-            else:
-                files = list(self.directories.get_files(fileclasses=self.fileclasses, j=j))
-            if self.options['ignore_hardlink_matches']:
-                files = self._remove_hardlink_dupes(files)
-            logging.info('Scanning %d files' % len(files))
-            self.results.groups = scanner.get_dupe_groups(files, self.ignore_list, j)
-            self.discarded_file_count = scanner.discarded_file_count
+            # Digests computed during the scan are kept in the hash cache so that the next scans
+            # don't have to read unchanged files again.
+            fs.filesdb.connect(self._get_hash_cache_path())
+            if self.options['incremental_scan']:
+                # Created here because sqlite connections can't be shared between threads.
+                scanner.inventory = Inventory(self._get_inventory_path())
+            try:
+                roots = [str(path) for path in self.directories]
+                if scanner.scan_type == ScanType.Folders:
+                    files = list(self.directories.get_folders(folderclass=se.fs.Folder, j=j))
+                    fs.filesdb.purge_outdated(roots)
+                else:
+                    files = self._get_files_to_scan(j)
+                    fs.filesdb.purge_outdated(roots, (str(f.path) for f in files))
+                if self.options['ignore_hardlink_matches']:
+                    files = self._remove_hardlink_dupes(files)
+                logging.info('Scanning %d files' % len(files))
+                self.results.groups = scanner.get_dupe_groups(files, self.ignore_list, j)
+                digests_used = scanner.scan_type in {ScanType.Contents, ScanType.Folders}
+                self.results.hash_algorithm = fs.get_hash_algorithm() if digests_used else None
+                self.discarded_file_count = scanner.discarded_file_count
+            finally:
+                fs.filesdb.close()
+                if scanner.inventory is not None:
+                    scanner.inventory.close()
 
         self._start_job(JobType.Scan, do)
 
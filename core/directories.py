@@ -5,12 +5,14 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from xml.etree import ElementTree as ET
 import logging
 
 from hscommon.jobprogress import job
 from hscommon.path import Path
 from hscommon.util import FileOrPath
+from hscommon.trans import tr
 
 from . import fs
 
@@ -21,6 +23,10 @@ __all__ = [
     'InvalidPathError',
 ]
 
+# Listing directories is mostly waiting for the file system, especially on network mounts, so we
+# can use more threads than we have cores. The pool is bounded to not flood file servers.
+TRAVERSAL_THREAD_COUNT = 8
+
 class DirectoryState:
     """Enum describing how a folder should be considered.
 
@@ -38,6 +44,77 @@ class AlreadyThereError(Exception):
 class InvalidPathError(Exception):
     """The path being added is invalid"""
 
+class _StateNode:
+    __slots__ = ('children', 'state', 'active_count')
+
+    def __init__(self):
+        self.children = {}
+        self.state = None
+        # Number of nodes with a non-excluded state below this one
+        self.active_count = 0
+
+
+class StateTrie:
+    """Explicit folder states, stored in a trie of path components.
+
+    With a lot of states, looping through all of them for each folder we visit is expensive. With
+    this trie, finding the state a folder inherits, and whether a folder has a descendant that
+    isn't excluded, only visits as many nodes as there are components in the folder's path.
+    """
+    def __init__(self):
+        self.root = _StateNode()
+
+    def _find_node(self, path):
+        node = self.root
+        for name in path:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def _update_active_count(self, path, delta):
+        # Adds `delta` to the active count of all nodes above the node of `path`.
+        node = self.root
+        for name in path:
+            node.active_count += delta
+            node = node.children[name]
+
+    def get_state(self, path):
+        """Returns the state of the longest prefix of ``path`` having one, or None."""
+        result = None
+        node = self.root
+        for name in path:
+            node = node.children.get(name)
+            if node is None:
+                break
+            if node.state is not None:
+                result = node.state
+        return result
+
+    def has_active_descendant(self, path):
+        """Returns whether a folder under ``path`` has a state other than ``Excluded``."""
+        node = self._find_node(path)
+        return node is not None and node.active_count > 0
+
+    def remove_descendants(self, path):
+        node = self._find_node(path)
+        if node is None or not node.children:
+            return
+        self._update_active_count(path, -node.active_count)
+        node.children = {}
+        node.active_count = 0
+
+    def set_state(self, path, state):
+        node = self.root
+        for name in path:
+            node = node.children.setdefault(name, _StateNode())
+        was_active = node.state is not None and node.state != DirectoryState.Excluded
+        is_active = state != DirectoryState.Excluded
+        node.state = state
+        if is_active != was_active:
+            self._update_active_count(path, 1 if is_active else -1)
+
+
 class Directories:
     """Holds user folder selection.
 
@@ -52,6 +129,8 @@ class Directories:
         self._dirs = []
         # {path: state}
         self.states = {}
+        # The same states, for fast prefix queries. Updated along with self.states.
+        self._state_trie = StateTrie()
 
     def __contains__(self, path):
         for p in self._dirs:
@@ -74,35 +153,74 @@ class Directories:
         if path.name.startswith('.'): # hidden
             return DirectoryState.Excluded
 
-    def _get_files(self, from_path, fileclasses, j):
-        for root, dirs, files in os.walk(str(from_path)):
+    def _list_directory(self, root, fileclasses, on_folder=None):
+        # Returns a (files, subpaths) tuple for the directory at `root`. `files` are the files to
+        # yield from it, with `is_ref` set, and `subpaths` are the directories to walk next.
+        # `on_folder`, if set, is called with `root` right before it's listed.
+        # We list with os.scandir() rather than os.walk() because the entries it returns know
+        # their type (and, on some platforms, their stats) without additional system calls. On
+        # big trees, this is a lot less calls than checking each path, then reading its stats.
+        # This is called from worker threads by _get_files_concurrently(), so it must not modify
+        # self.
+        state = self.get_state(root)
+        if state == DirectoryState.Excluded and self.is_pruned(root):
+            return [], []
+        if on_folder is not None:
+            on_folder(root)
+        try:
+            entries = list(os.scandir(str(root)))
+        except OSError:
+            return [], []
+        found_files = []
+        subpaths = []
+        try:
+            for entry in entries:
+                path = root + entry.name
+                if state != DirectoryState.Excluded:
+                    # In some cases, directories can be considered as files by dupeGuru, which
+                    # is why we also try directories here. In fact, there only one case: Bundle
+                    # files under OS X... In other situations, directories end up in subpaths.
+                    f = fs.get_file_from_entry(entry, path, fileclasses=fileclasses)
+                    if f is not None:
+                        found_files.append(f)
+                        continue
+                if entry.is_dir() and not entry.is_symlink():
+                    subpaths.append(path)
+        except (EnvironmentError, fs.InvalidPath):
+            return [], subpaths
+        logging.debug("Collected %d files in folder %s", len(found_files), str(root))
+        for file in found_files:
+            file.is_ref = state == DirectoryState.Reference
+        return found_files, subpaths
+
+    def _get_files(self, from_path, fileclasses, j, on_folder=None):
+        paths = [from_path]
+        while paths:
             j.check_if_cancelled()
-            root = Path(root)
-            state = self.get_state(root)
-            if state == DirectoryState.Excluded:
-                # Recursively get files from folders with lots of subfolder is expensive. However, there
-                # might be a subfolder in this path that is not excluded. What we want to do is to skim
-                # through self.states and see if we must continue, or we can stop right here to save time
-                if not any(p[:len(root)] == root for p in self.states):
-                    del dirs[:]
+            found_files, subpaths = self._list_directory(paths.pop(), fileclasses, on_folder)
+            yield from found_files
+            # Reversed because we pop from the end and we want to walk in the order of the listing.
+            paths += reversed(subpaths)
+
+    def _get_files_concurrently(self, fileclasses, thread_count, j, on_folder=None):
+        # Directories of all roots are listed from a pool of threads, which is much faster when the
+        # latency of each listing is high (network file systems). Files are yielded as soon as
+        # their directory has been listed, so their order isn't deterministic.
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            pending = {executor.submit(self._list_directory, path, fileclasses, on_folder) for path in self._dirs}
             try:
-                if state != DirectoryState.Excluded:
-                    found_files = [fs.get_file(root + f, fileclasses=fileclasses) for f in files]
-                    found_files = [f for f in found_files if f is not None]
-                    # In some cases, directories can be considered as files by dupeGuru, which is
-                    # why we have this line below. In fact, there only one case: Bundle files under
-                    # OS X... In other situations, this forloop will do nothing.
-                    for d in dirs[:]:
-                        f = fs.get_file(root + d, fileclasses=fileclasses)
-                        if f is not None:
-                            found_files.append(f)
-                            dirs.remove(d)
-                    logging.debug("Collected %d files in folder %s", len(found_files), str(from_path))
-                    for file in found_files:
-                        file.is_ref = state == DirectoryState.Reference
-                        yield file
-            except (EnvironmentError, fs.InvalidPath):
-                pass
+                while pending:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    j.check_if_cancelled()
+                    for future in done:
+                        found_files, subpaths = future.result()
+                        for path in subpaths:
+                            pending.add(executor.submit(self._list_directory, path, fileclasses, on_folder))
+                        yield from found_files
+            finally:
+                # Cancelled job, error, or our caller doesn't want more files (has_any_file()).
+                for future in pending:
+                    future.cancel()
 
     def _get_folders(self, from_folder, j):
         j.check_if_cancelled()
@@ -150,17 +268,70 @@ class Directories:
         except EnvironmentError:
             return []
 
-    def get_files(self, fileclasses=None, j=job.nulljob):
+    def get_files(self, fileclasses=None, j=job.nulljob, thread_count=TRAVERSAL_THREAD_COUNT, on_folder=None):
         """Returns a list of all files that are not excluded.
 
         Returned files also have their ``is_ref`` attr set if applicable.
+
+        :param int thread_count: number of threads listing directories. With ``1``, directories
+                                 are listed one after the other and files are always returned
+                                 in the same order.
+        :param on_folder: if set, called with the path of each folder we walk, right before it's
+                          listed (such as :meth:`core.watcher.Watcher.watch_folder`). With more
+                          than one thread, it's called from the threads listing directories.
         """
         if fileclasses is None:
             fileclasses = [fs.File]
+        if thread_count > 1:
+            yield from self._get_files_concurrently(fileclasses, thread_count, j, on_folder)
+            return
         for path in self._dirs:
-            for file in self._get_files(path, fileclasses=fileclasses, j=j):
+            for file in self._get_files(path, fileclasses=fileclasses, j=j, on_folder=on_folder):
                 yield file
 
+    def update_files(self, previous_files, journal, fileclasses=None, j=job.nulljob):
+        """Returns the files :meth:`get_files` would return, from ``previous_files`` and ``journal``.
+
+        Rather than walking all folders again, we keep files of ``previous_files`` that are in
+        folders where nothing happened since they were collected, and only list the folders
+        ``journal`` reports as changed.
+
+        :param previous_files: files returned by the last call to :meth:`get_files` or to this
+                               method, with the same folder selection and states.
+        :param journal: a :class:`core.watcher.Journal` covering everything that changed since.
+        """
+        if fileclasses is None:
+            fileclasses = [fs.File]
+
+        def is_under(path, paths):
+            return any(path[:i] in paths for i in range(1, len(path) + 1))
+
+        def is_kept(f):
+            # Files in dirty folders are listed again and new folders are walked entirely.
+            if f.path.parent() in journal.dirty:
+                return False
+            return not (is_under(f.path, journal.removed) or is_under(f.path, journal.added))
+
+        result = [f for f in previous_files if is_kept(f)]
+        for f in result:
+            # Writes made by other machines on network volumes aren't journaled. Stats and digests
+            # are read again so that digests are only taken from the hash cache if the file didn't
+            # change since they were computed.
+            for attrname in f.INITIAL_INFO:
+                setattr(f, attrname, fs.NOT_SET)
+            # Results may have changed the ref status of these files since they were collected.
+            f.is_ref = self.get_state(f.path.parent()) == DirectoryState.Reference
+        for path in j.iter_with_progress(journal.dirty, tr("Listed %d/%d changed folders")):
+            if is_under(path, journal.removed) or is_under(path, journal.added):
+                continue
+            found_files, _ = self._list_directory(path, fileclasses)
+            result += found_files
+        for path in journal.added:
+            if is_under(path, journal.removed) or is_under(path.parent(), journal.added):
+                continue # removed since then or already walked
+            result += self._get_files(path, fileclasses, j)
+        return result
+
     def get_folders(self, folderclass=None, j=job.nulljob):
         """Returns a list of all folders that are not excluded.
 
@@ -173,6 +344,18 @@ class Directories:
             for folder in self._get_folders(from_folder, j):
                 yield folder
 
+    def is_pruned(self, path):
+        """Returns whether nothing in or under the folder at ``path`` is ever scanned.
+
+        :rtype: bool
+        """
+        if self.get_state(path) != DirectoryState.Excluded:
+            return False
+        # Recursively get files from folders with lots of subfolder is expensive. However, there
+        # might be a subfolder in this path that is not excluded. What we want to do is to skim
+        # through our states and see if we must continue, or we can stop right here to save time
+        return not self._state_trie.has_active_descendant(path)
+
     def get_state(self, path):
         """Returns the state of ``path``.
 
@@ -181,13 +364,10 @@ class Directories:
         # direct match? easy result.
         if path in self.states:
             return self.states[path]
-        state = self._default_state_for_path(path) or DirectoryState.Normal
-        prevlen = 0
-        # we loop through the states to find the longest matching prefix
-        for p, s in self.states.items():
-            if p.is_parent_of(path) and len(p) > prevlen:
-                prevlen = len(p)
-                state = s
+        # the state of the longest matching prefix, if any, has priority over the default one
+        state = self._state_trie.get_state(path)
+        if state is None:
+            state = self._default_state_for_path(path) or DirectoryState.Normal
         return state
 
     def has_any_file(self):
@@ -227,7 +407,10 @@ class Directories:
                 continue
             path = attrib['path']
             state = attrib['value']
-            self.states[Path(path)] = int(state)
+            path = Path(path)
+            state = int(state)
+            self.states[path] = state
+            self._state_trie.set_state(path, state)
 
     def save_to_file(self, outfile):
         """Save folder selection as XML to ``outfile``.
@@ -259,4 +442,6 @@ class Directories:
             if path.is_parent_of(iter_path):
                 del self.states[iter_path]
         self.states[path] = state
+        self._state_trie.remove_descendants(path)
+        self._state_trie.set_state(path, state)
 
@@ -9,14 +9,28 @@
 import difflib
 import itertools
 import logging
+import multiprocessing
+import re
 import string
-from collections import defaultdict, namedtuple
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from unicodedata import normalize
 
-from hscommon.util import flatten, multi_replace
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from hscommon.util import flatten
 from hscommon.trans import tr
 from hscommon.jobprogress import job
 
+if np is not None:
+    from . import minhash
+
 (
     WEIGHT_WORDS,
     MATCH_SIMILAR_WORDS,
@@ -25,12 +39,83 @@ from hscommon.jobprogress import job
 
 JOB_REFRESH_RATE = 100
 
+# hashlib releases the GIL while it digests data, so reading and hashing files from a pool of
+# threads keeps fast disks (SSD, NVMe, arrays) busy. On a single spinning disk, concurrent reads
+# mostly add seeks, which is why this is configurable through ``hash_thread_count``.
+try:
+    HASH_THREAD_COUNT = multiprocessing.cpu_count()
+except Exception:
+    HASH_THREAD_COUNT = 4
+
+# Word-based matching is CPU bound, so getmatches() can score candidates in a pool of processes.
+# Starting processes and sending them the word index has a cost, which only pays off with at least
+# MIN_OBJECTS_PER_PROCESS objects per process.
+MATCH_PROCESS_COUNT = HASH_THREAD_COUNT
+MIN_OBJECTS_PER_PROCESS = 2000
+# Shards of word IDs sent to match processes, per process. Shards have about the same number of
+# candidates but not the same cost, so we make enough of them for processes to stay busy.
+SHARDS_PER_PROCESS = 16
+
+# Digest attributes read by Contents scans, from the cheapest to the most expensive. Each probe
+# only reads a few Kb per file (see ``core.fs.File._get_probe``), which eliminates most same-sized
+# files before we read them completely.
+DIGEST_STAGES = ['md5head', 'md5tail', 'md5partial', 'md5samples', 'md5']
+
+# Digest attributes read by Folders scans. A folder's digest is made of the digests of all its
+# files, so every stage costs a pass over all of them and we only keep the most effective probe.
+FOLDER_DIGEST_STAGES = ['md5partial', 'md5']
+
+# When comparing files byte by byte, buckets of at most this many files are compared rather than
+# digested. Each file of a bucket is read at once, so this has to stay small.
+DEFAULT_BYTEWISE_MAX_FILES = 3
+
+# Size of the chunks read from each file by compare_contents()
+COMPARE_CHUNK_SIZE = 1024 * 1024 # 1 mb
+
+# merge_similar_words() finds similar words through deletions of their first chars, up to this many
+SIMILAR_WORDS_PREFIX_LENGTH = 8
+
+# getwords() splits words on these chars and removes all other chars except WORD_CHARS. As we
+# lower the string first, no uppercase letter is left when we remove chars.
+WORD_SEPARATORS = "-_&+():;\\[]{}.,<>/?~!@#$*"
+WORD_CHARS = string.ascii_lowercase + string.digits + string.whitespace
+WORD_SEPARATORS_TABLE = str.maketrans(WORD_SEPARATORS, ' ' * len(WORD_SEPARATORS))
+NON_WORD_CHARS_RE = re.compile('[^%s]' % re.escape(WORD_CHARS))
+NON_ASCII_RE = re.compile('[^\x00-\x7f]')
+# Lowers, splits and removes chars of ascii strings in one go
+ASCII_WORDS_TABLE = str.maketrans(
+    WORD_SEPARATORS + string.ascii_uppercase,
+    ' ' * len(WORD_SEPARATORS) + string.ascii_lowercase,
+    ''.join(c for c in map(chr, range(128)) if c not in WORD_SEPARATORS + WORD_CHARS + string.ascii_uppercase),
+)
+# Names, and even more so tags (albums, artists), come back often.
+GETWORDS_CACHE_SIZE = 0x10000
+
+# Jaccard similarity from which pairs are likely to be compared when approximating candidates with
+# MinHash. Lower values find more matches but yield more candidates to compare. 0.5 is a match
+# percentage of 67%, which gives a good recall for a minimum match percentage of 80%.
+DEFAULT_LSH_THRESHOLD = 0.5
+
+# Words that at least this many objects have are only indexed for objects having only common words
+# (see reduce_common_words()).
+COMMON_WORD_THRESHOLD = 50
+
+# Number of candidate pairs getmatches() scores at once with WordBags when NumPy is available
+SCORE_BATCH_SIZE = 0x10000
+
+@lru_cache(maxsize=GETWORDS_CACHE_SIZE)
+def _getwords(s):
+    if NON_ASCII_RE.search(s) is None: # str.isascii() needs Python 3.7
+        # Most names. Nothing to decompose and a single table does it all.
+        s = s.translate(ASCII_WORDS_TABLE)
+    else:
+        # We decompose the string so that ascii letters with accents can be part of the word.
+        s = normalize('NFD', s).lower().translate(WORD_SEPARATORS_TABLE)
+        s = NON_WORD_CHARS_RE.sub('', s)
+    return tuple(_f for _f in s.split(' ') if _f) # remove empty elements
+
 def getwords(s):
-    # We decompose the string so that ascii letters with accents can be part of the word.
-    s = normalize('NFD', s)
-    s = multi_replace(s, "-_&+():;\\[]{}.,<>/?~!@#$*", ' ').lower()
-    s = ''.join(c for c in s if c in string.ascii_letters + string.digits + string.whitespace)
-    return [_f for _f in s.split(' ') if _f] # remove empty elements
+    return list(_getwords(s))
 
 def getfields(s):
     fields = [getwords(field) for field in s.split(' - ')]
@@ -104,6 +189,103 @@ def compare_fields(first, second, flags=()):
         results = [compare(field1, field2, flags) for field1, field2 in zip(first, second)]
     return min(results) if results else 0
 
+class WordBags:
+    """Word lists of ``words`` encoded as integers, to :meth:`compare` many pairs at once with NumPy.
+
+    Each word list is a bag of ``(word_id, count)``. The bags of all lists are concatenated in flat
+    arrays, ``offsets[i]:offsets[i+1]`` being the slice of ``words[i]``. Only plain word lists can
+    be encoded (not :ref:`fields`) and similar words aren't matched.
+    """
+    def __init__(self, words, weight_words=False):
+        vocabulary = {}
+        offsets = [0]
+        word_ids = []
+        counts = []
+        for object_words in words:
+            bag = Counter(vocabulary.setdefault(word, len(vocabulary)) for word in object_words)
+            word_ids += bag.keys()
+            counts += bag.values()
+            offsets.append(len(word_ids))
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.word_ids = np.array(word_ids, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.vocabulary_size = len(vocabulary)
+        if weight_words:
+            self.word_weights = np.array([len(word) for word in vocabulary], dtype=np.int64)
+        else:
+            self.word_weights = np.ones(len(vocabulary), dtype=np.int64)
+        # What all words of each object are worth in compare()
+        self.bag_lengths = np.diff(self.offsets)
+        owners = np.repeat(np.arange(len(self.bag_lengths)), self.bag_lengths)
+        values = self.counts * self.word_weights[self.word_ids]
+        self.totals = np.bincount(owners, weights=values, minlength=len(self.bag_lengths))
+
+    def _gather(self, indexes):
+        # Returns (pair_numbers, entries): the entries of the bags of objects at `indexes`, along
+        # with the number of the pair each of them is for.
+        starts = self.offsets[indexes]
+        lengths = self.offsets[indexes + 1] - starts
+        pair_numbers = np.repeat(np.arange(len(indexes)), lengths)
+        bag_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        entries = starts[pair_numbers] + np.arange(len(pair_numbers)) - bag_starts
+        return pair_numbers, entries
+
+    def compare(self, indexes1, indexes2):
+        """Returns the :func:`compare` results of the word lists at ``indexes1`` with ``indexes2``.
+
+        The result is an array of ints. A result of 100 doesn't take word order into account
+        and has to be confirmed with :func:`compare`, which might give 99 instead.
+        """
+        indexes1 = np.asarray(indexes1, dtype=np.int64)
+        indexes2 = np.asarray(indexes2, dtype=np.int64)
+        pairs1, entries1 = self._gather(indexes1)
+        pairs2, entries2 = self._gather(indexes2)
+        # A word is in both bags of a pair when the same (pair, word) key comes from both sides.
+        # Keys are unique within a bag, so matching keys are adjacent once sorted, the one from
+        # the first bag being first because the sort is stable.
+        keys = np.concatenate([
+            pairs1 * self.vocabulary_size + self.word_ids[entries1],
+            pairs2 * self.vocabulary_size + self.word_ids[entries2],
+        ])
+        entries = np.concatenate([entries1, entries2])
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        matching = np.nonzero(sorted_keys[1:] == sorted_keys[:-1])[0]
+        first_entries = entries[order[matching]]
+        second_entries = entries[order[matching + 1]]
+        # compare() removes each matched word from `second`: a word matches min(count) times.
+        matched_counts = np.minimum(self.counts[first_entries], self.counts[second_entries])
+        matched_values = matched_counts * self.word_weights[self.word_ids[first_entries]]
+        match_counts = np.bincount(
+            pairs1[order[matching]], weights=matched_values, minlength=len(indexes1)
+        )
+        total_counts = self.totals[indexes1] + self.totals[indexes2]
+        empty = (self.bag_lengths[indexes1] == 0) | (self.bag_lengths[indexes2] == 0)
+        total_counts[empty] = 1
+        # Same operations, in the same order, as compare() so that we round the same floats.
+        result = np.rint(((match_counts * 2) / total_counts) * 100).astype(np.int64)
+        result[empty] = 0
+        return result
+
+def score_batch(words, bags, indexes1, indexes2, flags, min_match_percentage):
+    """Returns ``(index1, index2, percentage)`` for pairs of ``indexes1`` and ``indexes2`` that match.
+
+    ``bags`` are the :class:`WordBags` of ``words`` and ``indexes1``/``indexes2`` are arrays of
+    indexes in ``words``. Only pairs matching by at least ``min_match_percentage`` are returned.
+    """
+    percentages = bags.compare(indexes1, indexes2)
+    result = []
+    for i in np.nonzero(percentages >= min_match_percentage)[0].tolist():
+        index1, index2 = int(indexes1[i]), int(indexes2[i])
+        percentage = int(percentages[i])
+        if percentage == 100:
+            # Only compare() knows if words are in the same order.
+            percentage = compare(words[index1], words[index2], flags)
+            if percentage < min_match_percentage:
+                continue
+        result.append((index1, index2, percentage))
+    return result
+
 def build_word_dict(objects, j=job.nulljob):
     """Returns a dict of objects mapped by their words.
 
@@ -118,25 +300,127 @@ def build_word_dict(objects, j=job.nulljob):
             result[word].add(object)
     return result
 
+def build_word_index(objects, word_dict):
+    """Returns ``(postings, object_words)``, an inverted index of ``word_dict``.
+
+    Words are interned to integer IDs (their position in ``postings``) and objects are referred to
+    by their index in ``objects``. ``postings[word_id]`` is a sorted array of the indexes of the
+    objects having that word and ``object_words[index]`` is a sorted array of the IDs of the words
+    of ``objects[index]``. Arrays of ints are much more compact than sets of objects.
+
+    ``word_dict`` has been built with :func:`build_word_dict` and is emptied in the process.
+    """
+    obj2index = {o: index for index, o in enumerate(objects)}
+    postings = []
+    object_words = [array('I') for _ in objects]
+    while word_dict:
+        word_objects = word_dict.popitem()[1]
+        word_id = len(postings)
+        posting = array('I', sorted(obj2index[o] for o in word_objects))
+        postings.append(posting)
+        for index in posting:
+            object_words[index].append(word_id)
+    return postings, object_words
+
+def iter_candidates(word_id, postings, object_words, only_with=None):
+    """Yields the ``(index1, index2)`` pairs of objects to compare for the word ``word_id``.
+
+    ``postings`` and ``object_words`` come from :func:`build_word_index`. A pair is only yielded
+    for the smallest word ID its objects share, so that each pair is yielded once for all words.
+    If ``only_with`` isn't None, it's a set of object indexes and pairs without any of them are
+    skipped.
+    """
+    posting = postings[word_id]
+    for i, ref_index in enumerate(posting):
+        ref_words = object_words[ref_index]
+        earlier_words = set(ref_words[:bisect_left(ref_words, word_id)])
+        ref_in_only_with = only_with is None or ref_index in only_with
+        for other_index in posting[i+1:]:
+            if earlier_words:
+                other_words = object_words[other_index]
+                if not earlier_words.isdisjoint(other_words[:bisect_left(other_words, word_id)]):
+                    continue
+            if not ref_in_only_with and other_index not in only_with:
+                continue
+            yield ref_index, other_index
+
+def get_word_deletions(word, max_deletions=None):
+    """Returns the set of strings obtained by deleting up to ``max_deletions`` chars of ``word``.
+
+    Only the :data:`SIMILAR_WORDS_PREFIX_LENGTH` first chars of ``word`` are considered. If
+    ``max_deletions`` is None, it's a third of the length of ``word``, up to 2. Two words being 80%
+    similar (as in :func:`merge_similar_words`) have a common subsequence that each of them gets
+    to with at most a third of its chars deleted, so they have deletions in common unless they're
+    long and differ by more than two chars.
+    """
+    if max_deletions is None:
+        max_deletions = min(len(word) // 3, 2)
+    word = word[:SIMILAR_WORDS_PREFIX_LENGTH]
+    result = {word}
+    current = {word}
+    for _ in range(max_deletions):
+        current = {w[:i] + w[i+1:] for w in current for i in range(len(w))}
+        result |= current
+    return result
+
 def merge_similar_words(word_dict):
     """Take all keys in ``word_dict`` that are similar, and merge them together.
 
     ``word_dict`` has been built with :func:`build_word_dict`. Similarity is computed with Python's
     ``difflib.get_close_matches()``, which computes the number of edits that are necessary to make
     a word equal to the other.
+
+    Comparing each word with all others doesn't scale to large vocabularies, so words are only
+    compared with the words they have deletions in common with (see :func:`get_word_deletions`).
+    Similar words having no deletions in common (long words differing by more than two chars)
+    aren't merged.
+
+    Returns a ``{similar: key}`` dict of the merged words.
     """
     keys = list(word_dict.keys())
     keys.sort(key=len)# we want the shortest word to stay
-    while keys:
-        key = keys.pop(0)
-        similars = difflib.get_close_matches(key, keys, 100, 0.8)
+    deletion2keys = defaultdict(list)
+    for key in keys:
+        for deletion in get_word_deletions(key):
+            deletion2keys[deletion].append(key)
+    done = set()
+    merged = {}
+    for key in keys:
+        if key in done:
+            continue # merged into a shorter word
+        done.add(key)
+        candidates = {
+            candidate for deletion in get_word_deletions(key) for candidate in deletion2keys.get(deletion, ())
+            if candidate not in done
+        }
+        similars = difflib.get_close_matches(key, candidates, 100, 0.8)
         if not similars:
             continue
         objects = word_dict[key]
         for similar in similars:
             objects |= word_dict[similar]
             del word_dict[similar]
-            keys.remove(similar)
+            done.add(similar)
+            merged[similar] = key
+    return merged
+
+def get_word_state(objects, match_similar_words=False):
+    """Returns what, besides their own words, decides which pairs of ``objects`` :func:`getmatches`
+    compares.
+
+    Common words (see :func:`reduce_common_words`) and similar words (see
+    :func:`merge_similar_words`) depend on all ``objects``. As long as they don't change, pairs of
+    objects whose words didn't change are compared, or not, like before. The result is a dict that
+    can be dumped to JSON and compared with the one of another scan.
+    """
+    word_dict = build_word_dict(objects)
+    common_words = sorted(word for word, objects in word_dict.items() if len(objects) >= COMMON_WORD_THRESHOLD)
+    reduce_common_words(word_dict, COMMON_WORD_THRESHOLD)
+    merged_words = sorted(merge_similar_words(word_dict).items()) if match_similar_words else []
+    return {
+        'common_words': common_words,
+        'merged_words': [list(item) for item in merged_words],
+    }
 
 def reduce_common_words(word_dict, threshold):
     """Remove all objects from ``word_dict`` values where the object count >= ``threshold``
@@ -191,7 +475,7 @@ def get_match(first, second, flags=()):
 
 def getmatches(
         objects, min_match_percentage=0, match_similar_words=False, weight_words=False,
-        no_field_order=False, j=job.nulljob):
+        no_field_order=False, only_with=None, process_count=1, lsh_threshold=None, j=job.nulljob):
     """Returns a list of :class:`Match` within ``objects`` after fuzzily matching their words.
 
     :param objects: List of :class:`~core.fs.File` to match.
@@ -199,19 +483,23 @@ def getmatches(
     :param bool match_similar_words: make similar words (see :func:`merge_similar_words`) match.
     :param bool weight_words: longer words are worth more in match % computations.
     :param bool no_field_order: match :ref:`fields` regardless of their order.
+    :param only_with: if not None, a set of objects within ``objects``. Only pairs with at least one
+                      object in that set are compared (used for incremental rescans).
+    :param int process_count: number of processes to score candidates in. With enough objects,
+                              the word index is split in shards that processes match on their own.
+    :param lsh_threshold: if not None, candidates are approximated with MinHash signatures (see
+                          :mod:`core.minhash`) rather than taken from a word index. Pairs whose word
+                          sets have a Jaccard similarity around ``lsh_threshold`` or more are likely
+                          to be compared. It's lower for a better recall, higher for less
+                          comparisons. Common words aren't ignored and matches aren't limited in
+                          number, but similar words aren't merged. Requires NumPy.
     :param j: A :ref:`job progress instance <jobs>`.
     """
-    COMMON_WORD_THRESHOLD = 50
     LIMIT = 5000000
-    j = j.start_subjob(2)
-    sj = j.start_subjob(2)
+    objects = list(objects)
     for o in objects:
         if not hasattr(o, 'words'):
             o.words = getwords(o.name)
-    word_dict = build_word_dict(objects, sj)
-    reduce_common_words(word_dict, COMMON_WORD_THRESHOLD)
-    if match_similar_words:
-        merge_similar_words(word_dict)
     match_flags = []
     if weight_words:
         match_flags.append(WEIGHT_WORDS)
@@ -219,56 +507,380 @@ def getmatches(
         match_flags.append(MATCH_SIMILAR_WORDS)
     if no_field_order:
         match_flags.append(NO_FIELD_ORDER)
-    j.start_job(len(word_dict), tr("0 matches found"))
-    compared = defaultdict(set)
+    if only_with is not None:
+        only_with = {index for index, o in enumerate(objects) if o in only_with}
+    if lsh_threshold is not None:
+        if np is not None:
+            return _getmatches_lsh(objects, match_flags, min_match_percentage, only_with, lsh_threshold, j)
+        logging.warning("NumPy isn't installed, we can't approximate matches. Matching them exactly.")
+    j = j.start_subjob(2)
+    sj = j.start_subjob(2)
+    word_dict = build_word_dict(objects, sj)
+    reduce_common_words(word_dict, COMMON_WORD_THRESHOLD)
+    if match_similar_words:
+        merge_similar_words(word_dict)
+    postings, object_words = build_word_index(objects, word_dict)
+    # Scores are computed in batches with NumPy when possible, which is much faster than calling
+    # get_match() for each pair. Similar words and fields can't be compared in batches.
+    can_batch = np is not None and not match_similar_words and not any(
+        isinstance(word, list) for o in objects for word in o.words
+    )
+    if process_count > 1 and len(objects) >= process_count * MIN_OBJECTS_PER_PROCESS:
+        return _getmatches_in_processes(
+            objects, postings, object_words, only_with, match_flags, min_match_percentage, can_batch,
+            process_count, LIMIT, j
+        )
+    words = [o.words for o in objects]
+    bags = WordBags(words, weight_words) if can_batch else None
+    batch1 = array('I')
+    batch2 = array('I')
     result = []
+
+    def flush_batch():
+        indexes1 = np.frombuffer(batch1, dtype=np.uint32).astype(np.int64)
+        indexes2 = np.frombuffer(batch2, dtype=np.uint32).astype(np.int64)
+        for index1, index2, percentage in score_batch(
+                words, bags, indexes1, indexes2, match_flags, min_match_percentage):
+            result.append(Match(objects[index1], objects[index2], percentage))
+        del batch1[:]
+        del batch2[:]
+
+    j.start_job(len(postings), tr("0 matches found"))
     try:
-        # This whole 'popping' thing is there to avoid taking too much memory at the same time.
-        while word_dict:
-            items = word_dict.popitem()[1]
-            while items:
-                ref = items.pop()
-                compared_already = compared[ref]
-                to_compare = items - compared_already
-                compared_already |= to_compare
-                for other in to_compare:
-                    m = get_match(ref, other, match_flags)
+        for word_id in range(len(postings)):
+            for ref_index, other_index in iter_candidates(word_id, postings, object_words, only_with):
+                if bags is not None:
+                    batch1.append(ref_index)
+                    batch2.append(other_index)
+                    if len(batch1) >= SCORE_BATCH_SIZE:
+                        flush_batch()
+                else:
+                    m = get_match(objects[ref_index], objects[other_index], match_flags)
                     if m.percentage >= min_match_percentage:
                         result.append(m)
-                        if len(result) >= LIMIT:
-                            return result
+                if len(result) >= LIMIT:
+                    return result[:LIMIT]
+            postings[word_id] = None # We don't need it anymore
             j.add_progress(desc=tr("%d matches found") % len(result))
+        if batch1:
+            flush_batch()
     except MemoryError:
         # This is the place where the memory usage is at its peak during the scan.
         # Just continue the process with an incomplete list of matches.
-        del compared # This should give us enough room to call logging.
-        logging.warning('Memory Overflow. Matches: %d. Word dict: %d' % (len(result), len(word_dict)))
+        del postings # This should give us enough room to call logging.
+        logging.warning('Memory Overflow. Matches: %d. Objects: %d' % (len(result), len(objects)))
         return result
+    return result[:LIMIT]
+
+def get_shards(postings, shard_count):
+    """Splits word IDs of ``postings`` in about ``shard_count`` shards of similar candidate counts.
+
+    Returns a list of arrays of word IDs.
+    """
+    costs = [len(posting) * (len(posting) - 1) // 2 for posting in postings]
+    shard_cost = max(sum(costs) / shard_count, 1)
+    result = []
+    shard = array('I')
+    cost = 0
+    for word_id, word_cost in enumerate(costs):
+        shard.append(word_id)
+        cost += word_cost
+        if cost >= shard_cost:
+            result.append(shard)
+            shard = array('I')
+            cost = 0
+    if shard:
+        result.append(shard)
     return result
 
-def getmatches_by_contents(files, j=job.nulljob):
-    """Returns a list of :class:`Match` within ``files`` if their contents is the same.
+# (words, postings, object_words, only_with, flags, min_match_percentage, bags) of a match process
+_match_process_state = None
+
+def _init_match_process(words, postings, object_words, only_with, flags, min_match_percentage, can_batch):
+    global _match_process_state
+    bags = WordBags(words, WEIGHT_WORDS in flags) if can_batch else None
+    _match_process_state = (words, postings, object_words, only_with, flags, min_match_percentage, bags)
+
+def _match_shard(word_ids):
+    # Runs in match processes. Returns the (indexes1, indexes2, percentages) arrays of the matches
+    # among candidates of `word_ids`. Arrays of ints are much cheaper to send back than Match
+    # instances, which the parent process creates.
+    words, postings, object_words, only_with, flags, min_match_percentage, bags = _match_process_state
+    indexes1, indexes2, percentages = array('I'), array('I'), array('B')
+    batch1, batch2 = array('I'), array('I')
+
+    def flush_batch():
+        batch_indexes1 = np.frombuffer(batch1, dtype=np.uint32).astype(np.int64)
+        batch_indexes2 = np.frombuffer(batch2, dtype=np.uint32).astype(np.int64)
+        for index1, index2, percentage in score_batch(
+                words, bags, batch_indexes1, batch_indexes2, flags, min_match_percentage):
+            indexes1.append(index1)
+            indexes2.append(index2)
+            percentages.append(percentage)
+        del batch1[:]
+        del batch2[:]
+
+    for word_id in word_ids:
+        for index1, index2 in iter_candidates(word_id, postings, object_words, only_with):
+            if bags is not None:
+                batch1.append(index1)
+                batch2.append(index2)
+                if len(batch1) >= SCORE_BATCH_SIZE:
+                    flush_batch()
+            else:
+                percentage = compare(words[index1], words[index2], flags)
+                if percentage >= min_match_percentage:
+                    indexes1.append(index1)
+                    indexes2.append(index2)
+                    percentages.append(percentage)
+    if batch1:
+        flush_batch()
+    return indexes1, indexes2, percentages
+
+def _getmatches_in_processes(
+        objects, postings, object_words, only_with, flags, min_match_percentage, can_batch,
+        process_count, limit, j):
+    # Candidates of each word only depend on the (read-only) word index, so shards of word IDs can
+    # be matched independently from each other. Processes get the index once, when they start.
+    shards = get_shards(postings, process_count * SHARDS_PER_PROCESS)
+    words = [o.words for o in objects]
+    initargs = (words, postings, object_words, only_with, flags, min_match_percentage, can_batch)
+    pool = multiprocessing.Pool(process_count, initializer=_init_match_process, initargs=initargs)
+    j.start_job(len(shards), tr("0 matches found"))
+    result = []
+    try:
+        for indexes1, indexes2, percentages in pool.imap_unordered(_match_shard, shards):
+            for index1, index2, percentage in zip(indexes1, indexes2, percentages):
+                result.append(Match(objects[index1], objects[index2], percentage))
+            if len(result) >= limit:
+                break
+            # Raises JobCancelled if the user cancelled, which terminates the pool below.
+            j.add_progress(desc=tr("%d matches found") % len(result))
+    except MemoryError:
+        logging.warning('Memory Overflow. Matches: %d. Objects: %d' % (len(result), len(objects)))
+    finally:
+        pool.terminate()
+        pool.join()
+    return result[:limit]
+
+def _getmatches_lsh(objects, flags, min_match_percentage, only_with, lsh_threshold, j):
+    # Candidates are the pairs of objects having the same key in a band of their MinHash signature.
+    j = j.start_subjob([1, 9])
+    j.set_progress(0, tr("Computing signatures"))
+    words = [o.words for o in objects]
+    sets = WordBags([set(unpack_fields(object_words)) for object_words in words])
+    # Objects without words don't match anything and empty sets don't have a MinHash.
+    with_words = np.nonzero(sets.bag_lengths)[0]
+    offsets = np.append(sets.offsets[with_words], sets.offsets[-1])
+    bands, rows = minhash.get_band_params(lsh_threshold)
+    band_keys = minhash.get_band_keys(offsets, sets.word_ids, bands, rows)
+    del sets
+    if only_with is not None:
+        in_only_with = np.zeros(len(objects), dtype=bool)
+        in_only_with[list(only_with)] = True
+    plain_words = not any(isinstance(word, list) for object_words in words for word in object_words)
+    bags = WordBags(words, WEIGHT_WORDS in flags) if plain_words and MATCH_SIMILAR_WORDS not in flags else None
+    result = []
+    batch1, batch2 = [], []
+
+    def flush_batch():
+        indexes1, indexes2 = np.concatenate(batch1), np.concatenate(batch2)
+        if bags is not None:
+            for index1, index2, percentage in score_batch(
+                    words, bags, indexes1, indexes2, flags, min_match_percentage):
+                result.append(Match(objects[index1], objects[index2], percentage))
+        else:
+            for index1, index2 in zip(indexes1.tolist(), indexes2.tolist()):
+                m = get_match(objects[index1], objects[index2], flags)
+                if m.percentage >= min_match_percentage:
+                    result.append(m)
+        del batch1[:]
+        del batch2[:]
+
+    j.start_job(bands, tr("0 matches found"))
+    batch_size = 0
+    for band in range(bands):
+        for indexes1, indexes2 in minhash.iter_band_candidates(band_keys, band):
+            indexes1, indexes2 = with_words[indexes1], with_words[indexes2]
+            if only_with is not None:
+                keep = in_only_with[indexes1] | in_only_with[indexes2]
+                indexes1, indexes2 = indexes1[keep], indexes2[keep]
+            batch1.append(indexes1)
+            batch2.append(indexes2)
+            batch_size += len(indexes1)
+            if batch_size >= SCORE_BATCH_SIZE:
+                flush_batch()
+                batch_size = 0
+        j.add_progress(desc=tr("%d matches found") % len(result))
+    if batch1:
+        flush_batch()
+    return result
+
+def read_digests(files, attrname, thread_count=HASH_THREAD_COUNT, j=job.nulljob):
+    """Reads the ``attrname`` digest (one of :data:`DIGEST_STAGES`) of every file in ``files``.
+
+    Digests are read from a pool of ``thread_count`` threads. Once this returns, reading
+    ``attrname`` on any of ``files`` doesn't touch the disk anymore.
+
+    :param j: A :ref:`job progress instance <jobs>`.
+    """
+    desc = tr("Hashed %d/%d files")
+    if thread_count <= 1 or len(files) <= 1:
+        for f in j.iter_with_progress(files, desc, JOB_REFRESH_RATE):
+            getattr(f, attrname, None)
+        return
+    j.start_job(len(files), desc % (0, len(files)))
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        futures = [executor.submit(getattr, f, attrname, None) for f in files]
+        try:
+            for i, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                if i % JOB_REFRESH_RATE == 0:
+                    j.set_progress(i, desc % (i, len(files)))
+        except BaseException:
+            # Don't make a cancelled scan wait for all remaining files to be hashed.
+            for future in futures:
+                future.cancel()
+            raise
+    j.set_progress(len(files), desc % (len(files), len(files)))
+
+def compare_contents(files, j=job.nulljob):
+    """Returns buckets (lists) of files within ``files`` that have identical contents.
+
+    ``files`` are expected to have the same size. Rather than digesting them completely, we read
+    all of them in lockstep, chunk by chunk, and stop reading a file as soon as its contents
+    diverges from all the others. For non-identical files, this reads about half as much as
+    digesting, and identical files can't be grouped because of a digest collision. Files that
+    can't be read are dropped.
+
+    :param j: A :ref:`job progress instance <jobs>`. Only used for cancellation.
+    """
+    result = []
+    opened = []
+    try:
+        for f in files:
+            try:
+                opened.append((f, f.path.open('rb')))
+            except OSError:
+                logging.warning("Couldn't open %s for comparison", f.path)
+        pending = [opened]
+        while pending:
+            j.check_if_cancelled()
+            bucket = pending.pop()
+            chunk2files = defaultdict(list)
+            for f, fp in bucket:
+                try:
+                    chunk2files[fp.read(COMPARE_CHUNK_SIZE)].append((f, fp))
+                except OSError:
+                    logging.warning("Couldn't read %s for comparison", f.path)
+            for chunk, members in chunk2files.items():
+                if len(members) < 2:
+                    continue
+                if chunk:
+                    pending.append(members)
+                else: # All members reached the end of their file at the same time
+                    result.append([f for f, fp in members])
+    finally:
+        for f, fp in opened:
+            fp.close()
+    return result
 
+def getbuckets_by_contents(
+        files, hash_thread_count=HASH_THREAD_COUNT, digest_stages=DIGEST_STAGES, bytewise_max_files=0,
+        j=job.nulljob):
+    """Returns a list of buckets (lists) of files within ``files`` that have the same contents.
+
+    Files are first bucketed by size, then each stage of ``digest_stages`` splits the buckets
+    further. Only files still sharing a bucket with another file have the next stage read, so
+    same-sized files that differ anywhere a probe looks at are never read completely. Files that
+    aren't bigger than a probe (their ``PROBE_SIZE``) go straight to the last stage. Digests of
+    each stage are read in parallel (see :func:`read_digests`). Buckets containing only ref files
+    are dropped.
+
+    :param int hash_thread_count: number of threads reading digests.
+    :param digest_stages: digest attributes to read, in order. The last one should be ``md5``.
+    :param int bytewise_max_files: when the last stage is reached, buckets with at most this many
+                                   files are compared with :func:`compare_contents` instead of being
+                                   digested. ``0`` disables bytewise comparison.
     :param j: A :ref:`job progress instance <jobs>`.
     """
-    size2files = defaultdict(set)
+    def split(buckets, attrname):
+        result = []
+        for bucket in buckets:
+            digest2files = defaultdict(list)
+            for f in bucket:
+                # Objects that don't support a probe simply aren't split by it.
+                digest2files[getattr(f, attrname, None)].append(f)
+            result += [files for files in digest2files.values() if can_match(files)]
+        return result
+
+    def can_match(files):
+        # Don't spend time comparing ref files together.
+        return len(files) > 1 and not all(f.is_ref for f in files)
+
+    size2files = defaultdict(list)
     for f in files:
         if f.size:
-            size2files[f.size].add(f)
+            size2files[f.size].append(f)
     del files
-    possible_matches = [files for files in size2files.values() if len(files) > 1]
+    buckets = [files for files in size2files.values() if can_match(files)]
     del size2files
-    result = []
-    j.start_job(len(possible_matches), tr("0 matches found"))
-    for group in possible_matches:
-        for first, second in itertools.combinations(group, 2):
+    # Probing a file that small would open it once per probe to read all of it each time.
+    small_buckets = [files for files in buckets if files[0].size <= getattr(files[0], 'PROBE_SIZE', 0)]
+    buckets = [files for files in buckets if files[0].size > getattr(files[0], 'PROBE_SIZE', 0)]
+    # Probes read a few Kb per file, the full digest reads everything.
+    j = j.start_subjob([1] * (len(digest_stages) - 1) + [4])
+    for attrname in digest_stages[:-1]:
+        read_digests([f for files in buckets for f in files], attrname, hash_thread_count, j)
+        buckets = split(buckets, attrname)
+    buckets += small_buckets
+    attrname = digest_stages[-1]
+    if not bytewise_max_files:
+        read_digests([f for files in buckets for f in files], attrname, hash_thread_count, j)
+        return split(buckets, attrname)
+    to_compare = [files for files in buckets if len(files) <= bytewise_max_files]
+    to_digest = [files for files in buckets if len(files) > bytewise_max_files]
+    j = j.start_subjob([1, 1])
+    read_digests([f for files in to_digest for f in files], attrname, hash_thread_count, j)
+    buckets = split(to_digest, attrname)
+    for files in j.iter_with_progress(to_compare, tr("Compared %d/%d groups of files")):
+        buckets += [bucket for bucket in compare_contents(files, j) if can_match(bucket)]
+    return buckets
+
+def iter_matches_by_contents(
+        files, hash_thread_count=HASH_THREAD_COUNT, digest_stages=DIGEST_STAGES, bytewise_max_files=0,
+        j=job.nulljob):
+    """Yields :class:`Match` within ``files`` if their contents is the same.
+
+    Same as :func:`getmatches_by_contents`, but matches are yielded as they're made rather than
+    being returned in a list, which can be huge when big buckets of files are the same.
+    """
+    j = j.start_subjob([9, 1])
+    buckets = getbuckets_by_contents(files, hash_thread_count, digest_stages, bytewise_max_files, j)
+    match_count = 0
+    j.start_job(len(buckets), tr("0 matches found"))
+    for bucket in buckets:
+        for first, second in itertools.combinations(bucket, 2):
             if first.is_ref and second.is_ref:
                 continue # Don't spend time comparing two ref pics together.
-            if first.md5partial == second.md5partial:
-                if first.md5 == second.md5:
-                    result.append(Match(first, second, 100))
-        j.add_progress(desc=tr("%d matches found") % len(result))
-    return result
+            match_count += 1
+            yield Match(first, second, 100)
+        j.add_progress(desc=tr("%d matches found") % match_count)
+
+def getmatches_by_contents(
+        files, hash_thread_count=HASH_THREAD_COUNT, digest_stages=DIGEST_STAGES, bytewise_max_files=0,
+        j=job.nulljob):
+    """Returns a list of :class:`Match` within ``files`` if their contents is the same.
+
+    Matches are made between every pair of files in each bucket returned by
+    :func:`getbuckets_by_contents`.
+
+    :param int hash_thread_count: number of threads reading digests.
+    :param digest_stages: see :func:`getbuckets_by_contents`.
+    :param int bytewise_max_files: see :func:`getbuckets_by_contents`.
+    :param j: A :ref:`job progress instance <jobs>`.
+    """
+    return list(iter_matches_by_contents(files, hash_thread_count, digest_stages, bytewise_max_files, j))
 
 class Group:
     """A group of :class:`~core.fs.File` that match together.
@@ -296,7 +908,20 @@ class Group:
     .. attribute:: percentage
 
         Average match percentage of match pairs containing :attr:`ref`.
+
+    .. attribute:: exact
+
+        Whether the group was built with :meth:`add_exact_dupes`. Exact groups don't hold match
+        pairs.
+
+    .. attribute:: candidates
+
+        ``{file: set of files it matches}`` for files that aren't in the group yet. It's only
+        needed while matches are added and is freed by :meth:`discard_matches`.
     """
+    # There can be hundreds of thousands of groups, so we keep them as small as we can.
+    __slots__ = ('ordered', 'unordered', 'matches', 'exact', '_candidates', '_percentage', '_matches_for_ref')
+
     #---Override
     def __init__(self):
         self._clear()
@@ -317,15 +942,21 @@ class Group:
     def _clear(self):
         self._percentage = None
         self._matches_for_ref = None
-        self.matches = set()
-        self.candidates = defaultdict(set)
+        self._candidates = None
+        # Exact groups never hold matches. The empty frozenset is shared, unlike empty sets.
+        self.matches = frozenset()
         self.ordered = []
         self.unordered = set()
+        self.exact = False
 
     def _get_matches_for_ref(self):
+        # Returns {dupe: match pair between dupe and ref}. Exact groups don't need it.
         if self._matches_for_ref is None:
             ref = self.ref
-            self._matches_for_ref = [match for match in self.matches if ref in match]
+            self._matches_for_ref = {
+                match.second if match.first is ref else match.first: match
+                for match in self.matches if ref in match
+            }
         return self._matches_for_ref
 
     #---Public
@@ -340,7 +971,9 @@ class Group:
         :param tuple match: pair of :class:`~core.fs.File` to add
         """
         def add_candidate(item, match):
-            matches = self.candidates[item]
+            if self._candidates is None:
+                self._candidates = defaultdict(set)
+            matches = self._candidates[item]
             matches.add(match)
             if self.unordered <= matches:
                 self.ordered.append(item)
@@ -348,6 +981,8 @@ class Group:
 
         if match in self.matches:
             return
+        if not self.matches:
+            self.matches = set()
         self.matches.add(match)
         first, second, _ = match
         if first not in self.unordered:
@@ -357,6 +992,23 @@ class Group:
         self._percentage = None
         self._matches_for_ref = None
 
+    def add_exact_dupes(self, dupes):
+        """Adds ``dupes``, which are known to all have the same contents, to the group.
+
+        Unlike :meth:`add_match`, this doesn't need a match pair for every combination of
+        duplicates, which would be quadratic in their count. Instead, the group becomes
+        :attr:`exact` and matches with :attr:`ref` are always 100% matches.
+
+        :param dupes: list of :class:`~core.fs.File` to add
+        """
+        for dupe in dupes:
+            if dupe not in self.unordered:
+                self.ordered.append(dupe)
+                self.unordered.add(dupe)
+        self.exact = True
+        self._percentage = None
+        self._matches_for_ref = None
+
     def discard_matches(self):
         """Remove all recorded matches that didn't result in a duplicate being added to the group.
 
@@ -364,7 +1016,7 @@ class Group:
         """
         discarded = set(m for m in self.matches if not all(obj in self.unordered for obj in [m.first, m.second]))
         self.matches -= discarded
-        self.candidates = defaultdict(set)
+        self._candidates = None
         return discarded
 
     def get_match_of(self, item):
@@ -372,9 +1024,9 @@ class Group:
         """
         if item is self.ref:
             return
-        for m in self._get_matches_for_ref():
-            if item in m:
-                return m
+        if self.exact:
+            return Match(self.ref, item, 100) if item in self.unordered else None
+        return self._get_matches_for_ref().get(item)
 
     def prioritize(self, key_func, tie_breaker=None):
         """Reorders :attr:`ordered` according to ``key_func``.
@@ -433,14 +1085,20 @@ class Group:
 
     dupes = property(lambda self: self[1:])
 
+    @property
+    def candidates(self):
+        return self._candidates if self._candidates is not None else {}
+
     @property
     def percentage(self):
         if self._percentage is None:
-            if self.dupes:
-                matches = self._get_matches_for_ref()
-                self._percentage = sum(match.percentage for match in matches) // len(matches)
-            else:
+            if not self.dupes:
                 self._percentage = 0
+            elif self.exact:
+                self._percentage = 100
+            else:
+                matches = self._get_matches_for_ref().values()
+                self._percentage = sum(match.percentage for match in matches) // len(matches)
         return self._percentage
 
     @property
@@ -449,6 +1107,77 @@ class Group:
             return self[0]
 
 
+def get_exact_groups(buckets):
+    """Returns a list of :class:`Group` from ``buckets`` of files with the same contents.
+
+    Unlike :func:`get_groups`, no match pair is involved: each bucket becomes an :attr:`exact
+    <Group.exact>` group.
+    """
+    groups = []
+    for bucket in buckets:
+        if len(bucket) > 1:
+            group = Group()
+            group.add_exact_dupes(bucket)
+            groups.append(group)
+    return groups
+
+def get_transitive_groups(matches, is_match=None):
+    """Returns a list of :class:`Group` from ``matches`` that are all 100% and transitive.
+
+    When every match is 100% and ``a`` matching ``b`` and ``b`` matching ``c`` means that ``a``
+    matches ``c`` (such as matches by contents), groups are simply the connected components of the
+    matches, which we find with a union-find in near-linear time. Components become :attr:`exact
+    <Group.exact>` groups.
+
+    ``matches`` can be any iterable, such as a generator. It's only iterated once and its matches
+    aren't kept: memory only depends on the number of matched objects.
+
+    Matches filtered out before grouping (ignored pairs, for example) can leave a component without
+    a match for every pair of its files. The matches of such components are made again, for their
+    pairs of files for which ``is_match(first, second)`` is true, and grouped by
+    :func:`get_groups`. Pairs of ref files are never matched and don't count as missing, but only
+    one ref is kept per group.
+    """
+    parents = {}
+    # {root: number of matches in its component}
+    match_counts = {}
+
+    def find(obj):
+        parent = parents.setdefault(obj, obj)
+        while parent is not obj:
+            grandparent = parents[parent]
+            parents[obj] = grandparent # path halving
+            obj, parent = parent, grandparent
+        return obj
+
+    for first, second, _ in matches:
+        first_root, second_root = find(first), find(second)
+        if first_root is second_root:
+            match_counts[first_root] += 1
+        else:
+            parents[first_root] = second_root
+            match_counts[second_root] = match_counts.pop(first_root, 0) + match_counts.get(second_root, 0) + 1
+    root2objects = defaultdict(list)
+    for obj in parents:
+        root2objects[find(obj)].append(obj)
+    parents.clear()
+    buckets = []
+    incomplete_matches = []
+    for root, objects in root2objects.items():
+        refs = [obj for obj in objects if obj.is_ref]
+        pair_count = len(objects) * (len(objects) - 1) // 2 - len(refs) * (len(refs) - 1) // 2
+        if match_counts[root] == pair_count:
+            buckets.append(refs[:1] + [obj for obj in objects if not obj.is_ref])
+        else:
+            incomplete_matches += [
+                Match(first, second, 100) for first, second in itertools.combinations(objects, 2)
+                if not (first.is_ref and second.is_ref) and (is_match is None or is_match(first, second))
+            ]
+    groups = get_exact_groups(buckets)
+    if incomplete_matches:
+        groups += get_groups(incomplete_matches)
+    return groups
+
 def get_groups(matches):
     """Returns a list of :class:`Group` from ``matches``.
 
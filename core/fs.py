@@ -13,13 +13,32 @@
 
 import hashlib
 import logging
+import mmap
+import os
+import os.path as op
+import sqlite3 as sqlite
+from collections import OrderedDict
+from functools import partial
+from threading import Lock
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 from hscommon.util import nonone, get_file_ext
 
 __all__ = [
     'File',
     'Folder',
+    'FilesDB',
+    'filesdb',
+    'HASH_ALGORITHMS',
+    'get_hash_algorithm',
+    'set_hash_algorithm',
+    'hash_file_contents',
     'get_file',
+    'get_file_from_entry',
     'get_files',
     'FSError',
     'AlreadyExistsError',
@@ -30,6 +49,90 @@ __all__ = [
 
 NOT_SET = object()
 
+# Hash algorithms that can be used to compute file digests. Values are callables returning new
+# hash objects. Despite their name, the ``md5*`` attributes of files hold digests computed with
+# the algorithm selected with ``set_hash_algorithm()``.
+HASH_ALGORITHMS = OrderedDict([
+    ('md5', hashlib.md5),
+])
+if hasattr(hashlib, 'blake2b'): # Python 3.6+
+    HASH_ALGORITHMS['blake2b'] = partial(hashlib.blake2b, digest_size=16)
+if xxhash is not None and hasattr(xxhash, 'xxh3_128'):
+    HASH_ALGORITHMS['xxh3'] = xxhash.xxh3_128
+# ``fast`` isn't an algorithm by itself, it's the fastest one available here. Without xxhash, it's
+# BLAKE2b, or MD5: digests of files have to stay strong enough to tell that they're identical.
+FAST_HASH_ALGORITHM = next(name for name in ['xxh3', 'blake2b', 'md5'] if name in HASH_ALGORITHMS)
+
+_hash_algorithm = 'md5'
+
+# Files at least this big are mapped in memory when hashed instead of being read in chunks.
+MMAP_THRESHOLD = 64 * 1024 * 1024 # 64 mb
+# The goal here is to not run out of memory on really big files. However, the chunk size has to be
+# large enough so that the python loop isn't too costly in terms of CPU.
+READ_CHUNK_SIZE = 1024 * 1024 # 1 mb
+
+def get_hash_algorithm():
+    """Returns the name of the algorithm files are currently hashed with."""
+    return _hash_algorithm
+
+def set_hash_algorithm(name):
+    """Selects the algorithm, among :data:`HASH_ALGORITHMS`, with which files are hashed.
+
+    ``name`` can also be ``fast``, which selects the fastest non-cryptographic algorithm available.
+    Raises ``ValueError`` if ``name`` is unknown.
+    """
+    global _hash_algorithm
+    if name == 'fast':
+        name = FAST_HASH_ALGORITHM
+    if name not in HASH_ALGORITHMS:
+        raise ValueError("Unknown hash algorithm: {}".format(name))
+    _hash_algorithm = name
+
+def new_hash():
+    return HASH_ALGORITHMS[_hash_algorithm]()
+
+def _fadvise(fd, advice):
+    # posix_fadvise() only exists on some platforms (Linux, mostly) and is only a hint anyway.
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+def hash_file_contents(path_str, hasher):
+    """Feeds the whole contents of the file at ``path_str`` to ``hasher``.
+
+    Big files are mapped in memory, others are read in a reused buffer so that we don't allocate
+    a new ``bytes`` for every chunk. Where it's supported, we tell the OS that we read the file
+    sequentially and that it can drop it from its page cache afterwards: we only read it once and
+    we don't want multi-Gb files to push everything else out of the cache.
+    """
+    with open(path_str, 'rb', buffering=0) as fp:
+        fd = fp.fileno()
+        _fadvise(fd, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+        try:
+            if os.fstat(fd).st_size >= MMAP_THRESHOLD:
+                try:
+                    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+                        hasher.update(mapped)
+                    return
+                except (OSError, ValueError, OverflowError):
+                    # Mapping can fail, for example, for files bigger than the address space.
+                    # The buffered read below always works.
+                    pass
+            buf = bytearray(READ_CHUNK_SIZE)
+            view = memoryview(buf)
+            readcount = fp.readinto(buf)
+            while readcount:
+                hasher.update(view[:readcount])
+                readcount = fp.readinto(buf)
+        finally:
+            _fadvise(fd, getattr(os, 'POSIX_FADV_DONTNEED', 0))
+
+# Digests of small chunks of a file. They're much cheaper to read than the full md5 and Contents
+# scans use them to split files of the same size before reading them completely.
+PROBE_FIELDS = ('md5partial', 'md5head', 'md5tail', 'md5samples')
+
 class FSError(Exception):
     cls_message = "An error has occured on '{name}' in '{parent}'"
 
@@ -62,6 +165,125 @@ class OperationError(FSError):
     operation shows that it didn't work."""
     cls_message = "Operation on '{name}' failed."
 
+class FilesDB:
+    """Persistent cache of file digests, stored in a sqlite database.
+
+    Computing digests is what makes Contents and Folders scans slow, and most files don't change
+    between two scans. A digest is stored along with the device, inode, size and mtime of its file
+    at the time it was computed, and is only returned if none of these changed since.
+
+    ``kind`` is a string describing what was digested (``md5``, ``md5partial:16384:16384``), which
+    allows us to store more than one digest per file. ``algorithm`` is the name of the hash
+    algorithm (see :data:`HASH_ALGORITHMS`) the digest was computed with.
+    """
+    def __init__(self):
+        self.dbname = None
+        self.con = None
+        # Files are hashed from worker threads during Contents scans.
+        self.lock = Lock()
+
+    def _create_con(self, second_try=False):
+        def create_tables():
+            logging.debug("Creating hash cache tables.")
+            self.con.execute("drop table if exists digests")
+            self.con.execute(
+                "create table digests(path TEXT, kind TEXT, algorithm TEXT, dev INTEGER, inode INTEGER, "
+                "size INTEGER, mtime_ns INTEGER, digest BLOB, primary key (path, kind, algorithm))"
+            )
+
+        self.con = sqlite.connect(self.dbname, check_same_thread=False)
+        try:
+            self.con.execute(
+                "select path, kind, algorithm, dev, inode, size, mtime_ns, digest from digests where 1=2"
+            )
+        except sqlite.OperationalError: # new db or db from an older version
+            create_tables()
+        except sqlite.DatabaseError as e: # corrupted db
+            if second_try:
+                raise # Something really strange is happening
+            logging.warning('Could not create hash cache because of an error: %s', str(e))
+            self.con.close()
+            os.remove(self.dbname)
+            self._create_con(second_try=True)
+
+    def connect(self, dbname):
+        with self.lock:
+            self.dbname = dbname
+            self._create_con()
+
+    def close(self):
+        with self.lock:
+            if self.con is not None:
+                self.con.commit()
+                self.con.close()
+            self.con = None
+
+    def get(self, path_str, kind, algorithm, stats):
+        """Returns the cached ``kind`` digest of ``path_str``, or None if it isn't valid anymore.
+
+        :param stats: ``os.stat_result`` of ``path_str``, as it is now.
+        """
+        sql = "select digest from digests where path = ? and kind = ? and algorithm = ? and dev = ? "\
+            "and inode = ? and size = ? and mtime_ns = ?"
+        args = [path_str, kind, algorithm, stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns]
+        with self.lock:
+            if self.con is None:
+                return None
+            result = self.con.execute(sql, args).fetchone()
+        return result[0] if result else None
+
+    def put(self, path_str, kind, algorithm, stats, digest):
+        sql = "insert or replace into digests(path, kind, algorithm, dev, inode, size, mtime_ns, digest) "\
+            "values(?, ?, ?, ?, ?, ?, ?, ?)"
+        args = [path_str, kind, algorithm, stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns, digest]
+        with self.lock:
+            if self.con is None:
+                return
+            try:
+                self.con.execute(sql, args)
+            except sqlite.DatabaseError as e:
+                logging.warning('DatabaseError while caching digest of %r: %s', path_str, str(e))
+
+    def purge_outdated(self, roots, existing_paths=()):
+        """Remove records of files under ``roots`` that don't exist anymore.
+
+        Only records under the folders being scanned are checked: files elsewhere, such as on
+        volumes that aren't mounted right now, keep their digests for when they're scanned again.
+        Roots that don't exist are skipped for the same reason. ``existing_paths`` are paths we
+        already know exist (the files we've just collected), which we don't have to check again.
+
+        Records of files that changed don't need purging: they're replaced the next time their
+        digest is computed.
+        """
+        sql = "select distinct path from digests where substr(path, 1, ?) = ?"
+        paths = []
+        with self.lock:
+            if self.con is None:
+                return
+            for root in roots:
+                if not op.exists(root):
+                    continue
+                prefix = op.join(root, '')
+                paths += [row[0] for row in self.con.execute(sql, [len(prefix), prefix])]
+        existing_paths = set(existing_paths)
+        todelete = [(p, ) for p in paths if p not in existing_paths and not op.exists(p)]
+        if not todelete:
+            return
+        with self.lock:
+            if self.con is None:
+                return
+            self.con.executemany("delete from digests where path = ?", todelete)
+            self.con.commit()
+
+    @property
+    def connected(self):
+        return self.con is not None
+
+
+# Digests of files read during scans go through this instance. Until the app connects it to a
+# database, digests are simply computed every time.
+filesdb = FilesDB()
+
 class File:
     """Represents a file and holds metadata to be used for scanning.
     """
@@ -70,6 +292,9 @@ class File:
         'mtime': 0,
         'md5': '',
         'md5partial': '',
+        'md5head': '',
+        'md5tail': '',
+        'md5samples': '',
     }
     # Slots for File make us save quite a bit of memory. In a memory test I've made with a lot of
     # files, I saved 35% memory usage with "unread" files (no _read_info() call) and gains become
@@ -96,44 +321,81 @@ class File:
                 result = self.INITIAL_INFO[attrname]
         return result
 
+    # Size of the chunks read by the md5head, md5tail and md5samples probes
+    PROBE_SIZE = 0x1000 # 4Kb
+    # Number of evenly spaced chunks read by the md5samples probe
+    SAMPLE_COUNT = 8
+
     #This offset is where we should start reading the file to get a partial md5
     #For audio file, it should be where audio data starts
     def _get_md5partial_offset_and_size(self):
         return (0x4000, 0x4000) #16Kb
 
+    def _get_probe(self, field):
+        # Returns a (kind, chunks) tuple for the `field` probe. `chunks` is a list of
+        # (offset, size) to digest and `kind` identifies these chunks in `filesdb`.
+        size = self.PROBE_SIZE
+        if field == 'md5partial':
+            offset, size = self._get_md5partial_offset_and_size()
+            # The offset is part of the kind because subclasses read partial digests at different
+            # places in the same file.
+            return 'md5partial:{}:{}'.format(offset, size), [(offset, size)]
+        elif field == 'md5head':
+            return 'md5head:{}'.format(size), [(0, size)]
+        elif field == 'md5tail':
+            return 'md5tail:{}'.format(size), [(max(self.size - size, 0), size)]
+        else:
+            step = self.size // (self.SAMPLE_COUNT + 1)
+            chunks = [(step * i, size) for i in range(1, self.SAMPLE_COUNT + 1)]
+            return 'md5samples:{}:{}'.format(self.SAMPLE_COUNT, size), chunks
+
+    def _compute_md5chunks(self, chunks):
+        with self.path.open('rb') as fp:
+            md5 = new_hash()
+            for offset, size in chunks:
+                fp.seek(offset)
+                md5.update(fp.read(size))
+            return md5.digest()
+
+    def _compute_md5(self):
+        md5 = new_hash()
+        hash_file_contents(str(self.path), md5)
+        return md5.digest()
+
+    def _get_digest(self, kind, compute):
+        # Returns the digest from `filesdb` if it's still valid. Otherwise, computes it with
+        # `compute()` and stores it there for the next scan.
+        if not filesdb.connected:
+            return compute()
+        path_str = str(self.path)
+        stats = os.stat(path_str)
+        algorithm = get_hash_algorithm()
+        digest = filesdb.get(path_str, kind, algorithm, stats)
+        if digest is None:
+            digest = compute()
+            filesdb.put(path_str, kind, algorithm, stats, digest)
+        return digest
+
     def _read_info(self, field):
         if field in ('size', 'mtime'):
-            stats = self.path.stat()
-            self.size = nonone(stats.st_size, 0)
-            self.mtime = nonone(stats.st_mtime, 0)
-        elif field == 'md5partial':
+            self._read_stats(self.path.stat())
+        elif field in PROBE_FIELDS:
             try:
-                fp = self.path.open('rb')
-                offset, size = self._get_md5partial_offset_and_size()
-                fp.seek(offset)
-                partialdata = fp.read(size)
-                md5 = hashlib.md5(partialdata)
-                self.md5partial = md5.digest()
-                fp.close()
+                kind, chunks = self._get_probe(field)
+                setattr(self, field, self._get_digest(kind, lambda: self._compute_md5chunks(chunks)))
             except Exception:
                 pass
         elif field == 'md5':
             try:
-                fp = self.path.open('rb')
-                md5 = hashlib.md5()
-                # The goal here is to not run out of memory on really big files. However, the chunk
-                # size has to be large enough so that the python loop isn't too costly in terms of
-                # CPU.
-                CHUNK_SIZE = 1024 * 1024 # 1 mb
-                filedata = fp.read(CHUNK_SIZE)
-                while filedata:
-                    md5.update(filedata)
-                    filedata = fp.read(CHUNK_SIZE)
-                self.md5 = md5.digest()
-                fp.close()
+                self.md5 = self._get_digest('md5', self._compute_md5)
             except Exception:
                 pass
 
+    def _read_stats(self, stats):
+        # Sets the info we get from a ``os.stat_result`` of our path.
+        self.size = nonone(stats.st_size, 0)
+        self.mtime = nonone(stats.st_mtime, 0)
+
     def _read_all_info(self, attrnames=None):
         """Cache all possible info.
 
@@ -151,6 +413,19 @@ class File:
         """
         return not path.islink() and path.isfile()
 
+    @classmethod
+    def can_handle_entry(cls, entry, path):
+        """Returns whether this file wrapper class can handle ``path``, listed as ``entry``.
+
+        ``entry`` is the ``os.DirEntry`` of ``path`` returned by ``os.scandir()``. Unlike
+        :meth:`can_handle`, this uses the file type ``entry`` already knows instead of querying the
+        file system again. Subclasses overriding :meth:`can_handle` should override this too.
+        """
+        if cls.can_handle.__func__ is not File.can_handle.__func__:
+            # A subclass with its own criteria that doesn't know about entries.
+            return cls.can_handle(path)
+        return not entry.is_symlink() and entry.is_file()
+
     def rename(self, newname):
         if newname == self.name:
             return
@@ -206,7 +481,7 @@ class Folder(File):
             self.size = size
             stats = self.path.stat()
             self.mtime = nonone(stats.st_mtime, 0)
-        elif field in {'md5', 'md5partial'}:
+        elif field == 'md5' or field in PROBE_FIELDS:
             # What's sensitive here is that we must make sure that subfiles'
             # md5 are always added up in the same order, but we also want a
             # different md5 if a file gets moved in a different subdirectory.
@@ -216,7 +491,8 @@ class Folder(File):
                 md5s = [getattr(f, field) for f in items]
                 return b''.join(md5s)
 
-            md5 = hashlib.md5(get_dir_md5_concat())
+            md5 = new_hash()
+            md5.update(get_dir_md5_concat())
             digest = md5.digest()
             setattr(self, field, digest)
 
@@ -227,10 +503,18 @@ class Folder(File):
             self._subfolders = [self.__class__(p) for p in subfolders]
         return self._subfolders
 
+    def _read_stats(self, stats):
+        # Our size is the size of our subitems, not the one of our directory entry.
+        pass
+
     @classmethod
     def can_handle(cls, path):
         return not path.islink() and path.isdir()
 
+    @classmethod
+    def can_handle_entry(cls, entry, path):
+        return not entry.is_symlink() and entry.is_dir()
+
 
 def get_file(path, fileclasses=[File]):
     """Wraps ``path`` around its appropriate :class:`File` class.
@@ -244,6 +528,21 @@ def get_file(path, fileclasses=[File]):
         if fileclass.can_handle(path):
             return fileclass(path)
 
+def get_file_from_entry(entry, path, fileclasses=[File]):
+    """Wraps ``path``, listed as ``entry`` by ``os.scandir()``, around its appropriate :class:`File` class.
+
+    Same as :func:`get_file`, but file type and stat information cached in ``entry`` is used to
+    choose the class and to pre-populate ``size`` and ``mtime`` of the returned file.
+    """
+    for fileclass in fileclasses:
+        if fileclass.can_handle_entry(entry, path):
+            file = fileclass(path)
+            try:
+                file._read_stats(entry.stat())
+            except OSError:
+                pass # size and mtime will be read when needed, like with get_file()
+            return file
+
 def get_files(path, fileclasses=[File]):
     """Returns a list of :class:`File` for each file contained in ``path``.
 
@@ -0,0 +1,129 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+import json
+import logging
+import sqlite3 as sqlite
+from collections import namedtuple
+
+class FileInfo(namedtuple('FileInfo', 'size mtime words')):
+    """What we know about a file from the previous scan.
+
+    ``words`` is None if the scan that recorded it wasn't a word-based one.
+    """
+    __slots__ = ()
+
+
+class Inventory:
+    """Files and matches of the last scan, stored in a sqlite backend.
+
+    It's what makes incremental rescans possible: files with the same size and mtime as in the
+    previous scan get their words back without being read again and their matches with each other
+    don't need to be computed again. Only new or changed files have to be matched with the others.
+
+    An inventory is only valid for scans made with the same options. ``signature`` is a string
+    describing these options and inventories recorded with another signature are ignored.
+
+    Along with them, we keep a "word state" (see :func:`core.engine.get_word_state`): previous
+    matches are only valid if the words that all scanned files have in common didn't change.
+    """
+    def __init__(self, db=':memory:'):
+        self.dbname = db
+        self.con = None
+        self._create_con()
+
+    def _create_con(self, second_try=False):
+        def create_tables():
+            logging.debug("Creating inventory tables.")
+            self.con.execute("drop table if exists info")
+            self.con.execute("drop table if exists files")
+            self.con.execute("drop table if exists matches")
+            self.con.execute("create table info(signature TEXT, word_state TEXT)")
+            self.con.execute("create table files(path TEXT primary key, size INTEGER, mtime REAL, words TEXT)")
+            self.con.execute("create table matches(first TEXT, second TEXT, percentage INTEGER)")
+
+        self.con = sqlite.connect(self.dbname, isolation_level=None)
+        try:
+            self.con.execute("select signature, word_state from info where 1=2")
+            self.con.execute("select path, size, mtime, words from files where 1=2")
+            self.con.execute("select first, second, percentage from matches where 1=2")
+        except sqlite.OperationalError: # new db or db from an older version
+            create_tables()
+        except sqlite.DatabaseError as e: # corrupted db
+            if second_try:
+                raise # Something really strange is happening
+            logging.warning('Could not create inventory because of an error: %s', str(e))
+            self.con.close()
+            os.remove(self.dbname)
+            self._create_con(second_try=True)
+
+    def clear(self):
+        self.close()
+        if self.dbname != ':memory:':
+            os.remove(self.dbname)
+        self._create_con()
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+        self.con = None
+
+    def load(self, signature):
+        """Returns ``(path2info, matches)`` recorded by the last :meth:`save` with ``signature``.
+
+        ``path2info`` is a ``{path_str: FileInfo}`` dict and ``matches`` is a list of
+        ``(first_path_str, second_path_str, percentage)``. If the inventory was recorded with
+        another signature, both are empty.
+        """
+        row = self.con.execute("select signature from info").fetchone()
+        if row is None or row[0] != signature:
+            return {}, []
+        path2info = {}
+        for path_str, size, mtime, words in self.con.execute("select path, size, mtime, words from files"):
+            words = json.loads(words) if words is not None else None
+            path2info[path_str] = FileInfo(size, mtime, words)
+        matches = self.con.execute("select first, second, percentage from matches").fetchall()
+        return path2info, matches
+
+    def load_word_state(self, signature):
+        """Returns the word state given to the last :meth:`save` with ``signature``, or None.
+        """
+        row = self.con.execute("select signature, word_state from info").fetchone()
+        if row is None or row[0] != signature or row[1] is None:
+            return None
+        return json.loads(row[1])
+
+    def save(self, signature, files, matches, word_state=None):
+        """Replaces the inventory with ``files`` and their ``matches``, scanned with ``signature``.
+
+        ``word_state`` is a JSON serializable object returned as is by :meth:`load_word_state`.
+        """
+        def get_words(f):
+            words = getattr(f, 'words', None)
+            return json.dumps(words) if words is not None else None
+
+        self.con.execute("begin")
+        try:
+            self.con.execute("delete from info")
+            self.con.execute("delete from files")
+            self.con.execute("delete from matches")
+            self.con.execute(
+                "insert into info(signature, word_state) values(?, ?)",
+                [signature, json.dumps(word_state) if word_state is not None else None]
+            )
+            self.con.executemany(
+                "insert or replace into files(path, size, mtime, words) values(?, ?, ?, ?)",
+                ((str(f.path), f.size, f.mtime, get_words(f)) for f in files)
+            )
+            self.con.executemany(
+                "insert into matches(first, second, percentage) values(?, ?, ?)",
+                ((str(m.first.path), str(m.second.path), m.percentage) for m in matches)
+            )
+            self.con.execute("commit")
+        except sqlite.DatabaseError as e:
+            self.con.execute("rollback")
+            logging.warning('DatabaseError while saving inventory: %s', str(e))
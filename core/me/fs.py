@@ -40,6 +40,12 @@ class MusicFile(fs.File):
             return False
         return get_file_ext(path.name) in auto.EXT2CLASS
 
+    @classmethod
+    def can_handle_entry(cls, entry, path):
+        if not fs.File.can_handle_entry(entry, path):
+            return False
+        return get_file_ext(path.name) in auto.EXT2CLASS
+
     def get_display_info(self, group, delta):
         size = self.size
         duration = self.duration
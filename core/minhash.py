@@ -0,0 +1,84 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Approximate candidate generation for word-based scans, with MinHash signatures and LSH banding.
+
+The MinHash of a word set is the smallest hash of its words. Two sets have the same MinHash with a
+probability equal to their Jaccard similarity (the size of their intersection divided by the size
+of their union). Signatures are made of many MinHashes, computed with different hash functions,
+and cut in ``bands`` of ``rows`` MinHashes. Two sets with the same rows in at least one band are
+candidates, which happens with a probability of ``1 - (1 - s**rows)**bands`` for a similarity
+``s``. That's an S-curve whose steepest point, the threshold, is about ``(1 / bands)**(1 / rows)``.
+
+This requires NumPy.
+"""
+
+import numpy as np
+
+# Number of MinHashes in a signature
+SIGNATURE_SIZE = 128
+
+# A Mersenne prime larger than any word ID, for the (a * x + b) % P universal hash functions
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+def get_band_params(threshold, signature_size=SIGNATURE_SIZE):
+    """Returns the ``(bands, rows)`` whose S-curve threshold is the closest to ``threshold``.
+    """
+    candidates = [(signature_size // rows, rows) for rows in range(1, signature_size + 1)]
+    return min(candidates, key=lambda params: abs((1 / params[0]) ** (1 / params[1]) - threshold))
+
+def get_band_keys(offsets, word_ids, bands, rows, seed=0):
+    """Returns the band keys of word sets, an array of shape ``(bands, set_count)``.
+
+    ``offsets`` and ``word_ids`` are flat arrays of word IDs, ``word_ids[offsets[i]:offsets[i+1]]``
+    being the IDs (below 2**32) of the words of set ``i``, which can't be empty. Keys are 32-bit
+    hashes of the rows of each band: different rows can give the same key, but rarely enough not
+    to matter.
+    """
+    random = np.random.RandomState(seed)
+    hash_count = bands * rows
+    # Coefficients stay below 2**31 so that (a * x + b) never overflows 64 bits with x < 2**32.
+    a = random.randint(1, 1 << 31, size=hash_count).astype(np.uint64)
+    b = random.randint(0, 1 << 31, size=hash_count).astype(np.uint64)
+    row_multipliers = random.randint(1, 1 << 31, size=rows).astype(np.uint64) | np.uint64(1)
+    x = word_ids.astype(np.uint64)
+    starts = offsets[:-1]
+    result = np.empty((bands, len(starts)), dtype=np.uint32)
+    for band in range(bands):
+        key = np.zeros(len(starts), dtype=np.uint64)
+        for row in range(rows):
+            i = band * rows + row
+            hashes = ((a[i] * x + b[i]) % np.uint64(MERSENNE_PRIME)) & np.uint64(MAX_HASH)
+            minhashes = np.minimum.reduceat(hashes, starts)
+            key = key * row_multipliers[row] + minhashes # wraps around, which is fine for a hash
+        result[band] = (key ^ (key >> np.uint64(32))) & np.uint64(MAX_HASH)
+    return result
+
+def iter_band_candidates(band_keys, band):
+    """Yields ``(indexes1, indexes2)`` arrays of the pairs of sets with the same key in ``band``.
+
+    Pairs which also have the same key in a previous band have already been yielded for it and are
+    skipped, so that going through all bands yields each pair once.
+    """
+    keys = band_keys[band]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    boundaries = np.nonzero(sorted_keys[1:] != sorted_keys[:-1])[0] + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(keys)]])
+    previous_keys = band_keys[:band]
+    for start, end in zip(starts[ends - starts > 1].tolist(), ends[ends - starts > 1].tolist()):
+        bucket = order[start:end]
+        for position in range(len(bucket) - 1):
+            others = bucket[position+1:]
+            ref = np.full(len(others), bucket[position])
+            if band:
+                seen = (previous_keys[:, ref] == previous_keys[:, others]).any(axis=0)
+                others = others[~seen]
+                ref = ref[:len(others)]
+            if len(others):
+                yield ref, others
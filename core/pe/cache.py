@@ -14,6 +14,20 @@ def colors_to_string(colors):
     """
     return ''.join('%02x%02x%02x' % (r, g, b) for r, g, b in colors)
 
+def colors_to_bytes(colors):
+    """Transform the 3 sized tuples 'colors' into bytes, one per color component.
+
+    [(1,2,3),(4,5,6)] --> b'\\x01\\x02\\x03\\x04\\x05\\x06'
+    """
+    return bytes(component for color in colors for component in color)
+
+def bytes_to_colors(data):
+    """Transform the bytes 'data' in a list of 3 sized tuples.
+
+    An incomplete color at the end is ignored, like with string_to_colors.
+    """
+    return list(zip(data[0::3], data[1::3], data[2::3]))
+
 # This function is an important bottleneck of dupeGuru PE. It has been converted to C.
 # def string_to_colors(s):
 #     """Transform the string 's' in a list of 3 sized tuples.
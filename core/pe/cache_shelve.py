@@ -10,7 +10,7 @@ import shelve
 import tempfile
 from collections import namedtuple
 
-from .cache import string_to_colors, colors_to_string
+from .cache import string_to_colors, colors_to_string, colors_to_bytes
 
 def wrap_path(path):
     return 'path:{}'.format(path)
@@ -110,6 +110,10 @@ class ShelveCache:
                 continue
             yield (rowid, string_to_colors(self.shelve[skey].blocks))
 
+    def get_multiple_bytes(self, rowids):
+        for rowid, blocks in self.get_multiple(rowids):
+            yield (rowid, colors_to_bytes(blocks))
+
     def purge_outdated(self):
         """Go through the cache and purge outdated records.
 
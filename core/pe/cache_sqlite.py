@@ -9,10 +9,16 @@ import os.path as op
 import logging
 import sqlite3 as sqlite
 
-from .cache import string_to_colors, colors_to_string
+from .cache import colors_to_bytes, bytes_to_colors
+
+# Stored in the database's user_version. Version 0 stored blocks as hex strings. Version 1 stores
+# them as BLOBs of 3 bytes per block, which can be read without parsing.
+SCHEMA_VERSION = 1
 
 class SqliteCache:
     """A class to cache picture blocks in a sqlite backend.
+
+    Databases of a previous :data:`SCHEMA_VERSION` are migrated when they're opened.
     """
     def __init__(self, db=':memory:', readonly=False):
         # readonly is not used in the sqlite version of the cache
@@ -39,7 +45,7 @@ class SqliteCache:
             sql = "select blocks from pictures where path = ?"
         result = self.con.execute(sql, [key]).fetchone()
         if result:
-            result = string_to_colors(result[0])
+            result = bytes_to_colors(result[0])
             return result
         else:
             raise KeyError(key)
@@ -55,7 +61,7 @@ class SqliteCache:
         return result[0][0]
 
     def __setitem__(self, path_str, blocks):
-        blocks = colors_to_string(blocks)
+        blocks = colors_to_bytes(blocks)
         if op.exists(path_str):
             mtime = int(os.stat(path_str).st_mtime)
         else:
@@ -76,12 +82,47 @@ class SqliteCache:
             logging.debug("Creating picture cache tables.")
             self.con.execute("drop table if exists pictures")
             self.con.execute("drop index if exists idx_path")
-            self.con.execute("create table pictures(path TEXT, mtime INTEGER, blocks TEXT)")
+            self.con.execute("create table pictures(path TEXT, mtime INTEGER, blocks BLOB)")
             self.con.execute("create index idx_path on pictures (path)")
+            self.con.execute("pragma user_version = %d" % SCHEMA_VERSION)
+
+        def migrate_from_hex_strings():
+            logging.info("Migrating picture cache to binary blocks.")
+
+            def iter_rows():
+                for rowid, path, mtime, blocks in self.con.execute("select rowid, path, mtime, blocks from pictures"):
+                    try:
+                        yield (rowid, path, mtime, bytes.fromhex(blocks))
+                    except (TypeError, ValueError):
+                        pass # the blocks will be read again
+
+            self.con.execute("begin")
+            try:
+                self.con.execute("create table pictures_blobs(path TEXT, mtime INTEGER, blocks BLOB)")
+                self.con.executemany(
+                    "insert into pictures_blobs(rowid, path, mtime, blocks) values(?,?,?,?)", iter_rows()
+                )
+                self.con.execute("drop index if exists idx_path")
+                self.con.execute("drop table pictures")
+                self.con.execute("alter table pictures_blobs rename to pictures")
+                self.con.execute("create index idx_path on pictures (path)")
+                self.con.execute("pragma user_version = %d" % SCHEMA_VERSION)
+                self.con.execute("commit")
+            except sqlite.Error:
+                # Otherwise, the transaction stays open and whatever we do with the cache next is
+                # never committed.
+                self.con.execute("rollback")
+                raise
 
         self.con = sqlite.connect(self.dbname, isolation_level=None)
         try:
             self.con.execute("select path, mtime, blocks from pictures where 1=2")
+            version = self.con.execute("pragma user_version").fetchone()[0]
+            if version == 0:
+                migrate_from_hex_strings()
+            elif version != SCHEMA_VERSION:
+                # Made by a newer version. It's only a cache, we start over.
+                create_tables()
         except sqlite.OperationalError: # new db
             create_tables()
         except sqlite.DatabaseError as e: # corrupted db
@@ -117,9 +158,15 @@ class SqliteCache:
             raise ValueError(path)
 
     def get_multiple(self, rowids):
+        return ((rowid, bytes_to_colors(blocks)) for rowid, blocks in self.get_multiple_bytes(rowids))
+
+    def get_multiple_bytes(self, rowids):
+        """Returns ``(rowid, blocks)`` pairs like :meth:`get_multiple`, but with blocks as bytes.
+
+        Blocks are 3 bytes each (red, green, blue) and can be read as arrays without parsing.
+        """
         sql = "select rowid, blocks from pictures where rowid in (%s)" % ','.join(map(str, rowids))
-        cur = self.con.execute(sql)
-        return ((rowid, string_to_colors(blocks)) for rowid, blocks in cur)
+        return self.con.execute(sql)
 
     def purge_outdated(self):
         """Go through the cache and purge outdated records.
@@ -17,6 +17,17 @@ from hscommon.jobprogress import job
 from core.engine import Match
 from .block import avgdiff, DifferentBlockCountError, NoBlocksError
 
+try:
+    import numpy as np
+    from . import npblock
+except ImportError:
+    np = npblock = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8
+    shared_memory = None
+
 # OPTIMIZATION NOTES:
 # The bottleneck of the matching phase is CPU, which is why we use multiprocessing. However, another
 # bottleneck that shows up when a lot of pictures are involved is Disk IO's because blocks
@@ -31,11 +42,17 @@ from .block import avgdiff, DifferentBlockCountError, NoBlocksError
 # memory at the same time and we might end up with memory trashing, which is awfully slow. So,
 # because our *real* bottleneck is CPU, the chunk size must simply be enough so that the CPU isn't
 # starved by Disk IOs.
+# When NumPy and multiprocessing.shared_memory (Python 3.8+) are available, we do better: the parent
+# process reads all blocks once, in a shared memory array, and chunks are only ranges of pictures
+# in that array. Blocks are then read from disk number_of_files times.
 
 MIN_ITERATIONS = 3
 BLOCK_COUNT_PER_SIDE = 15
 DEFAULT_CHUNK_SIZE = 1000
 MIN_CHUNK_SIZE = 100
+# With NumPy, pairs of pictures are compared this many at once. Their blocks are copied in arrays
+# of PAIR_BATCH_SIZE * 225 * 3 bytes.
+PAIR_BATCH_SIZE = 0x4000
 
 # Enough so that we're sure that the main thread will not wait after a result.get() call
 # cpucount+1 should be enough to be sure that the spawned process will not wait after the results
@@ -112,15 +129,9 @@ def get_match(first, second, percentage):
         percentage = 0
     return Match(first, second, percentage)
 
-def async_compare(ref_ids, other_ids, dbname, threshold, picinfo):
-    # The list of ids in ref_ids have to be compared to the list of ids in other_ids. other_ids
-    # can be None. In this case, ref_ids has to be compared with itself
-    # picinfo is a dictionary {pic_id: (dimensions, is_ref)}
-    cache = get_cache(dbname, readonly=True)
+def _compare_pairs(ref_pairs, other_pairs, threshold, picinfo):
     limit = 100 - threshold
-    ref_pairs = list(cache.get_multiple(ref_ids))
-    if other_ids is not None:
-        other_pairs = list(cache.get_multiple(other_ids))
+    if other_pairs is not None:
         comparisons_to_do = [(r, o) for r in ref_pairs for o in other_pairs]
     else:
         comparisons_to_do = list(combinations(ref_pairs, 2))
@@ -139,9 +150,156 @@ def async_compare(ref_ids, other_ids, dbname, threshold, picinfo):
             percentage = 0
         if percentage >= threshold:
             results.append((ref_id, other_id, percentage))
-    cache.close()
     return results
 
+def _compare_block_arrays(ref, other, threshold):
+    # `ref` and `other` are (blocks, valid, dimensions, is_ref) arrays of pictures (see
+    # _compare_arrays()). When `other` is None, `ref` is compared with itself. The pairs to compare
+    # are selected with masks and their blocks are compared in batches with npblock.avgdiffs().
+    # Returns the (indexes1, indexes2, percentages) arrays of the pairs reaching `threshold`.
+    limit = 100 - threshold
+    self_compare = other is None
+    if self_compare:
+        other = ref
+    ref_blocks, ref_valid, ref_dimensions, ref_is_ref = ref
+    other_blocks, other_valid, other_dimensions, other_is_ref = other
+    candidates = ref_dimensions[:, None] == other_dimensions[None, :]
+    candidates &= ~(ref_is_ref[:, None] & other_is_ref[None, :])
+    if self_compare:
+        candidates = np.triu(candidates, k=1)
+    indexes1, indexes2 = np.nonzero(candidates)
+    percentages = np.zeros(len(indexes1), dtype=np.int32)
+    # Pictures without blocks can't be compared and get 0%, like with avgdiff().
+    valid = ref_valid[indexes1] & other_valid[indexes2]
+    valid_positions = np.nonzero(valid)[0]
+    for start in range(0, len(valid_positions), PAIR_BATCH_SIZE):
+        positions = valid_positions[start:start+PAIR_BATCH_SIZE]
+        diffs = npblock.avgdiffs(
+            ref_blocks, other_blocks, indexes1[positions], indexes2[positions], limit, MIN_ITERATIONS
+        )
+        percentages[positions] = 100 - diffs
+    found = np.nonzero(percentages >= threshold)[0]
+    return indexes1[found], indexes2[found], percentages[found]
+
+def _compare_arrays(ref_pairs, other_pairs, threshold, picinfo):
+    # Same as _compare_pairs(), but blocks are bytes (see SqliteCache.get_multiple_bytes()) and
+    # are compared as arrays.
+    dimensions2code = {}
+
+    def get_arrays(pairs):
+        pic_ids = [pic_id for pic_id, _ in pairs]
+        blocks, valid = npblock.to_block_array([blocks for _, blocks in pairs], BLOCK_COUNT_PER_SIDE ** 2)
+        dimensions = [dimensions2code.setdefault(picinfo[pic_id][0], len(dimensions2code)) for pic_id in pic_ids]
+        is_ref = [picinfo[pic_id][1] for pic_id in pic_ids]
+        return pic_ids, (blocks, valid, np.array(dimensions, dtype=np.int64), np.array(is_ref, dtype=bool))
+
+    ref_ids, ref = get_arrays(ref_pairs)
+    if other_pairs is None:
+        other_ids, other = ref_ids, None
+    else:
+        other_ids, other = get_arrays(other_pairs)
+    indexes1, indexes2, percentages = _compare_block_arrays(ref, other, threshold)
+    return [
+        (ref_ids[i], other_ids[j], percentage)
+        for i, j, percentage in zip(indexes1.tolist(), indexes2.tolist(), percentages.tolist())
+    ]
+
+def async_compare(ref_ids, other_ids, dbname, threshold, picinfo):
+    # The list of ids in ref_ids have to be compared to the list of ids in other_ids. other_ids
+    # can be None. In this case, ref_ids has to be compared with itself
+    # picinfo is a dictionary {pic_id: (dimensions, is_ref)}
+    cache = get_cache(dbname, readonly=True)
+    get_multiple = cache.get_multiple if npblock is None else cache.get_multiple_bytes
+    ref_pairs = list(get_multiple(ref_ids))
+    if other_ids is not None:
+        other_pairs = list(get_multiple(other_ids))
+    else:
+        other_pairs = None
+    cache.close()
+    if npblock is None:
+        return _compare_pairs(ref_pairs, other_pairs, threshold, picinfo)
+    else:
+        return _compare_arrays(ref_pairs, other_pairs, threshold, picinfo)
+
+def _share_blocks(pictures, cache_path, get_picinfo):
+    # Loads the blocks of all `pictures` from the cache, once, in a shared memory block array that
+    # compare processes can read without copying. Returns the SharedMemory, which has to be closed
+    # and unlinked when processes are done with it, and the arguments of _init_compare_process().
+    block_count = BLOCK_COUNT_PER_SIDE ** 2
+    shared_blocks = shared_memory.SharedMemory(create=True, size=max(len(pictures) * block_count * 3, 1))
+    try:
+        blocks = np.ndarray((len(pictures), block_count, 3), dtype=np.uint8, buffer=shared_blocks.buf)
+        valid = np.zeros(len(pictures), dtype=bool)
+        cache = get_cache(cache_path, readonly=True)
+        for start in range(0, len(pictures), DEFAULT_CHUNK_SIZE):
+            cache_ids = [p.cache_id for p in pictures[start:start+DEFAULT_CHUNK_SIZE]]
+            id2blocks = dict(cache.get_multiple_bytes(cache_ids))
+            chunk_blocks, chunk_valid = npblock.to_block_array(
+                [id2blocks.get(cache_id, b'') for cache_id in cache_ids], block_count
+            )
+            blocks[start:start+len(cache_ids)] = chunk_blocks
+            valid[start:start+len(cache_ids)] = chunk_valid
+        cache.close()
+        del blocks # the shared memory can't be closed while arrays use it
+    except BaseException:
+        shared_blocks.close()
+        shared_blocks.unlink()
+        raise
+    dimensions2code = {}
+    picinfos = [get_picinfo(p) for p in pictures]
+    dimensions = [dimensions2code.setdefault(dimensions, len(dimensions2code)) for dimensions, _ in picinfos]
+    initargs = (
+        shared_blocks.name,
+        np.array([p.cache_id for p in pictures], dtype=np.int64),
+        valid,
+        np.array(dimensions, dtype=np.int64),
+        np.array([is_ref for _, is_ref in picinfos], dtype=bool),
+    )
+    return shared_blocks, initargs
+
+# Set in compare processes by _init_compare_process()
+_compare_process_state = None
+
+def _attach_shared_memory(name):
+    # Only the parent process owns the shared memory and unlinks it. Compare processes mustn't
+    # register it with the resource tracker: it would otherwise be reported as leaked, and unlinked a
+    # second time, when a process has its own tracker. Python 3.13 lets us opt out of tracking. With
+    # older versions, we can't unregister the segment either because the tracker is usually the
+    # parent's, so registration is disabled while attaching (we're alone in the process in the pool
+    # initializer).
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def _init_compare_process(shared_blocks_name, cache_ids, valid, dimensions, is_ref):
+    global _compare_process_state
+    shared_blocks = _attach_shared_memory(shared_blocks_name)
+    blocks = np.ndarray((len(cache_ids), BLOCK_COUNT_PER_SIDE ** 2, 3), dtype=np.uint8, buffer=shared_blocks.buf)
+    _compare_process_state = (shared_blocks, cache_ids, (blocks, valid, dimensions, is_ref))
+
+def shared_compare(ref_range, other_range, threshold):
+    # Same as async_compare(), but in a process started with _init_compare_process(). Pictures are
+    # (start, stop) ranges of the shared arrays. When other_range is None, ref_range has to be
+    # compared with itself.
+    _, cache_ids, arrays = _compare_process_state
+    ref = [array[slice(*ref_range)] for array in arrays]
+    if other_range is None:
+        other = None
+        other_range = ref_range
+    else:
+        other = [array[slice(*other_range)] for array in arrays]
+    indexes1, indexes2, percentages = _compare_block_arrays(ref, other, threshold)
+    ref_ids = cache_ids[ref_range[0] + indexes1]
+    other_ids = cache_ids[other_range[0] + indexes2]
+    return list(zip(ref_ids.tolist(), other_ids.tolist(), percentages.tolist()))
+
 def getmatches(pictures, cache_path, threshold, match_scaled=False, j=job.nulljob):
     def get_picinfo(p):
         if match_scaled:
@@ -176,10 +334,18 @@ def getmatches(pictures, cache_path, threshold, match_scaled=False, j=job.nulljo
             pass
     cache.close()
     pictures = [p for p in pictures if hasattr(p, 'cache_id')]
-    pool = multiprocessing.Pool()
+    if npblock is not None and shared_memory is not None:
+        # Blocks are read from the cache once instead of once per chunk comparison. Chunks are then
+        # ranges of pictures in shared arrays.
+        shared_blocks, initargs = _share_blocks(pictures, cache_path, get_picinfo)
+        pool = multiprocessing.Pool(initializer=_init_compare_process, initargs=initargs)
+        chunks = get_chunks(range(len(pictures)))
+    else:
+        shared_blocks = None
+        pool = multiprocessing.Pool()
+        chunks = get_chunks(pictures)
     async_results = []
     matches = []
-    chunks = get_chunks(pictures)
     # We add a None element at the end of the chunk list because each chunk has to be compared
     # with itself. Thus, each chunk will show up as a ref_chunk having other_chunk set to None once.
     comparisons_to_do = list(combinations(chunks + [None], 2))
@@ -187,15 +353,21 @@ def getmatches(pictures, cache_path, threshold, match_scaled=False, j=job.nulljo
     j.start_job(len(comparisons_to_do))
     try:
         for ref_chunk, other_chunk in comparisons_to_do:
-            picinfo = {p.cache_id: get_picinfo(p) for p in ref_chunk}
-            ref_ids = [p.cache_id for p in ref_chunk]
-            if other_chunk is not None:
-                other_ids = [p.cache_id for p in other_chunk]
-                picinfo.update({p.cache_id: get_picinfo(p) for p in other_chunk})
+            if shared_blocks is not None:
+                ref_range = (ref_chunk.start, ref_chunk.stop)
+                other_range = None if other_chunk is None else (other_chunk.start, other_chunk.stop)
+                args = (ref_range, other_range, threshold)
+                async_results.append(pool.apply_async(shared_compare, args))
             else:
-                other_ids = None
-            args = (ref_ids, other_ids, cache_path, threshold, picinfo)
-            async_results.append(pool.apply_async(async_compare, args))
+                picinfo = {p.cache_id: get_picinfo(p) for p in ref_chunk}
+                ref_ids = [p.cache_id for p in ref_chunk]
+                if other_chunk is not None:
+                    other_ids = [p.cache_id for p in other_chunk]
+                    picinfo.update({p.cache_id: get_picinfo(p) for p in other_chunk})
+                else:
+                    other_ids = None
+                args = (ref_ids, other_ids, cache_path, threshold, picinfo)
+                async_results.append(pool.apply_async(async_compare, args))
             collect_results()
         collect_results(collect_all=True)
     except MemoryError:
@@ -206,7 +378,15 @@ def getmatches(pictures, cache_path, threshold, match_scaled=False, j=job.nulljo
         del comparisons_to_do, chunks, pictures # some wiggle room for the next statements
         logging.warning("Ran out of memory when scanning! We had %d matches.", len(matches))
         del matches[-len(matches)//3:] # some wiggle room to ensure we don't run out of memory again.
-    pool.close()
+    finally:
+        if shared_blocks is None:
+            pool.close()
+        else:
+            # Processes have to be done with the shared memory before we free it.
+            pool.terminate()
+            pool.join()
+            shared_blocks.close()
+            shared_blocks.unlink()
     result = []
     myiter = j.iter_with_progress(
         iterconsume(matches, reverse=False),
@@ -14,6 +14,8 @@ from hscommon.trans import tr
 from core.engine import Match
 
 def getmatches(files, match_scaled, j):
+    # Yields matches rather than returning a list: pictures with the same timestamp can be numerous
+    # and the scanner groups matches as they come.
     timestamp2pic = defaultdict(set)
     for picture in j.iter_with_progress(files, tr("Read EXIF of %d/%d pictures")):
         timestamp = picture.exif_timestamp
@@ -21,11 +23,9 @@ def getmatches(files, match_scaled, j):
             timestamp2pic[timestamp].add(picture)
     if '0000:00:00 00:00:00' in timestamp2pic: # very likely false matches
         del timestamp2pic['0000:00:00 00:00:00']
-    matches = []
     for pictures in timestamp2pic.values():
         for p1, p2 in combinations(pictures, 2):
             if (not match_scaled) and (p1.dimensions != p2.dimensions):
                 continue
-            matches.append(Match(p1, p2, 100))
-    return matches
+            yield Match(p1, p2, 100)
 
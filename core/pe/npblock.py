@@ -0,0 +1,119 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Block functions working on whole pictures at once with NumPy.
+
+The functions in :mod:`core.pe.block` go through pictures pixel by pixel, asking them for every
+pixel through the Python C API. Here, pictures are decoded pixel buffers, read as arrays without
+any copy, and all blocks are computed in a few vectorized operations.
+
+This requires NumPy.
+"""
+
+import numpy as np
+
+def getblocks_from_array(pixels, block_count_per_side):
+    """Returns a list of blocks (3 sized tuples) from an RGB picture.
+
+    pixels: ``uint8`` array of shape ``(height, width, 3)`` (or more channels, only the first 3
+    are used). Rows and pixels can be strided, so it can be a view on a padded buffer.
+    block_count_per_side: same as in :func:`core.pe.block.getblocks2`, which gives the same blocks.
+
+    Blocks are laid out like in ``getblocks2``: blocks of ``height // block_count_per_side`` rows
+    and ``width // block_count_per_side`` columns, from the top left corner. The last rows and
+    columns are ignored when the size isn't a multiple of the block count. When the picture is
+    smaller than the block count, blocks are 1 pixel and the last ones repeat the last pixel.
+    """
+    height, width = pixels.shape[:2]
+    if not (width and height):
+        return []
+    block_width = max(width // block_count_per_side, 1)
+    block_height = max(height // block_count_per_side, 1)
+    positions = np.arange(block_count_per_side)
+    tops = np.minimum(positions * block_height, height - block_height)
+    lefts = np.minimum(positions * block_width, width - block_width)
+    # add.reduceat() sums the rows from each index to the next one (a single row when the next
+    # index isn't greater, which only happens with 1 pixel blocks), the last index going to the end.
+    pixels = pixels[:tops[-1] + block_height, :lefts[-1] + block_width, :3]
+    # 32-bit sums don't overflow for blocks of less than 16 million pixels.
+    sums = np.add.reduceat(pixels, tops, axis=0, dtype=np.uint32)
+    sums = np.add.reduceat(sums, lefts, axis=1)
+    blocks = sums // np.uint32(block_width * block_height)
+    return list(map(tuple, blocks.reshape(-1, 3).tolist()))
+
+def getblocks_from_buffer(buffer, width, height, bytes_per_line, block_count_per_side):
+    """Returns a list of blocks from a buffer of ``RGB888`` pixels.
+
+    Lines of pixels are ``bytes_per_line`` bytes apart, which can be more than ``width * 3``
+    because of alignment (Qt aligns lines on 32 bits).
+    """
+    if not (width and height):
+        return []
+    lines = np.frombuffer(buffer, dtype=np.uint8, count=bytes_per_line * height)
+    pixels = lines.reshape(height, bytes_per_line)[:, :width * 3].reshape(height, width, 3)
+    return getblocks_from_array(pixels, block_count_per_side)
+
+def getblocks_from_pil(image, block_count_per_side):
+    """Returns a list of blocks from a PIL image, such as what :func:`core.pe.block.getblocks2`
+    returns.
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return getblocks_from_array(np.asarray(image), block_count_per_side)
+
+def to_block_array(blobs, block_count):
+    """Returns ``blobs`` of ``block_count`` blocks as an array of shape
+    ``(len(blobs), block_count, 3)``, and an array telling which blobs were valid.
+
+    Blobs are blocks as bytes, 3 per block, such as what
+    :meth:`~core.pe.cache_sqlite.SqliteCache.get_multiple_bytes` returns. They're read as they are,
+    without parsing. Blobs without exactly ``block_count`` blocks, such as the empty blocks of
+    pictures that couldn't be read, are invalid and left black.
+    """
+    blob_size = block_count * 3
+    result = np.zeros((len(blobs), block_count, 3), dtype=np.uint8)
+    valid = np.array([len(blob) == blob_size for blob in blobs], dtype=bool)
+    if valid.any():
+        data = b''.join(blob for blob in blobs if len(blob) == blob_size)
+        result[valid] = np.frombuffer(data, dtype=np.uint8).reshape(-1, block_count, 3)
+    return result, valid
+
+def avgdiffs(first, second, indexes1, indexes2, limit=768, min_iterations=1):
+    """Returns the :func:`core.pe.block.avgdiff` of each pair of ``first[indexes1[i]]`` and
+    ``second[indexes2[i]]``.
+
+    ``first`` and ``second`` are block arrays of shape ``(picture_count, block_count, 3)``. The
+    result is the same as ``avgdiff()``: diffs are summed block after block and if, after at least
+    ``min_iterations`` blocks, the sum goes over ``limit`` times the number of blocks summed so far,
+    the result is ``limit + 1``.
+
+    Like ``avgdiff()``, which stops as soon as the limit is reached, we don't go through all blocks
+    of most pairs: blocks are compared in growing slices and pairs over the limit are dropped after
+    each slice.
+    """
+    block_count = first.shape[1]
+    result = np.full(len(indexes1), limit + 1, dtype=np.int32)
+    sums = np.zeros(len(indexes1), dtype=np.int32)
+    remaining = np.arange(len(indexes1))
+    start = 0
+    end = min(max(min_iterations, 4), block_count)
+    while start < block_count and len(remaining):
+        blocks1 = first[indexes1[remaining], start:end]
+        blocks2 = second[indexes2[remaining], start:end]
+        diffs = np.abs(blocks1.astype(np.int16) - blocks2).sum(axis=2, dtype=np.int32)
+        partial_sums = diffs.cumsum(axis=1) + sums[remaining, None]
+        sums[remaining] = partial_sums[:, -1]
+        # Only sums after at least min_iterations blocks are checked.
+        checked = max(min_iterations - start, 1) - 1
+        limits = limit * np.arange(start + 1, end + 1)
+        over_limit = (partial_sums[:, checked:] > limits[checked:]).any(axis=1)
+        remaining = remaining[~over_limit]
+        start, end = end, min(end * 2, block_count)
+    totals = sums[remaining]
+    diffs = totals // block_count
+    diffs[(diffs == 0) & (totals > 0)] = 1
+    result[remaining] = diffs
+    return result
@@ -63,6 +63,10 @@ class Photo(fs.File):
     def can_handle(cls, path):
         return fs.File.can_handle(path) and get_file_ext(path.name) in cls.HANDLED_EXTS
 
+    @classmethod
+    def can_handle_entry(cls, entry, path):
+        return fs.File.can_handle_entry(entry, path) and get_file_ext(path.name) in cls.HANDLED_EXTS
+
     def get_display_info(self, group, delta):
         size = self.size
         mtime = self.mtime
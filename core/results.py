@@ -50,6 +50,8 @@ class Results(Markable):
         self.app = app
         self.problems = [] # (dupe, error_msg)
         self.is_modified = False
+        # Name of the algorithm with which digests of the grouped files were computed, if any.
+        self.hash_algorithm = None
 
     def _did_mark(self, dupe):
         self.__marked_size += dupe.size
@@ -223,6 +225,7 @@ class Results(Markable):
 
         self.apply_filter(None)
         root = ET.parse(infile).getroot()
+        self.hash_algorithm = root.get('hash_algorithm')
         group_elems = list(root.getiterator('group'))
         groups = []
         marked = set()
@@ -252,7 +255,9 @@ class Results(Markable):
                 except (IndexError, KeyError, ValueError):
                     # Covers missing attr, non-int values and indexes out of bounds
                     pass
-            if (not group.matches) and (len(dupes) >= 2):
+            if group_elem.get('exact') == 'y':
+                group.add_exact_dupes(dupes)
+            elif (not group.matches) and (len(dupes) >= 2):
                 do_match(dupes[0], dupes[1:], group)
             group.prioritize(lambda x: dupes.index(x))
             if len(group):
@@ -340,8 +345,12 @@ class Results(Markable):
         """
         self.apply_filter(None)
         root = ET.Element('results')
+        if self.hash_algorithm:
+            root.set('hash_algorithm', self.hash_algorithm)
         for g in self.groups:
             group_elem = ET.SubElement(root, 'group')
+            if g.exact:
+                group_elem.set('exact', 'y')
             dupe2index = {}
             for index, d in enumerate(g):
                 dupe2index[d] = index
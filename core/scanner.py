@@ -7,7 +7,8 @@
 import logging
 import re
 import os.path as op
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from itertools import combinations
 
 from hscommon.jobprogress import job
 from hscommon.util import dedupe, rem_file_ext, get_file_ext
@@ -35,6 +36,11 @@ ScanOption = namedtuple('ScanOption', 'scan_type label')
 
 SCANNABLE_TAGS = ['track', 'artist', 'album', 'title', 'genre', 'year']
 
+# Scan types matching the words of files with engine.getmatches()
+WORD_SCAN_TYPES = {ScanType.Filename, ScanType.Fields, ScanType.FieldsNoOrder, ScanType.Tag}
+# Scan types whose matches are all 100% and transitive. See engine.get_transitive_groups().
+TRANSITIVE_SCAN_TYPES = {ScanType.Contents, ScanType.Folders, ScanType.ExifTimestamp}
+
 RE_DIGIT_ENDING = re.compile(r'\d+|\(\d+\)|\[\d+\]|{\d+}')
 
 def is_same_with_digit(name, refname):
@@ -71,37 +77,157 @@ class Scanner:
     def __init__(self):
         self.discarded_file_count = 0
 
-    def _getmatches(self, files, j):
+    def _get_inventory_signature(self):
+        # Options having an influence on the words of files and on their matches.
+        return repr([
+            type(self).__name__, self.scan_type, self.min_match_percentage, self.match_similar_words,
+            self.word_weighting, sorted(self.scanned_tags), self.size_threshold, self.lsh_threshold,
+        ])
+
+    def _getmatches_incremental(self, files, j):
+        # Word-based scans with an inventory of the previous scan. Files that didn't change since
+        # then get their words back and keep their matches with each other. Only pairs involving
+        # at least one new or changed file are compared, unless common or similar words changed
+        # since the last scan, in which case we have to match all files again.
+        signature = self._get_inventory_signature()
+        path2info, previous_matches = self.inventory.load(signature)
+        files = self._filter_by_size(files, j)
+        path2file = {}
+        changed = set()
+        for f in files:
+            path_str = str(f.path)
+            path2file[path_str] = f
+            info = path2info.get(path_str)
+            if info is not None and info.words is not None and (info.size, info.mtime) == (f.size, f.mtime):
+                f.words = info.words
+            else:
+                changed.add(f)
+        logging.info("%d new or changed files since the last scan", len(changed))
+        j = j.start_subjob([2, 8])
+        self._read_words([f for f in files if f in changed], j)
+        if self.lsh_threshold is None:
+            word_state = engine.get_word_state(files, self.match_similar_words)
+        else:
+            word_state = None # candidates only depend on the words of each file
+        if word_state != self.inventory.load_word_state(signature):
+            logging.info("Common or similar words changed since the last scan, matching all files again")
+            previous_matches = []
+            changed = None
+        matches = []
+        for first, second, percentage in previous_matches:
+            first, second = path2file.get(first), path2file.get(second)
+            # Matches with deleted or changed files are computed again (or not).
+            if first is None or second is None or first in changed or second in changed:
+                continue
+            matches.append(engine.Match(first, second, percentage))
+        matches += self._match_words(files, j, only_with=changed)
+        self.inventory.save(signature, files, matches, word_state)
+        return matches
+
+    def _filter_by_size(self, files, j):
         if self.size_threshold or self.scan_type in {ScanType.Contents, ScanType.Folders}:
             j = j.start_subjob([2, 8])
             for f in j.iter_with_progress(files, tr("Read size of %d/%d files")):
                 f.size # pre-read, makes a smoother progress if read here (especially for bundles)
             if self.size_threshold:
                 files = [f for f in files if f.size >= self.size_threshold]
+        return files
+
+    def _read_words(self, files, j):
+        scan_type = ScanType.Fields if self.scan_type == ScanType.FieldsNoOrder else self.scan_type
+        func = {
+            ScanType.Filename: lambda f: engine.getwords(rem_file_ext(f.name)),
+            ScanType.Fields: lambda f: engine.getfields(rem_file_ext(f.name)),
+            ScanType.Tag: lambda f: [
+                engine.getwords(str(getattr(f, attrname)))
+                for attrname in SCANNABLE_TAGS
+                if attrname in self.scanned_tags
+            ],
+        }[scan_type]
+        for f in j.iter_with_progress(files, tr("Read metadata of %d/%d files")):
+            logging.debug("Reading metadata of %s", f.path)
+            f.words = func(f)
+
+    def _match_words(self, files, j, only_with=None):
+        kw = {}
+        kw['match_similar_words'] = self.match_similar_words
+        kw['weight_words'] = self.word_weighting
+        kw['min_match_percentage'] = self.min_match_percentage
+        kw['process_count'] = self.match_process_count
+        kw['lsh_threshold'] = self.lsh_threshold
+        if self.scan_type == ScanType.FieldsNoOrder:
+            self.scan_type = ScanType.Fields
+            kw['no_field_order'] = True
+        return engine.getmatches(files, only_with=only_with, j=j, **kw)
+
+    def _getmatches(self, files, j):
+        files = self._filter_by_size(files, j)
         if self.scan_type in {ScanType.Contents, ScanType.Folders}:
-            return engine.getmatches_by_contents(files, j=j)
+            if self.scan_type == ScanType.Contents:
+                digest_stages = self.digest_stages
+                bytewise_max_files = self.bytewise_max_files
+            else:
+                # Folders can't be compared byte by byte, only their digests can.
+                digest_stages = engine.FOLDER_DIGEST_STAGES
+                bytewise_max_files = 0
+            return engine.iter_matches_by_contents(
+                files, hash_thread_count=self.hash_thread_count, digest_stages=digest_stages,
+                bytewise_max_files=bytewise_max_files, j=j
+            )
         else:
             j = j.start_subjob([2, 8])
-            kw = {}
-            kw['match_similar_words'] = self.match_similar_words
-            kw['weight_words'] = self.word_weighting
-            kw['min_match_percentage'] = self.min_match_percentage
-            if self.scan_type == ScanType.FieldsNoOrder:
-                self.scan_type = ScanType.Fields
-                kw['no_field_order'] = True
-            func = {
-                ScanType.Filename: lambda f: engine.getwords(rem_file_ext(f.name)),
-                ScanType.Fields: lambda f: engine.getfields(rem_file_ext(f.name)),
-                ScanType.Tag: lambda f: [
-                    engine.getwords(str(getattr(f, attrname)))
-                    for attrname in SCANNABLE_TAGS
-                    if attrname in self.scanned_tags
-                ],
-            }[self.scan_type]
-            for f in j.iter_with_progress(files, tr("Read metadata of %d/%d files")):
-                logging.debug("Reading metadata of %s", f.path)
-                f.words = func(f)
-            return engine.getmatches(files, j=j, **kw)
+            self._read_words(files, j)
+            return self._match_words(files, j)
+
+    def _get_groups_by_digest(self, files, ignore_list, j):
+        # Contents scans without match pairs. Buckets of files with the same contents directly
+        # become groups, so we apply our "false matches" filters on files rather than on matches.
+        j = j.start_subjob([2, 8])
+        for f in j.iter_with_progress(files, tr("Read size of %d/%d files")):
+            f.size # pre-read, makes a smoother progress if read here (especially for bundles)
+        if self.size_threshold:
+            files = [f for f in files if f.size >= self.size_threshold]
+        buckets = engine.getbuckets_by_contents(
+            files, hash_thread_count=self.hash_thread_count, digest_stages=self.digest_stages,
+            bytewise_max_files=self.bytewise_max_files, j=j
+        )
+        logging.info('Found %d buckets' % len(buckets))
+        j.set_progress(100, tr("Almost done! Fiddling with results..."))
+        if ignore_list:
+            ignored_paths = {path for pair in ignore_list for path in pair}
+        exact_buckets = []
+        matches = []
+        for bucket in buckets:
+            bucket = [f for f in bucket if f.path.exists()]
+            if self.mix_file_kind:
+                subbuckets = [bucket]
+            else:
+                ext2files = defaultdict(list)
+                for f in bucket:
+                    ext2files[get_file_ext(f.name)].append(f)
+                subbuckets = ext2files.values()
+            for subbucket in subbuckets:
+                # A bucket can't hold more than one ref file because we never match ref files
+                # together.
+                refs = [f for f in subbucket if f.is_ref]
+                subbucket = refs[:1] + [f for f in subbucket if not f.is_ref]
+                if ignore_list and sum(str(f.path) in ignored_paths for f in subbucket) > 1:
+                    # Some of these files were ignored together. Only match pairs can express that.
+                    matches += [
+                        engine.Match(first, second, 100)
+                        for first, second in combinations(subbucket, 2)
+                        if not ignore_list.AreIgnored(str(first.path), str(second.path))
+                    ]
+                else:
+                    exact_buckets.append(subbucket)
+        return engine.get_exact_groups(exact_buckets) + engine.get_groups(matches)
+
+    def _finalize_groups(self, groups):
+        groups = [g for g in groups if any(not f.is_ref for f in g)]
+        logging.info('Created %d groups' % len(groups))
+        for g in groups:
+            g.prioritize(self._key_func, self._tie_breaker)
+        return groups
 
     @staticmethod
     def _key_func(dupe):
@@ -129,43 +255,95 @@ class Scanner:
         """
         raise NotImplementedError()
 
+    @staticmethod
+    def _count_matches(matches, j):
+        # Passes matches through and logs how many there were once the matcher is done.
+        match_count = 0
+        for match in matches:
+            match_count += 1
+            yield match
+        logging.info('Found %d matches' % match_count)
+        j.set_progress(100, tr("Almost done! Fiddling with results..."))
+
+    @staticmethod
+    def _get_matched_subfolder_paths(matches):
+        # Returns the paths of matched folders whose parent is also matched.
+        if not matches:
+            return set()
+        allpath = {m.first.path for m in matches}
+        allpath |= {m.second.path for m in matches}
+        sortedpaths = sorted(allpath)
+        toremove = set()
+        last_parent_path = sortedpaths[0]
+        for p in sortedpaths[1:]:
+            if p in last_parent_path:
+                toremove.add(p)
+            else:
+                last_parent_path = p
+        return toremove
+
+    def _get_match_filter(self, subfolder_paths, ignore_list):
+        # Returns a function telling whether two matching files can be grouped. We don't want matches
+        # between two subfolders of matched folders, we don't want mixed file kinds if the option
+        # isn't enabled, we want matches for which both files exist and, lastly, we don't want
+        # matches with both files as ref or ignored together. All checks are made in a single pass
+        # instead of filtering the whole match list once for each of them.
+        path2exists = {}
+
+        def exists(path):
+            result = path2exists.get(path)
+            if result is None:
+                result = path2exists[path] = path.exists()
+            return result
+
+        def is_match(first, second):
+            if first.is_ref and second.is_ref:
+                return False
+            if first.path in subfolder_paths and second.path in subfolder_paths:
+                return False
+            if not self.mix_file_kind and get_file_ext(first.name) != get_file_ext(second.name):
+                return False
+            if not (exists(first.path) and exists(second.path)):
+                return False
+            return not (ignore_list and ignore_list.AreIgnored(str(first.path), str(second.path)))
+
+        return is_match
+
     def get_dupe_groups(self, files, ignore_list=None, j=job.nulljob):
         for f in (f for f in files if not hasattr(f, 'is_ref')):
             f.is_ref = False
         files = remove_dupe_paths(files)
+        if self.scan_type == ScanType.Contents and self.group_contents_by_digest:
+            logging.info("Getting buckets. Scan type: %d", self.scan_type)
+            groups = self._get_groups_by_digest(files, ignore_list, j)
+            self.discarded_file_count = 0
+            return self._finalize_groups(groups)
         logging.info("Getting matches. Scan type: %d", self.scan_type)
-        matches = self._getmatches(files, j)
-        logging.info('Found %d matches' % len(matches))
-        j.set_progress(100, tr("Almost done! Fiddling with results..."))
+        if self.inventory is not None and self.scan_type in WORD_SCAN_TYPES:
+            matches = self._getmatches_incremental(files, j)
+        else:
+            matches = self._getmatches(files, j)
+        # Matchers can return a generator, in which case matches are filtered and grouped as they're
+        # found and never all kept in memory (when the scan type allows it, see below).
+        matches = self._count_matches(matches, j)
         # In removing what we call here "false matches", we first want to remove, if we scan by
         # folders, we want to remove folder matches for which the parent is also in a match (they're
-        # "duplicated duplicates if you will). Then, we also don't want mixed file kinds if the
-        # option isn't enabled, we want matches for which both files exist and, lastly, we don't
-        # want matches with both files as ref.
-        if self.scan_type == ScanType.Folders and matches:
-            allpath = {m.first.path for m in matches}
-            allpath |= {m.second.path for m in matches}
-            sortedpaths = sorted(allpath)
-            toremove = set()
-            last_parent_path = sortedpaths[0]
-            for p in sortedpaths[1:]:
-                if p in last_parent_path:
-                    toremove.add(p)
-                else:
-                    last_parent_path = p
-            matches = [m for m in matches if m.first.path not in toremove or m.second.path not in toremove]
-        if not self.mix_file_kind:
-            matches = [m for m in matches if get_file_ext(m.first.name) == get_file_ext(m.second.name)]
-        matches = [m for m in matches if m.first.path.exists() and m.second.path.exists()]
-        matches = [m for m in matches if not (m.first.is_ref and m.second.is_ref)]
-        if ignore_list:
-            matches = [
-                m for m in matches
-                if not ignore_list.AreIgnored(str(m.first.path), str(m.second.path))
-            ]
+        # "duplicated duplicates if you will). Finding them needs all matches, which we keep.
+        if self.scan_type == ScanType.Folders:
+            matches = list(matches)
+            subfolder_paths = self._get_matched_subfolder_paths(matches)
+        else:
+            subfolder_paths = set()
+        is_match = self._get_match_filter(subfolder_paths, ignore_list)
+        matches = (m for m in matches if is_match(m.first, m.second))
         logging.info('Grouping matches')
-        groups = engine.get_groups(matches)
-        if self.scan_type in {ScanType.Filename, ScanType.Fields, ScanType.FieldsNoOrder, ScanType.Tag}:
+        if self.scan_type in TRANSITIVE_SCAN_TYPES:
+            groups = engine.get_transitive_groups(matches, is_match)
+        else:
+            # Fuzzy matches are grouped from the best to the worst, so they all have to be there.
+            matches = list(matches)
+            groups = engine.get_groups(matches)
+        if self.scan_type in WORD_SCAN_TYPES:
             matched_files = dedupe([m.first for m in matches] + [m.second for m in matches])
             self.discarded_file_count = len(matched_files) - sum(len(g) for g in groups)
         else:
@@ -180,12 +358,20 @@ class Scanner:
             # effectively disabling the "discarded" feature in PE, but it's better than falsely
             # reporting discarded matches.
             self.discarded_file_count = 0
-        groups = [g for g in groups if any(not f.is_ref for f in g)]
-        logging.info('Created %d groups' % len(groups))
-        for g in groups:
-            g.prioritize(self._key_func, self._tie_breaker)
-        return groups
+        return self._finalize_groups(groups)
 
+    # Files in buckets this small are compared byte by byte rather than digested. Digests are
+    # kept in the hash cache, comparisons aren't, so this is disabled by default.
+    bytewise_max_files = 0
+    digest_stages = engine.DIGEST_STAGES
+    # Contents scans group buckets of identical files directly rather than through match pairs.
+    group_contents_by_digest = True
+    hash_thread_count = engine.HASH_THREAD_COUNT
+    # core.inventory.Inventory of the previous scan. When set, word-based scans are incremental.
+    inventory = None
+    # When not None, candidates of word-based scans are approximated. See engine.getmatches().
+    lsh_threshold = None
+    match_process_count = engine.MATCH_PROCESS_COUNT
     match_similar_words = False
     min_match_percentage = 80
     mix_file_kind = True
@@ -110,6 +110,27 @@ class TestCaseDupeGuru:
         app.start_scanning()
         eq_(len(app.results.groups), 0)
 
+    def test_hash_thread_count(self, tmpdir, monkeypatch):
+        # The hash_thread_count option is the number of threads reading digests during the scan.
+        thread_counts = set()
+        read_digests = engine.read_digests
+
+        def mock_read_digests(files, attrname, thread_count, j):
+            thread_counts.add(thread_count)
+            return read_digests(files, attrname, thread_count, j)
+
+        monkeypatch.setattr(engine, 'read_digests', mock_read_digests)
+        tmppath = Path(str(tmpdir))
+        tmppath['foo'].open('w').write('foo')
+        tmppath['bar'].open('w').write('foo')
+        app = TestApp().app
+        app.directories.add_path(tmppath)
+        app.options['scan_type'] = ScanType.Contents
+        app.options['hash_thread_count'] = 1
+        app.start_scanning()
+        eq_(thread_counts, {1})
+        eq_(len(app.results.groups), 1)
+
     def test_rename_when_nothing_is_selected(self):
         # Issue #140
         # It's possible that rename operation has its selected row swept off from under it, thus
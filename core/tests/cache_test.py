@@ -5,13 +5,14 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 import logging
+import sqlite3 as sqlite
 
 from pytest import raises, skip
 from hscommon.testutil import eq_
 
 try:
-    from ..pe.cache import colors_to_string, string_to_colors
-    from ..pe.cache_sqlite import SqliteCache
+    from ..pe.cache import colors_to_string, string_to_colors, colors_to_bytes, bytes_to_colors
+    from ..pe.cache_sqlite import SqliteCache, SCHEMA_VERSION
     from ..pe.cache_shelve import ShelveCache
 except ImportError:
     skip("Can't import the cache module, probably hasn't been compiled.")
@@ -46,6 +47,16 @@ class TestCasestring_to_colors:
         eq_([], string_to_colors('102'))
 
 
+class TestCasebytes_to_colors:
+    def test_round_trip(self):
+        colors = [(10, 20, 30), (40, 50, 60)]
+        eq_(b'\x0a\x14\x1e\x28\x32\x3c', colors_to_bytes(colors))
+        eq_(colors, bytes_to_colors(colors_to_bytes(colors)))
+
+    def test_incomplete_color(self):
+        eq_([(1, 2, 3)], bytes_to_colors(b'\x01\x02\x03\x04'))
+
+
 class BaseTestCaseCache:
     def get_cache(self, dbname=None):
         raise NotImplementedError()
@@ -131,6 +142,58 @@ class TestCaseSqliteCache(BaseTestCaseCache):
         c = self.get_cache(dbname)
         eq_(c['foo'], [(1, 2, 3)])
 
+    def test_get_multiple_bytes(self):
+        c = self.get_cache()
+        c['foo'] = [(1, 2, 3), (4, 5, 6)]
+        foo_id = c.get_id('foo')
+        eq_(list(c.get_multiple_bytes([foo_id])), [(foo_id, b'\x01\x02\x03\x04\x05\x06')])
+
+    def test_migrate_hex_strings(self, tmpdir):
+        # Caches made before the schema was versioned stored blocks as hex strings.
+        dbname = str(tmpdir.join('foo.db'))
+        con = sqlite.connect(dbname)
+        con.execute("create table pictures(path TEXT, mtime INTEGER, blocks TEXT)")
+        con.execute("create index idx_path on pictures (path)")
+        con.execute("insert into pictures(path, mtime, blocks) values('foo', 42, '0102030a141e')")
+        con.execute("insert into pictures(path, mtime, blocks) values('bar', 42, 'not hex')")
+        con.commit()
+        con.close()
+        c = self.get_cache(dbname)
+        eq_(c['foo'], [(1, 2, 3), (10, 20, 30)])
+        assert 'bar' not in c # read again
+        eq_(list(c.get_multiple_bytes([c.get_id('foo')]))[0][1], b'\x01\x02\x03\x0a\x14\x1e')
+        eq_(c.con.execute("pragma user_version").fetchone()[0], SCHEMA_VERSION)
+        c.close()
+        c = self.get_cache(dbname)
+        eq_(c['foo'], [(1, 2, 3), (10, 20, 30)])
+
+    def test_failed_migration_is_rolled_back(self, tmpdir):
+        dbname = str(tmpdir.join('foo.db'))
+        con = sqlite.connect(dbname)
+        con.execute("create table pictures(path TEXT, mtime INTEGER, blocks TEXT)")
+        con.execute("insert into pictures(path, mtime, blocks) values('foo', 42, '0102030a141e')")
+        # Makes the migration fail
+        con.execute("create table pictures_blobs(foo TEXT)")
+        con.commit()
+        con.close()
+        c = self.get_cache(dbname)
+        assert not c.con.in_transaction
+        # The cache is recreated, and what we put in it is saved.
+        eq_(len(c), 0)
+        c['foo'] = [(1, 2, 3)]
+        c.close()
+        c = self.get_cache(dbname)
+        eq_(c['foo'], [(1, 2, 3)])
+
+    def test_newer_schema_is_recreated(self, tmpdir):
+        dbname = str(tmpdir.join('foo.db'))
+        c = self.get_cache(dbname)
+        c['foo'] = [(1, 2, 3)]
+        c.con.execute("pragma user_version = %d" % (SCHEMA_VERSION + 1))
+        c.close()
+        c = self.get_cache(dbname)
+        eq_(len(c), 0)
+
 
 class TestCaseShelveCache(BaseTestCaseCache):
     def get_cache(self, dbname=None):
@@ -9,12 +9,13 @@ import time
 import tempfile
 import shutil
 
-from pytest import raises
+from pytest import raises, skip
 from hscommon.path import Path
 from hscommon.testutil import eq_
 
 from ..fs import File
 from ..directories import Directories, DirectoryState, AlreadyThereError, InvalidPathError
+from ..watcher import Journal
 
 def create_fake_fs(rootpath):
     # We have it as a separate function because other units are using it.
@@ -149,6 +150,35 @@ def test_states_overwritten_when_larger_directory_eat_smaller_ones():
     eq_(d.get_state(p['dir1']), DirectoryState.Reference)
     eq_(d.get_state(testpath), DirectoryState.Reference)
 
+def test_get_state_longest_prefix():
+    d = Directories()
+    p = testpath['onefile']
+    d.set_state(p, DirectoryState.Excluded)
+    d.set_state(p['a'], DirectoryState.Reference)
+    d.set_state(p['a']['b']['c'], DirectoryState.Excluded)
+    eq_(d.get_state(p['foo']), DirectoryState.Excluded)
+    eq_(d.get_state(p['a']['b']), DirectoryState.Reference)
+    eq_(d.get_state(p['a']['b']['c']['d']), DirectoryState.Excluded)
+    # States under a folder are dropped when its own state is set.
+    d.set_state(p, DirectoryState.Normal)
+    eq_(d.get_state(p['a']['b']['c']['d']), DirectoryState.Normal)
+
+def test_get_files_in_non_excluded_folder_of_excluded_folder(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    p['dir1']['sub'].mkdir()
+    p['dir1']['sub']['file.test'].open('w').write('1')
+    d = Directories()
+    d.add_path(p)
+    d.set_state(p['dir1'], DirectoryState.Excluded)
+    d.set_state(p['dir1']['sub'], DirectoryState.Reference)
+    files = list(d.get_files(thread_count=1))
+    eq_(len(files), 6)
+    eq_([f.path for f in files if f.is_ref], [p['dir1']['sub']['file.test']])
+    d.set_state(p['dir1'], DirectoryState.Excluded)
+    eq_(len(list(d.get_files(thread_count=1))), 6)
+    d.set_state(p['dir1']['sub'], DirectoryState.Excluded)
+    eq_(len(list(d.get_files(thread_count=1))), 5)
+
 def test_get_files():
     d = Directories()
     p = testpath['fs']
@@ -163,6 +193,31 @@ def test_get_files():
         else:
             assert not f.is_ref
 
+def test_get_files_same_result_with_thread_pool(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p['dir1'])
+    d.add_path(p['dir2'])
+    d.add_path(p['dir3'])
+    d.set_state(p['dir1'], DirectoryState.Reference)
+    d.set_state(p['dir2'], DirectoryState.Excluded)
+    for thread_count in (1, 4):
+        files = list(d.get_files(thread_count=thread_count))
+        eq_(sorted((str(f.path), f.is_ref) for f in files), [
+            (str(p['dir1']['file1.test']), True),
+            (str(p['dir3']['file3.test']), False),
+        ])
+
+def test_get_files_calls_on_folder_for_walked_folders(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    d.set_state(p['dir2'], DirectoryState.Excluded)
+    for thread_count in (1, 4):
+        folders = []
+        list(d.get_files(thread_count=thread_count, on_folder=folders.append))
+        eq_(sorted(folders), [p, p['dir1'], p['dir3']])
+
 def test_get_files_with_folders():
     # When fileclasses handle folders, return them and stop recursing!
     class FakeFile(File):
@@ -177,6 +232,79 @@ def test_get_files_with_folders():
     # We have the 3 root files and the 3 root dirs
     eq_(6, len(files))
 
+def test_get_files_prepopulates_stats(tmpdir):
+    # Size and mtime come from the directory listing, we don't have to stat files again.
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    files = list(d.get_files())
+    p.rmtree()
+    eq_(sorted(f.size for f in files), [1, 1, 2, 2, 3, 3])
+    assert all(f.mtime > 0 for f in files)
+
+def test_get_files_ignores_symlinks(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    try:
+        os.symlink(str(p['file1.test']), str(p['link.test']))
+        os.symlink(str(p['dir1']), str(p['linkdir']))
+    except (OSError, NotImplementedError):
+        skip("Can't create symlinks here")
+    d = Directories()
+    d.add_path(p)
+    eq_(len(list(d.get_files())), 6)
+
+def test_update_files(tmpdir):
+    # Only folders the journal reports as changed are listed again.
+    p = create_fake_fs(Path(str(tmpdir)))
+    p['dir3']['sub'].mkdir()
+    p['dir3']['sub']['file5.test'].open('w').write('12345')
+    d = Directories()
+    d.add_path(p)
+    files = list(d.get_files())
+    p['dir1']['new.test'].open('w').write('foo')
+    p['dir2'].rmtree()
+    p['dir4'].mkdir()
+    p['dir4']['sub'].mkdir()
+    p['dir4']['sub']['file4.test'].open('w').write('1234')
+    journal = Journal()
+    journal.dirty.update([p['dir1'], p])
+    journal.removed.add(p['dir2'])
+    journal.added.update([p['dir4'], p['dir4']['sub']])
+    # Folders moved away and back are removed and added, their files aren't there twice.
+    journal.added.add(p['dir3'])
+    files = d.update_files(files, journal)
+    eq_(sorted(str(f.path[p:]) for f in files), [
+        'dir1/file1.test', 'dir1/new.test', 'dir3/file3.test', 'dir3/sub/file5.test',
+        'dir4/sub/file4.test', 'file1.test', 'file2.test', 'file3.test',
+    ])
+
+def test_update_files_keeps_unchanged_files(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    files = list(d.get_files())
+    # A change that isn't journaled isn't seen.
+    p['dir1']['new.test'].open('w').write('foo')
+    journal = Journal()
+    journal.dirty.add(p['dir3'])
+    updated = d.update_files(files, journal)
+    eq_(len(updated), 6)
+    unchanged = [f for f in files if f.path.parent() != p['dir3']]
+    assert all(any(f is g for g in updated) for f in unchanged)
+
+def test_update_files_reads_info_of_kept_files_again(tmpdir):
+    # A file can change without the journal knowing, when it's written from another machine.
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    files = list(d.get_files())
+    [f] = [f for f in files if f.path == p['file1.test']]
+    old_md5 = f.md5
+    p['file1.test'].open('w').write('changed')
+    [f] = [f for f in d.update_files(files, Journal()) if f.path == p['file1.test']]
+    eq_(f.size, len('changed'))
+    assert f.md5 != old_md5
+
 def test_get_folders():
     d = Directories()
     p = testpath['fs']
@@ -216,6 +344,7 @@ def test_save_and_load(tmpdir):
     eq_(2, len(d2))
     eq_(DirectoryState.Reference, d2.get_state(p1))
     eq_(DirectoryState.Excluded, d2.get_state(p1['dir1']))
+    eq_(DirectoryState.Excluded, d2.get_state(p1['dir1']['foo']))
 
 def test_invalid_path():
     d = Directories()
@@ -5,17 +5,24 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 import sys
+import itertools
+import random
+from array import array
 
 from hscommon.jobprogress import job
+from hscommon.path import Path
 from hscommon.util import first
 from hscommon.testutil import eq_, log_calls
+from pytest import raises, skip
 
 from .base import NamedObject
-from .. import engine
+from .. import engine, fs
 from ..engine import (
     get_match, getwords, Group, getfields, unpack_fields, compare_fields, compare, WEIGHT_WORDS,
     MATCH_SIMILAR_WORDS, NO_FIELD_ORDER, build_word_dict, get_groups, getmatches, Match,
-    getmatches_by_contents, merge_similar_words, reduce_common_words
+    getmatches_by_contents, getbuckets_by_contents, get_exact_groups, compare_contents,
+    merge_similar_words, reduce_common_words, build_word_index, WordBags, get_shards,
+    get_word_deletions, get_transitive_groups, iter_matches_by_contents, get_word_state
 )
 
 no = NamedObject
@@ -69,6 +76,18 @@ class TestCasegetwords:
     def test_decompose_unicode(self):
         eq_(getwords('foo\xe9bar'), ['fooebar'])
 
+    def test_removed_chars(self):
+        eq_(getwords("50% off = \"great\" | 'deal'^"), ['50', 'off', 'great', 'deal'])
+        eq_(getwords('\u65e5\u672c foo\u2212bar \u00df'), ['foobar'])
+        # Whitespace other than spaces doesn't split words
+        eq_(getwords('foo\tbar baz'), ['foo\tbar', 'baz'])
+
+    def test_result_can_be_modified(self):
+        # Results are cached, but callers get their own list.
+        words = getwords('foo bar')
+        words.remove('foo')
+        eq_(getwords('foo bar'), ['foo', 'bar'])
+
 
 class TestCasegetfields:
     def test_simple(self):
@@ -234,6 +253,19 @@ class TestCasebuild_word_dict:
         eq_(100, self.log[1])
 
 
+class TestCasebuild_word_index:
+    def test_simple(self):
+        l = [NamedObject('foo bar', True), NamedObject('bar baz', True), NamedObject('baz', True)]
+        d = build_word_dict(l)
+        postings, object_words = build_word_index(l, d)
+        eq_(len(postings), 3)
+        eq_(sorted(list(p) for p in postings), [[0], [0, 1], [1, 2]])
+        for index, word_ids in enumerate(object_words):
+            eq_(list(word_ids), sorted(word_ids))
+            eq_(set(word_ids), {word_id for word_id, p in enumerate(postings) if index in p})
+        assert not d
+
+
 class TestCasemerge_similar_words:
     def test_some_similar_words(self):
         d = {
@@ -245,7 +277,29 @@ class TestCasemerge_similar_words:
         eq_(1, len(d))
         eq_(3, len(d['foobar']))
 
-
+    def test_words_of_different_lengths(self):
+        # 'acmo' is 80% similar to 'cdacmo', which needs two deletions to become 'acmo'.
+        d = {'cdacmo': {1}, 'acmo': {2}, 'unrelated': {3}}
+        eq_(merge_similar_words(d), {'cdacmo': 'acmo'})
+        eq_(d, {'acmo': {1, 2}, 'unrelated': {3}})
+
+    def test_get_word_deletions(self):
+        eq_(get_word_deletions('abc'), {'abc', 'ab', 'ac', 'bc'})
+        eq_(get_word_deletions('ab'), {'ab'})
+        eq_(len(get_word_deletions('abcdefgh')), 1 + 8 + 28)
+        # Only the prefix is considered
+        eq_(get_word_deletions('abcdefghijkl'), get_word_deletions('abcdefghxxxx'))
+
+
+def test_get_word_state():
+    # Two letter words are never similar.
+    words = [a + b for a, b in itertools.combinations('abcdefghijk', 2)][:48]
+    objects = [no('foo ' + word, True) for word in words] + [no('foo barba', True)]
+    eq_(get_word_state(objects)['common_words'], [])
+    objects.append(no('foo barbaz', True))
+    eq_(get_word_state(objects)['common_words'], ['foo'])
+    eq_(get_word_state(objects)['merged_words'], [])
+    eq_(get_word_state(objects, match_similar_words=True)['merged_words'], [['barbaz', 'barba']])
 
 class TestCasereduce_common_words:
     def test_typical(self):
@@ -344,6 +398,47 @@ class TestCaseget_match:
         eq_(m.percentage, int((6.0 / 13.0) * 100))
 
 
+class TestCaseWordBags:
+    def setup_method(self, method):
+        if engine.np is None:
+            skip("NumPy isn't installed")
+
+    def check_same_as_compare(self, objects, flags):
+        bags = WordBags([o.words for o in objects], WEIGHT_WORDS in flags)
+        pairs = [(i1, i2) for i1 in range(len(objects)) for i2 in range(len(objects))]
+        results = bags.compare([i1 for i1, _ in pairs], [i2 for _, i2 in pairs])
+        for (i1, i2), result in zip(pairs, results.tolist()):
+            expected = compare(objects[i1].words, objects[i2].words, flags)
+            if result == 100:
+                # Word order isn't taken into account
+                assert expected in {99, 100}
+            else:
+                eq_(result, expected)
+
+    def test_same_as_compare(self):
+        r = random.Random(42)
+        vocabulary = ['a', 'foo', 'bar', 'bleh', 'something', 'x1', 'yz']
+        objects = [NamedObject('') for _ in range(60)]
+        for o in objects:
+            o.words = [r.choice(vocabulary) for _ in range(r.randint(0, 6))]
+        objects += [NamedObject('foo bar', True), NamedObject('bar foo', True), NamedObject('foo foo bar', True)]
+        self.check_same_as_compare(objects, ())
+        self.check_same_as_compare(objects, (WEIGHT_WORDS, ))
+
+    def test_getmatches_same_with_and_without_numpy(self, monkeypatch):
+        l = [
+            NamedObject("foo bar"), NamedObject("bar foo"), NamedObject("foo bar bleh"), NamedObject("foo foo bar"),
+            NamedObject("bleh"), NamedObject(""), NamedObject("a b c foo"),
+        ]
+        for weight_words in (False, True):
+            with_numpy = getmatches(l, weight_words=weight_words)
+            monkeypatch.setattr(engine, 'np', None)
+            without_numpy = getmatches(l, weight_words=weight_words)
+            monkeypatch.undo()
+            key = lambda m: (id(m.first), id(m.second), m.percentage)
+            eq_(sorted(map(key, with_numpy)), sorted(map(key, without_numpy)))
+
+
 class TestCaseGetMatches:
     def test_empty(self):
         eq_(getmatches([]), [])
@@ -365,6 +460,56 @@ class TestCaseGetMatches:
         eq_(m.percentage, 50)
         assert_match(m, 'foo bar', 'bar bleh')
 
+    def test_only_with(self):
+        # Pairs without any object in only_with aren't compared.
+        l = [NamedObject("foo bar"), NamedObject("foo bar"), NamedObject("foo bar")]
+        r = getmatches(l, only_with={l[2]})
+        eq_(len(r), 2)
+        assert all(l[2] in (m.first, m.second) for m in r)
+
+    def test_pairs_sharing_many_words_are_compared_once(self, monkeypatch):
+        @log_calls
+        def mocked_match(first, second, flags):
+            return Match(first, second, 100)
+
+        monkeypatch.setattr(engine, 'get_match', mocked_match)
+        monkeypatch.setattr(engine, 'np', None) # get_match() isn't called when scoring in batches
+        l = [NamedObject("foo bar baz"), NamedObject("foo bar baz"), NamedObject("bar baz bleh")]
+        r = getmatches(l)
+        eq_(len(r), 3)
+        pairs = [{id(c['first']), id(c['second'])} for c in mocked_match.calls]
+        eq_(len(pairs), 3)
+        assert all(pairs.count(pair) == 1 for pair in pairs)
+
+    def test_process_count(self, monkeypatch):
+        # Matching in a pool of processes gives the same matches as doing it all here.
+        monkeypatch.setattr(engine, 'MIN_OBJECTS_PER_PROCESS', 1)
+        names = ["foo bar", "bar foo", "foo bar bleh", "foo foo bar", "bleh", "", "a b c foo", "bleh bar"]
+        l = [NamedObject(name) for name in names * 3]
+        key = lambda m: (id(m.first), id(m.second), m.percentage)
+        for np in {engine.np, None}:
+            monkeypatch.setattr(engine, 'np', np)
+            expected = sorted(map(key, getmatches(l, min_match_percentage=50)))
+            eq_(sorted(map(key, getmatches(l, min_match_percentage=50, process_count=2))), expected)
+
+    def test_process_count_only_with(self, monkeypatch):
+        monkeypatch.setattr(engine, 'MIN_OBJECTS_PER_PROCESS', 1)
+        l = [NamedObject("foo bar"), NamedObject("foo bar"), NamedObject("foo bar")]
+        r = getmatches(l, only_with={l[2]}, process_count=2)
+        eq_(len(r), 2)
+        assert all(l[2] in (m.first, m.second) for m in r)
+
+    def test_process_count_cancel(self, monkeypatch):
+        monkeypatch.setattr(engine, 'MIN_OBJECTS_PER_PROCESS', 1)
+        j = job.Job(1, lambda progress, desc='': False)
+        with raises(job.JobCancelled):
+            getmatches([NamedObject("foo bar") for _ in range(10)], process_count=2, j=j)
+
+    def test_get_shards(self):
+        postings = [array('I', range(n)) for n in [10, 10, 1, 1, 10]]
+        shards = get_shards(postings, 3)
+        eq_([list(shard) for shard in shards], [[0], [1], [2, 3, 4]])
+
     def test_twice_the_same_word(self):
         l = [NamedObject("foo foo bar"), NamedObject("bar bleh")]
         r = getmatches(l)
@@ -478,6 +623,7 @@ class TestCaseGetMatches:
 
         objects = [NamedObject() for i in range(10)] # results in 45 matches
         monkeypatch.setattr(engine, 'get_match', mocked_match)
+        monkeypatch.setattr(engine, 'np', None)
         try:
             r = getmatches(objects)
         except MemoryError:
@@ -490,6 +636,121 @@ class TestCaseGetMatchesByContents:
         o1, o2 = no(size=0), no(size=0)
         assert not getmatches_by_contents([o1, o2])
 
+    def test_only_read_md5_of_partial_matches(self):
+        class MyObject(NamedObject):
+            def __getattribute__(self, attrname):
+                if attrname == 'md5':
+                    raise AssertionError()
+                return object.__getattribute__(self, attrname)
+
+        o1, o2 = MyObject('foo'), MyObject('bar')
+        assert not getmatches_by_contents([o1, o2])
+
+    def test_same_result_with_thread_pool(self):
+        objects = [no('foo', size=1), no('foo', size=1), no('foo', size=2), no('bar', size=1)]
+        for thread_count in (1, 4):
+            [m] = getmatches_by_contents(objects, hash_thread_count=thread_count)
+            eq_({m.first, m.second}, set(objects[:2]))
+            eq_(m.percentage, 100)
+
+    def test_iter_matches_by_contents(self):
+        objects = [no('foo'), no('foo'), no('foo'), no('bar')]
+        matches = iter_matches_by_contents(objects)
+        assert not isinstance(matches, list)
+        eq_(len(list(matches)), 3)
+
+
+def create_files(tmpdir, contents):
+    p = Path(str(tmpdir))
+    result = []
+    for i, data in enumerate(contents):
+        p['file{}'.format(i)].open('wb').write(data)
+        result.append(fs.File(p['file{}'.format(i)]))
+    return result
+
+
+class TestCaseCompareContents:
+    def test_compare(self, tmpdir, monkeypatch):
+        # With small chunks, files diverge after a few of them.
+        monkeypatch.setattr(engine, 'COMPARE_CHUNK_SIZE', 2)
+        files = create_files(tmpdir, [b'foobar', b'foobar', b'foobaz', b'barfoo', b'barfoo', b'bazfoo'])
+        buckets = compare_contents(files)
+        eq_(sorted(sorted(str(f.name) for f in b) for b in buckets), [['file0', 'file1'], ['file3', 'file4']])
+
+    def test_unreadable_files_are_dropped(self, tmpdir):
+        files = create_files(tmpdir, [b'foo', b'foo', b'foo'])
+        files[0].path.remove()
+        [bucket] = compare_contents(files)
+        eq_(set(bucket), set(files[1:]))
+
+    def test_getbuckets_compare_small_buckets(self, tmpdir):
+        # Small buckets are compared without reading their full digest.
+        digested = []
+
+        class MyFile(fs.File):
+            def _compute_md5(self):
+                digested.append(self)
+                return fs.File._compute_md5(self)
+
+        p = Path(str(tmpdir))
+        for name in 'abc':
+            p[name].open('wb').write(b'foobar')
+        files = [MyFile(p[name]) for name in 'abc']
+        for f in files:
+            f.is_ref = False
+        [bucket] = getbuckets_by_contents(files, bytewise_max_files=3)
+        eq_(set(bucket), set(files))
+        assert not digested
+        [bucket] = getbuckets_by_contents(files, bytewise_max_files=2)
+        eq_(len(digested), 3)
+
+
+class TestCaseGetBucketsByContents:
+    def test_buckets(self):
+        objects = [no('foo'), no('foo'), no('foo'), no('bar'), no('bar'), no('baz')]
+        buckets = getbuckets_by_contents(objects)
+        eq_(sorted(len(b) for b in buckets), [2, 3])
+
+    def test_same_partial_different_md5(self):
+        o1, o2 = no('foo'), no('foo')
+        o2.md5 = 'bar'
+        assert not getbuckets_by_contents([o1, o2])
+
+    def test_probes_split_buckets_before_md5(self):
+        class MyObject(NamedObject):
+            def __getattribute__(self, attrname):
+                if attrname == 'md5':
+                    raise AssertionError()
+                return object.__getattribute__(self, attrname)
+
+        o1, o2 = MyObject('foo'), MyObject('foo')
+        o1.md5tail, o2.md5tail = 'foo', 'bar'
+        assert not getbuckets_by_contents([o1, o2])
+
+    def test_small_files_arent_probed(self):
+        # Files no bigger than a probe go straight to the full digest.
+        class MyObject(NamedObject):
+            PROBE_SIZE = 4
+
+            def __getattribute__(self, attrname):
+                if attrname in engine.DIGEST_STAGES[:-1]:
+                    raise AssertionError()
+                return object.__getattribute__(self, attrname)
+
+        o1, o2, o3 = MyObject('foo', size=4), MyObject('foo', size=4), MyObject('bar', size=4)
+        [bucket] = getbuckets_by_contents([o1, o2, o3])
+        eq_(set(bucket), {o1, o2})
+
+    def test_custom_digest_stages(self):
+        o1, o2 = no('foo'), no('foo')
+        o2.md5 = 'bar'
+        eq_(len(getbuckets_by_contents([o1, o2], digest_stages=['md5partial'])), 1)
+
+    def test_dont_keep_ref_only_buckets(self):
+        o1, o2 = no('foo'), no('foo')
+        o1.is_ref = o2.is_ref = True
+        assert not getbuckets_by_contents([o1, o2])
+
 
 class TestCaseGroup:
     def test_empy(self):
@@ -730,6 +991,52 @@ class TestCaseGroup:
         eq_(1, len(g.matches))
         eq_(0, len(g.candidates))
 
+    def test_candidates_are_freed_by_get_groups(self):
+        o1, o2, o3 = (NamedObject("foo", True), NamedObject("bar", True), NamedObject("baz", True))
+        [g] = get_groups([get_match(o1, o2), get_match(o1, o3)])
+        eq_(0, len(g.candidates))
+
+    def test_get_match_of_after_remove_dupe(self):
+        g = Group()
+        o1, o2, o3 = (NamedObject("foo bar", True), NamedObject("foo bar", True), NamedObject("foo bar", True))
+        for match in [get_match(o1, o2), get_match(o1, o3), get_match(o2, o3)]:
+            g.add_match(match)
+        eq_(g.get_match_of(o3), get_match(o1, o3))
+        g.remove_dupe(o1)
+        eq_(g.get_match_of(o3), get_match(o2, o3))
+        assert g.get_match_of(o1) is None
+
+    def test_no_instance_dict(self):
+        # Groups are many, we don't want them to carry a __dict__.
+        assert not hasattr(Group(), '__dict__')
+
+
+class TestCaseExactGroup:
+    def test_add_exact_dupes(self):
+        g = Group()
+        o1, o2, o3 = no('foo'), no('bar'), no('baz')
+        g.add_exact_dupes([o1, o2, o3])
+        assert g.exact
+        eq_(g.ordered, [o1, o2, o3])
+        eq_(0, len(g.matches))
+        eq_(g.percentage, 100)
+        eq_(g.get_match_of(o3), Match(o1, o3, 100))
+        assert g.get_match_of(no('other')) is None
+
+    def test_get_match_of_after_switch_ref(self):
+        g = Group()
+        o1, o2, o3 = no('foo'), no('bar'), no('baz')
+        g.add_exact_dupes([o1, o2, o3])
+        g.switch_ref(o2)
+        eq_(g.get_match_of(o3), Match(o2, o3, 100))
+        eq_(g.get_match_of(o1), Match(o2, o1, 100))
+
+    def test_get_exact_groups(self):
+        o1, o2, o3 = no('foo'), no('bar'), no('baz')
+        groups = get_exact_groups([[o1, o2], [o3]])
+        eq_(len(groups), 1)
+        eq_(groups[0].ordered, [o1, o2])
+
 
 class TestCaseget_groups:
     def test_empty(self):
@@ -820,3 +1127,51 @@ class TestCaseget_groups:
         assert C in g2
         assert D in g2
 
+
+
+class TestCaseget_transitive_groups:
+    def test_empty(self):
+        eq_(get_transitive_groups([]), [])
+
+    def test_components_become_exact_groups(self):
+        o1, o2, o3, o4, o5 = no('a'), no('b'), no('c'), no('d'), no('e')
+        matches = [Match(o1, o2, 100), Match(o2, o3, 100), Match(o1, o3, 100), Match(o4, o5, 100)]
+        groups = get_transitive_groups(matches)
+        eq_(len(groups), 2)
+        eq_([set(g) for g in groups], [{o1, o2, o3}, {o4, o5}])
+        assert all(g.exact for g in groups)
+
+    def test_missing_pair_falls_back_to_get_groups(self):
+        # o1 and o3 were ignored together, they can't be in the same group.
+        o1, o2, o3, o4, o5 = no('a'), no('b'), no('c'), no('d'), no('e')
+        matches = [Match(o1, o2, 100), Match(o2, o3, 100), Match(o4, o5, 100)]
+        groups = get_transitive_groups(matches, lambda first, second: {first, second} != {o1, o3})
+        eq_(len(groups), 2)
+        eq_(set(groups[0]), {o4, o5})
+        assert groups[0].exact
+        eq_(len(groups[1]), 2)
+        assert o2 in groups[1]
+        assert not groups[1].exact
+
+    def test_matches_are_iterated_once(self):
+        o1, o2, o3 = no('a'), no('b'), no('c')
+        matches = (m for m in [Match(o1, o2, 100), Match(o2, o3, 100), Match(o1, o3, 100)])
+        [g] = get_transitive_groups(matches)
+        eq_(set(g), {o1, o2, o3})
+
+    def test_only_one_ref_per_group(self):
+        # ref files are never matched together, which doesn't make the component incomplete.
+        o1, o2, o3 = no('a'), no('b'), no('c')
+        o1.is_ref = o2.is_ref = True
+        groups = get_transitive_groups([Match(o1, o3, 100), Match(o2, o3, 100)])
+        eq_(len(groups), 1)
+        eq_(groups[0].ordered, [o1, o3])
+
+    def test_same_groups_as_get_groups(self):
+        objects = [no(str(i)) for i in range(30)]
+        matches = [
+            Match(first, second, 100)
+            for i in range(0, 30, 6) for first, second in itertools.combinations(objects[i:i+i//6+2], 2)
+        ]
+        expected = {frozenset(g) for g in get_groups(list(matches))}
+        eq_({frozenset(g) for g in get_transitive_groups(matches)}, expected)
@@ -10,6 +10,7 @@ import hashlib
 
 from hscommon.path import Path
 from hscommon.testutil import eq_
+from pytest import raises, mark
 from core.tests.directories_test import create_fake_fs
 
 from .. import fs
@@ -43,3 +44,150 @@ def test_has_file_attrs(tmpdir):
     b = fs.Folder(Path(str(tmpdir)))
     assert b.mtime > 0
     eq_(b.extension, '')
+
+def test_md5_read_from_filesdb(tmpdir):
+    # When a file didn't change since its md5 was cached, it isn't read again.
+    p = Path(str(tmpdir))
+    p['file'].open('w').write('foo')
+    fs.filesdb.connect(str(tmpdir.join('hash_cache.db')))
+    try:
+        eq_(fs.File(p['file']).md5, hashlib.md5(b'foo').digest())
+
+        class NotReadFile(fs.File):
+            def _compute_md5(self):
+                return b'not read'
+
+        eq_(NotReadFile(p['file']).md5, hashlib.md5(b'foo').digest())
+    finally:
+        fs.filesdb.close()
+
+def test_filesdb_invalidated_on_change(tmpdir):
+    p = Path(str(tmpdir))
+    p['file'].open('w').write('foo')
+    fs.filesdb.connect(str(tmpdir.join('hash_cache.db')))
+    try:
+        fs.File(p['file']).md5
+        p['file'].open('w').write('foobar')
+        eq_(fs.File(p['file']).md5, hashlib.md5(b'foobar').digest())
+    finally:
+        fs.filesdb.close()
+
+def test_filesdb_purge_outdated(tmpdir):
+    p = Path(str(tmpdir))
+    p['scanned'].mkdir()
+    p['other'].mkdir()
+    for path in [p['scanned']['file'], p['scanned']['kept'], p['other']['file']]:
+        path.open('w').write('foo')
+    fs.filesdb.connect(str(tmpdir.join('hash_cache.db')))
+    try:
+        for path in [p['scanned']['file'], p['scanned']['kept'], p['other']['file']]:
+            fs.File(path).md5
+        p['scanned']['file'].remove()
+        p['other']['file'].remove()
+        fs.filesdb.purge_outdated([str(p['scanned']), str(p['missing'])])
+        # Records outside of the scanned folders are left alone.
+        paths = {row[0] for row in fs.filesdb.con.execute("select path from digests")}
+        eq_(paths, {str(p['scanned']['kept']), str(p['other']['file'])})
+    finally:
+        fs.filesdb.close()
+
+def test_probes_find_difference_near_the_end(tmpdir):
+    # Same-sized files that only differ near their end have the same head, but not the same tail.
+    p = Path(str(tmpdir))
+    p['file1'].open('wb').write(b'a' * 0x10000 + b'b')
+    p['file2'].open('wb').write(b'a' * 0x10000 + b'c')
+    f1, f2 = fs.File(p['file1']), fs.File(p['file2'])
+    eq_(f1.md5head, f2.md5head)
+    eq_(f1.md5partial, f2.md5partial)
+    assert f1.md5tail != f2.md5tail
+
+def test_md5samples(tmpdir):
+    p = Path(str(tmpdir))
+    data = bytes(range(256)) * 0x100
+    p['file'].open('wb').write(data)
+    f = fs.File(p['file'])
+    step = len(data) // (f.SAMPLE_COUNT + 1)
+    md5 = hashlib.md5()
+    for i in range(1, f.SAMPLE_COUNT + 1):
+        md5.update(data[step * i:step * i + f.PROBE_SIZE])
+    eq_(f.md5samples, md5.digest())
+
+def test_folder_probes(tmpdir):
+    # Folders aggregate the probes of their files like they do with md5.
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    p['dir']['file'].open('w').write('foo')
+    f = fs.File(p['dir']['file'])
+    eq_(fs.Folder(p['dir']).md5tail, hashlib.md5(f.md5tail).digest())
+
+needs_blake2b = mark.skipif(not hasattr(hashlib, 'blake2b'), reason="BLAKE2b needs Python 3.6")
+
+@needs_blake2b
+def test_blake2b_algorithm(tmpdir):
+    p = Path(str(tmpdir))
+    p['file'].open('w').write('foo')
+    fs.set_hash_algorithm('blake2b')
+    try:
+        eq_(fs.File(p['file']).md5, hashlib.blake2b(b'foo', digest_size=16).digest())
+    finally:
+        fs.set_hash_algorithm('md5')
+
+def test_fast_algorithm(tmpdir):
+    p = Path(str(tmpdir))
+    p['file1'].open('w').write('foo')
+    p['file2'].open('w').write('foo')
+    p['file3'].open('w').write('bar')
+    fs.set_hash_algorithm('fast')
+    try:
+        # Never weaker than a cryptographic hash when xxhash isn't there.
+        assert fs.get_hash_algorithm() in {'xxh3', 'blake2b', 'md5'}
+        if hasattr(hashlib, 'blake2b'):
+            assert fs.get_hash_algorithm() != 'md5'
+        f1, f2, f3 = [fs.File(p[name]) for name in ['file1', 'file2', 'file3']]
+        eq_(f1.md5, f2.md5)
+        assert f1.md5 != f3.md5
+    finally:
+        fs.set_hash_algorithm('md5')
+
+def test_unknown_hash_algorithm():
+    with raises(ValueError):
+        fs.set_hash_algorithm('foo')
+
+@needs_blake2b
+def test_filesdb_digests_are_per_algorithm(tmpdir):
+    # A digest cached with an algorithm isn't returned when files are hashed with another one.
+    p = Path(str(tmpdir))
+    p['file'].open('w').write('foo')
+    fs.filesdb.connect(str(tmpdir.join('hash_cache.db')))
+    try:
+        fs.File(p['file']).md5
+        fs.set_hash_algorithm('blake2b')
+        eq_(fs.File(p['file']).md5, hashlib.blake2b(b'foo', digest_size=16).digest())
+    finally:
+        fs.set_hash_algorithm('md5')
+        fs.filesdb.close()
+
+def test_hash_file_contents_in_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr(fs, 'READ_CHUNK_SIZE', 3)
+    p = tmpdir.join('file')
+    p.write_binary(b'foobarbaz!')
+    md5 = hashlib.md5()
+    fs.hash_file_contents(str(p), md5)
+    eq_(md5.digest(), hashlib.md5(b'foobarbaz!').digest())
+
+def test_hash_file_contents_mmap(tmpdir, monkeypatch):
+    monkeypatch.setattr(fs, 'MMAP_THRESHOLD', 1)
+    p = tmpdir.join('file')
+    p.write_binary(b'foobarbaz!')
+    md5 = hashlib.md5()
+    fs.hash_file_contents(str(p), md5)
+    eq_(md5.digest(), hashlib.md5(b'foobarbaz!').digest())
+
+def test_hash_empty_file_contents(tmpdir, monkeypatch):
+    # Empty files can't be mapped in memory.
+    monkeypatch.setattr(fs, 'MMAP_THRESHOLD', 0)
+    p = tmpdir.join('file')
+    p.write_binary(b'')
+    md5 = hashlib.md5()
+    fs.hash_file_contents(str(p), md5)
+    eq_(md5.digest(), hashlib.md5(b'').digest())
@@ -0,0 +1,56 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+from hscommon.testutil import eq_
+
+from ..engine import Match
+from ..inventory import Inventory
+from .scanner_test import NamedObject as no
+
+def test_save_and_load():
+    inventory = Inventory()
+    f = [no('foo bar', size=1, path='p1'), no('foo bar', size=2, path='p2')]
+    f[0].mtime = 42
+    f[1].mtime = 43.5
+    inventory.save('signature', f, [Match(f[0], f[1], 100)])
+    path2info, matches = inventory.load('signature')
+    eq_(path2info[str(f[0].path)], (1, 42, ['foo', 'bar']))
+    eq_(path2info[str(f[1].path)].mtime, 43.5)
+    eq_(matches, [(str(f[0].path), str(f[1].path), 100)])
+
+def test_other_signature():
+    inventory = Inventory()
+    f = [no('foo bar', path='p1')]
+    f[0].mtime = 42
+    inventory.save('signature', f, [])
+    eq_(inventory.load('other signature'), ({}, []))
+
+def test_word_state():
+    inventory = Inventory()
+    f = [no('foo bar', path='p1')]
+    f[0].mtime = 42
+    eq_(inventory.load_word_state('signature'), None)
+    inventory.save('signature', f, [], {'common_words': ['foo']})
+    eq_(inventory.load_word_state('signature'), {'common_words': ['foo']})
+    eq_(inventory.load_word_state('other signature'), None)
+
+def test_save_replaces_previous_inventory():
+    inventory = Inventory()
+    f = [no('foo bar', path='p1'), no('foo bar', path='p2')]
+    for o in f:
+        o.mtime = 42
+    inventory.save('signature', f, [Match(f[0], f[1], 100)])
+    inventory.save('signature', f[:1], [])
+    path2info, matches = inventory.load('signature')
+    eq_(list(path2info), [str(f[0].path)])
+    eq_(matches, [])
+
+def test_corrupted_db(tmpdir):
+    dbname = str(tmpdir.join('inventory.db'))
+    with open(dbname, 'w') as fp:
+        fp.write('invalid sqlite content')
+    inventory = Inventory(dbname) # no exception
+    eq_(inventory.load('signature'), ({}, []))
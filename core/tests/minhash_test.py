@@ -0,0 +1,69 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+from pytest import skip
+from hscommon.testutil import eq_
+
+from .base import NamedObject
+from .. import engine
+from ..engine import getmatches
+
+def setup_module(module):
+    if engine.np is None:
+        skip("NumPy isn't installed")
+
+def get_band_keys(word_sets, bands, rows):
+    from ..minhash import get_band_keys
+    np = engine.np
+    offsets = np.cumsum([0] + [len(s) for s in word_sets])
+    word_ids = np.array([w for s in word_sets for w in sorted(s)], dtype=np.int64)
+    return get_band_keys(offsets, word_ids, bands, rows)
+
+def iter_pairs(band_keys):
+    from ..minhash import iter_band_candidates
+    for band in range(len(band_keys)):
+        for indexes1, indexes2 in iter_band_candidates(band_keys, band):
+            yield from zip(indexes1.tolist(), indexes2.tolist())
+
+def test_get_band_params():
+    from ..minhash import get_band_params
+    bands, rows = get_band_params(0.5)
+    assert bands * rows <= 128
+    assert abs((1 / bands) ** (1 / rows) - 0.5) < 0.05
+
+def test_same_sets_have_same_keys():
+    keys = get_band_keys([{1, 2, 3}, {3, 2, 1}, {4, 5}], 8, 4)
+    assert (keys[:, 0] == keys[:, 1]).all()
+    assert not (keys[:, 0] == keys[:, 2]).any()
+
+def test_pairs_are_yielded_once():
+    keys = get_band_keys([{1, 2, 3}, {1, 2, 3}, {1, 2, 3, 4}, {7, 8}], 20, 2)
+    pairs = list(iter_pairs(keys))
+    eq_(len(pairs), len(set(pairs)))
+    assert (0, 1) in pairs
+    assert not any(3 in pair for pair in pairs)
+
+def test_getmatches_lsh():
+    l = [
+        NamedObject("foo bar baz"), NamedObject("foo bar baz"), NamedObject("bar baz foo"),
+        NamedObject("something else"), NamedObject(""),
+    ]
+    r = getmatches(l, lsh_threshold=0.5)
+    eq_(sorted(m.percentage for m in r), [99, 99, 100])
+
+def test_getmatches_lsh_with_fields():
+    l = [NamedObject("foo bar - baz"), NamedObject("foo bar - baz"), NamedObject("foo - bar")]
+    for o in l:
+        o.words = engine.getfields(o.name)
+    r = getmatches(l, min_match_percentage=50, lsh_threshold=0.5)
+    eq_(len(r), 1)
+    eq_(r[0].percentage, 100)
+
+def test_getmatches_lsh_only_with():
+    l = [NamedObject("foo bar"), NamedObject("foo bar"), NamedObject("foo bar")]
+    r = getmatches(l, only_with={l[2]}, lsh_threshold=0.5)
+    eq_(len(r), 2)
+    assert all(l[2] in (m.first, m.second) for m in r)
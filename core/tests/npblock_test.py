@@ -0,0 +1,166 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+import random
+
+from pytest import skip
+from hscommon.testutil import eq_
+
+try:
+    import numpy as np
+    from ..pe.npblock import (
+        getblocks_from_array, getblocks_from_buffer, getblocks_from_pil, avgdiffs, to_block_array
+    )
+except ImportError:
+    skip("NumPy isn't installed or the block module hasn't been compiled.")
+
+from ..pe.block import getblocks2, avgdiff
+from ..pe.cache import colors_to_bytes
+from ..pe import matchblock
+
+RED = (0xff, 0, 0)
+BLUE = (0, 0, 0xff)
+
+class FakeImage:
+    # PIL image for getblocks2()
+    def __init__(self, size, data):
+        self.size = size
+        self.data = data
+
+    def getdata(self):
+        return self.data
+
+    def crop(self, box):
+        pixels = []
+        for i in range(box[1], box[3]):
+            for j in range(box[0], box[2]):
+                pixels.append(self.data[i * self.size[0] + j])
+        return FakeImage((box[2] - box[0], box[3] - box[1]), pixels)
+
+def to_array(width, height, pixels):
+    return np.array(pixels, dtype=np.uint8).reshape(height, width, 3)
+
+def test_empty_image():
+    eq_(getblocks_from_array(np.zeros((0, 0, 3), dtype=np.uint8), 1), [])
+
+def test_four_pixels():
+    pixels = [RED, (0, 0x80, 0xff), (0x80, 0, 0), (0, 0x40, 0x80)]
+    [b] = getblocks_from_array(to_array(2, 2, pixels), 1)
+    eq_(b, ((0xff + 0x80) // 4, (0x80 + 0x40) // 4, (0xff + 0x80) // 4))
+
+def test_image_smaller_than_block_count():
+    blocks = getblocks_from_array(to_array(2, 1, [RED, BLUE]), 2)
+    eq_(blocks, [RED, BLUE, RED, BLUE])
+    blocks = getblocks_from_array(to_array(1, 2, [RED, BLUE]), 2)
+    eq_(blocks, [RED, RED, BLUE, BLUE])
+
+def test_same_blocks_as_getblocks2():
+    r = random.Random(42)
+    for width, height, block_count in [(15, 15, 15), (47, 31, 15), (7, 40, 15), (100, 3, 4), (5, 5, 1)]:
+        pixels = [tuple(r.randrange(256) for _ in range(3)) for _ in range(width * height)]
+        expected = getblocks2(FakeImage((width, height), pixels), block_count)
+        eq_(getblocks_from_array(to_array(width, height, pixels), block_count), expected)
+
+def test_getblocks_from_buffer_skips_line_padding():
+    # 3 pixels take 9 bytes, which Qt pads to 12.
+    lines = [bytes(RED * 3) + b'\xaa' * 3, bytes(BLUE * 3) + b'\xaa' * 3]
+    [b] = getblocks_from_buffer(b''.join(lines), 3, 2, 12, 1)
+    eq_(b, (0xff // 2, 0, 0xff // 2))
+
+def test_getblocks_from_pil_same_as_getblocks2():
+    try:
+        from PIL import Image
+    except ImportError:
+        skip("PIL isn't installed")
+    r = random.Random(42)
+    width, height = 47, 31
+    image = Image.new('RGB', (width, height))
+    image.putdata([tuple(r.randrange(256) for _ in range(3)) for _ in range(width * height)])
+    expected = getblocks2(image, 15)
+    eq_(getblocks_from_pil(image, 15), expected)
+    # Pictures in other modes are converted to RGB first.
+    eq_(getblocks_from_pil(image.convert('RGBA'), 15), expected)
+
+def random_blocks(r, count, like=None, noise=0):
+    if like is None:
+        return [tuple(r.randrange(256) for _ in range(3)) for _ in range(count)]
+    return [tuple(max(0, min(255, c + r.randint(-noise, noise))) for c in block) for block in like]
+
+def test_avgdiffs_same_as_avgdiff():
+    r = random.Random(42)
+    pairs = []
+    for noise in (0, 1, 5, 10, 30, 100):
+        for _ in range(20):
+            first = random_blocks(r, 225)
+            pairs.append((first, random_blocks(r, 225, like=first, noise=noise)))
+    first, _ = to_block_array([colors_to_bytes(p[0]) for p in pairs], 225)
+    second, _ = to_block_array([colors_to_bytes(p[1]) for p in pairs], 225)
+    indexes = np.arange(len(pairs))
+    for limit, min_iterations in [(0, 3), (10, 3), (20, 1), (50, 0), (30, 10), (768, 3)]:
+        expected = [avgdiff(b1, b2, limit, min_iterations) for b1, b2 in pairs]
+        eq_(avgdiffs(first, second, indexes, indexes, limit, min_iterations).tolist(), expected)
+
+def test_to_block_array_invalid_blocks():
+    blocks, valid = to_block_array([colors_to_bytes([RED, BLUE]), b'', colors_to_bytes([RED])], 2)
+    eq_(blocks.shape, (3, 2, 3))
+    eq_(valid.tolist(), [True, False, False])
+    eq_(blocks[0].tolist(), [list(RED), list(BLUE)])
+
+def test_compare_arrays_same_as_compare_pairs():
+    r = random.Random(42)
+    pairs = []
+    picinfo = {}
+    for pic_id in range(60):
+        if pic_id % 3:
+            blocks = random_blocks(r, 225, like=pairs[-1][1], noise=pic_id % 12)
+        else:
+            blocks = random_blocks(r, 225)
+        if pic_id == 10:
+            blocks = []
+        pairs.append((pic_id, blocks))
+        picinfo[pic_id] = ((pic_id % 2, 1), pic_id % 5 == 0)
+    blob_pairs = [(pic_id, colors_to_bytes(blocks)) for pic_id, blocks in pairs]
+    for threshold in (0, 80, 95):
+        for ref_pairs, other_pairs in [(pairs[:30], pairs[30:]), (pairs, None)]:
+            expected = matchblock._compare_pairs(ref_pairs, other_pairs, threshold, picinfo)
+            ref_pairs = blob_pairs[:len(ref_pairs)]
+            if other_pairs is not None:
+                other_pairs = blob_pairs[len(ref_pairs):]
+            result = matchblock._compare_arrays(ref_pairs, other_pairs, threshold, picinfo)
+            eq_(sorted(result), sorted(expected))
+
+class FakePicture:
+    def __init__(self, name, blocks, dimensions=(1, 1), is_ref=False):
+        self.path = name
+        self.blocks = blocks
+        self.dimensions = dimensions
+        self.is_ref = is_ref
+        self.md5 = name
+
+    def get_blocks(self, block_count_per_side):
+        return self.blocks
+
+def get_pictures():
+    r = random.Random(42)
+    pictures = []
+    for i in range(40):
+        if i % 4:
+            blocks = random_blocks(r, 225, like=pictures[-1].blocks, noise=i % 8)
+        else:
+            blocks = random_blocks(r, 225)
+        pictures.append(FakePicture('pic{}'.format(i), blocks, dimensions=(i % 2, 1), is_ref=i == 5))
+    return pictures
+
+def test_getmatches_with_shared_blocks(tmpdir, monkeypatch):
+    # Small chunks, to have comparisons between chunks.
+    monkeypatch.setattr(matchblock, 'MIN_CHUNK_SIZE', 7)
+    cache_path = str(tmpdir.join('cache.db'))
+    matches = matchblock.getmatches(get_pictures(), cache_path, 90)
+    assert matches
+    monkeypatch.setattr(matchblock, 'shared_memory', None)
+    expected = matchblock.getmatches(get_pictures(), cache_path, 90)
+    key = lambda m: (m.first.path, m.second.path, m.percentage)
+    eq_(sorted(map(key, matches)), sorted(map(key, expected)))
@@ -651,6 +651,29 @@ class TestCaseResultsXML:
         match = group.get_match_of(d3) #d2 - d3
         eq_(46, match[2])
 
+    def test_save_and_load_exact_group(self):
+        # Exact groups don't have matches, but they have to be reloaded as exact groups.
+        group = engine.Group()
+        group.add_exact_dupes(self.objects[:3])
+        self.results.groups = [group]
+        f = io.BytesIO()
+        self.results.save_to_xml(f)
+        f.seek(0)
+        self.results.load_from_xml(f, self.get_file)
+        [group] = self.results.groups
+        assert group.exact
+        eq_(len(group), 3)
+        eq_(group.get_match_of(group[2]).percentage, 100)
+
+    def test_save_and_load_hash_algorithm(self):
+        self.results.hash_algorithm = 'blake2b'
+        f = io.BytesIO()
+        self.results.save_to_xml(f)
+        f.seek(0)
+        self.results.hash_algorithm = None
+        self.results.load_from_xml(f, self.get_file)
+        eq_(self.results.hash_algorithm, 'blake2b')
+
     def test_save_and_load(self):
         # previously, when reloading matches, they wouldn't be reloaded as namedtuples
         f = io.BytesIO()
@@ -8,9 +8,10 @@ from hscommon.jobprogress import job
 from hscommon.path import Path
 from hscommon.testutil import eq_
 
-from .. import fs
-from ..engine import getwords, Match
+from .. import engine, fs
+from ..engine import getwords, compare, Match
 from ..ignore import IgnoreList
+from ..inventory import Inventory
 from ..scanner import Scanner, ScanType
 from ..me.scanner import ScannerME
 
@@ -106,6 +107,130 @@ def test_content_scan(fake_fileexists):
     eq_(len(r[0]), 2)
     eq_(s.discarded_file_count, 0) # don't count the different md5 as discarded!
 
+def test_incremental_scan(fake_fileexists, monkeypatch):
+    def create_files(names_and_paths):
+        result = [no(name, path=path) for name, path in names_and_paths]
+        for o in result:
+            o.mtime = 42
+        return result
+
+    compared = []
+
+    def get_match(first, second, flags=()):
+        compared.append({str(first.path), str(second.path)})
+        return Match(first, second, compare(first.words, second.words, flags))
+
+    monkeypatch.setattr(engine, 'get_match', get_match)
+    monkeypatch.setattr(engine, 'np', None) # get_match() isn't called when scoring in batches
+    s = Scanner()
+    s.inventory = Inventory()
+    f = create_files([('foo bar', 'p1'), ('foo bar', 'p2'), ('foo bleh', 'p3')])
+    [g] = s.get_dupe_groups(f)
+    eq_(len(g), 2)
+    del compared[:]
+    # A new file is only compared with the others. The match of unchanged files is kept.
+    f = create_files([('foo bar', 'p1'), ('foo bar', 'p2'), ('foo bleh', 'p3'), ('foo bar', 'p4')])
+    [g] = s.get_dupe_groups(f)
+    eq_(len(g), 3)
+    assert all(str(f[3].path) in pair for pair in compared)
+    # Matches with deleted or changed files go away.
+    f = create_files([('foo bar', 'p1'), ('foo bar', 'p2'), ('foo bleh', 'p3')])
+    f[1].mtime = 43
+    f[1].words = getwords('something else')
+    f[1].name = 'something else'
+    eq_(s.get_dupe_groups(f), [])
+
+def test_incremental_scan_same_as_full_scan_when_common_words_change(fake_fileexists):
+    # Common words depend on all scanned files. When files are added or removed, pairs of unchanged
+    # files can start or stop being compared, so their previous matches can't be kept.
+    def create_files(count):
+        result = [no('common w{}'.format(i), path='p{}'.format(i)) for i in range(count)]
+        result.append(no('common w0 zz', path='p'))
+        for o in result:
+            o.mtime = 42
+        return result
+
+    def get_matches(s, files):
+        # Groups of 50% matches depend on the order of matches, so we compare matches.
+        if s.inventory is not None:
+            matches = s._getmatches_incremental(files, job.nulljob)
+        else:
+            matches = s._getmatches(files, job.nulljob)
+        return sorted((sorted([str(m.first.path), str(m.second.path)]), m.percentage) for m in matches)
+
+    full_scanner = Scanner()
+    full_scanner.min_match_percentage = 50
+    s = Scanner()
+    s.min_match_percentage = 50
+    s.inventory = Inventory()
+    for count in (40, 60, 40):
+        eq_(get_matches(s, create_files(count)), get_matches(full_scanner, create_files(count)))
+
+def test_content_scan_group_by_digest(fake_fileexists):
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    f = [no('foo', path='p1'), no('bar', path='p2'), no('bleh', path='p3'), no('baz', path='p4')]
+    f[0].md5 = f[0].md5partial = 'foobar'
+    f[1].md5 = f[1].md5partial = 'foobar'
+    f[2].md5 = f[2].md5partial = 'foobar'
+    f[3].md5 = f[3].md5partial = 'bleh'
+    [g] = s.get_dupe_groups(f)
+    eq_(len(g), 3)
+    assert g.exact
+    eq_(s.discarded_file_count, 0)
+
+def test_content_scan_group_by_digest_with_ignore_list(fake_fileexists):
+    # Files that were ignored together can't be in the same group, even in buckets.
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    f = [no('foo', path='p1'), no('bar', path='p2'), no('bleh', path='p3')]
+    for o in f:
+        o.md5 = o.md5partial = 'foobar'
+    ignore_list = IgnoreList()
+    ignore_list.Ignore(str(f[0].path), str(f[1].path))
+    [g] = s.get_dupe_groups(f, ignore_list=ignore_list)
+    eq_(len(g), 2)
+    assert not (f[0] in g and f[1] in g)
+
+def test_content_scan_group_by_digest_one_ref_per_group(fake_fileexists):
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    f = [no('foo', path='p1'), no('bar', path='p2'), no('bleh', path='p3')]
+    for o in f:
+        o.md5 = o.md5partial = 'foobar'
+    f[0].is_ref = f[1].is_ref = True
+    [g] = s.get_dupe_groups(f)
+    eq_(len(g), 2)
+    assert g.ref.is_ref
+    assert g.dupes[0] is f[2]
+
+def test_content_scan_groups_are_exact(fake_fileexists):
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    s.group_contents_by_digest = False # grouped from match pairs
+    f = [no('foo', path='p1'), no('bar', path='p2'), no('bleh', path='p3')]
+    for o in f:
+        o.md5 = o.md5partial = 'foobar'
+    f[0].is_ref = f[1].is_ref = True
+    [g] = s.get_dupe_groups(f)
+    assert g.exact
+    eq_(len(g), 2)
+    assert g.ref.is_ref
+    assert g.dupes[0] is f[2]
+
+def test_content_scan_with_ignore_list(fake_fileexists):
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    s.group_contents_by_digest = False # grouped from match pairs
+    f = [no('foo', path='p1'), no('bar', path='p2'), no('bleh', path='p3')]
+    for o in f:
+        o.md5 = o.md5partial = 'foobar'
+    ignore_list = IgnoreList()
+    ignore_list.Ignore(str(f[0].path), str(f[1].path))
+    [g] = s.get_dupe_groups(f, ignore_list=ignore_list)
+    eq_(len(g), 2)
+    assert not (f[0] in g and f[1] in g)
+
 def test_content_scan_compare_sizes_first(fake_fileexists):
     class MyFile(no):
         @property
@@ -438,6 +563,7 @@ def test_dont_group_files_that_dont_exist(tmpdir):
     # get_groups() part.
     s = Scanner()
     s.scan_type = ScanType.Contents
+    s.group_contents_by_digest = False
     p = Path(str(tmpdir))
     p['file1'].open('w').write('foo')
     p['file2'].open('w').write('foo')
@@ -451,6 +577,37 @@ def test_dont_group_files_that_dont_exist(tmpdir):
 
     assert not s.get_dupe_groups([file1, file2])
 
+def test_dont_group_files_that_dont_exist_by_digest(tmpdir, monkeypatch):
+    # Same as above, but between the bucketing and the grouping of a Contents scan.
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    p = Path(str(tmpdir))
+    p['file1'].open('w').write('foo')
+    p['file2'].open('w').write('foo')
+    file1, file2 = fs.get_files(p)
+
+    def getbuckets_by_contents(*args, **kw):
+        file2.path.remove()
+        return [[file1, file2]]
+
+    monkeypatch.setattr(engine, 'getbuckets_by_contents', getbuckets_by_contents)
+
+    assert not s.get_dupe_groups([file1, file2])
+
+def test_folder_scan_digest_stages(fake_fileexists, monkeypatch):
+    # Each digest stage of a folder reads all of its files, so Folders scans only use one probe.
+    s = Scanner()
+    s.scan_type = ScanType.Folders
+    used_stages = []
+
+    def iter_matches_by_contents(files, **kw):
+        used_stages.append(kw['digest_stages'])
+        return []
+
+    monkeypatch.setattr(engine, 'iter_matches_by_contents', iter_matches_by_contents)
+    s.get_dupe_groups([no('foo'), no('bar')])
+    eq_(used_stages, [['md5partial', 'md5']])
+
 def test_folder_scan_exclude_subfolder_matches(fake_fileexists):
     # when doing a Folders scan type, don't include matches for folders whose parent folder already
     # match.
@@ -0,0 +1,180 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+import time
+
+from pytest import fixture, skip
+from hscommon.path import Path
+from hscommon.testutil import eq_
+
+from ..directories import Directories, DirectoryState
+from .. import watcher
+from ..watcher import Journal, Watcher
+from .directories_test import create_fake_fs
+
+def start_watcher(w):
+    # Folders are watched as the walk of get_files() goes through them.
+    w.start()
+    list(w.directories.get_files(on_folder=w.watch_folder))
+
+@fixture
+def polling_watcher(request, tmpdir, monkeypatch):
+    # The polling fallback, with a poll interval long enough for us to poll manually.
+    monkeypatch.setattr(watcher, '_load_libc', lambda: None)
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    w = Watcher(d, poll_interval=3600)
+    start_watcher(w)
+    request.addfinalizer(w.stop)
+    return w, p
+
+def test_empty_journal():
+    journal = Journal()
+    assert not journal
+    journal.dirty.add(Path('foo'))
+    assert journal
+
+def test_poll_nothing_changed(polling_watcher):
+    w, p = polling_watcher
+    w.poll_now()
+    assert not w.take_journal()
+
+def test_poll_modified_file(polling_watcher):
+    w, p = polling_watcher
+    with p['dir1']['file1.test'].open('a') as fp:
+        fp.write('more')
+    w.poll_now()
+    journal = w.take_journal()
+    eq_(journal.dirty, {p['dir1']})
+    eq_(journal.added, set())
+    # The journal was reset
+    assert not w.take_journal()
+
+def test_poll_added_and_removed_folders(polling_watcher):
+    w, p = polling_watcher
+    p['dir2'].rmtree()
+    p['dir4'].mkdir()
+    p['dir4']['sub'].mkdir()
+    w.poll_now()
+    journal = w.take_journal()
+    eq_(journal.dirty, {p})
+    eq_(journal.added, {p['dir4']})
+    eq_(journal.removed, {p['dir2']})
+    # New folders are watched too
+    p['dir4']['sub']['foo.test'].open('w').write('foo')
+    w.poll_now()
+    eq_(w.take_journal().dirty, {p['dir4']['sub']})
+
+def test_poll_removed_folder_tree_is_forgotten(polling_watcher):
+    w, p = polling_watcher
+    p['dir4'].mkdir()
+    p['dir4']['sub'].mkdir()
+    w.poll_now()
+    p['dir4'].rmtree()
+    w.poll_now()
+    assert p['dir4'] in w.take_journal().removed
+    assert p['dir4'] not in w._polled
+    assert p['dir4']['sub'] not in w._polled
+    assert p['dir4'] not in w._children[p]
+
+def test_poll_new_folder_tree_is_walked_without_lock(polling_watcher, monkeypatch):
+    # Walking a big new tree shouldn't block take_journal().
+    w, p = polling_watcher
+    walk_folders = w._walk_folders
+    locked = []
+
+    def mock_walk_folders(from_path):
+        locked.append(w._lock.locked())
+        return walk_folders(from_path)
+    monkeypatch.setattr(w, '_walk_folders', mock_walk_folders)
+    p['dir4'].mkdir()
+    w.poll_now()
+    eq_(locked, [False])
+    assert p['dir4'] in w._polled
+
+def test_pruned_folders_are_not_watched(tmpdir, monkeypatch):
+    monkeypatch.setattr(watcher, '_load_libc', lambda: None)
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    d.set_state(p['dir1'], DirectoryState.Excluded)
+    w = Watcher(d, poll_interval=3600)
+    start_watcher(w)
+    try:
+        p['dir1']['foo.test'].open('w').write('foo')
+        w.poll_now()
+        assert not w.take_journal()
+    finally:
+        w.stop()
+
+def test_unwatched_folders_without_polling_overflow(tmpdir, monkeypatch):
+    # Without inotify, and without polling, we can't tell what changed.
+    monkeypatch.setattr(watcher, '_load_libc', lambda: None)
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    w = Watcher(d)
+    start_watcher(w)
+    try:
+        eq_(w._threads, [])
+        assert w.take_journal().overflow
+    finally:
+        w.stop()
+
+def test_inotify(tmpdir):
+    if watcher._load_libc() is None:
+        skip("inotify isn't available here")
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    w = Watcher(d, poll_interval=3600)
+    start_watcher(w)
+    try:
+        p['dir1']['foo.test'].open('w').write('foo')
+        p['dir4'].mkdir()
+        dirty, added = set(), set()
+        # Events are read by another thread.
+        for _ in range(50):
+            journal = w.take_journal()
+            dirty |= journal.dirty
+            added |= journal.added
+            if p['dir1'] in dirty and p['dir4'] in added:
+                break
+            time.sleep(0.1)
+        eq_(dirty, {p, p['dir1']})
+        eq_(added, {p['dir4']})
+    finally:
+        w.stop()
+
+def test_inotify_watches_of_moved_folders_are_removed(tmpdir):
+    # A moved folder still exists, and so does its kernel watch, until we remove it.
+    if watcher._load_libc() is None:
+        skip("inotify isn't available here")
+    root = Path(str(tmpdir))
+    p = root['watched']
+    p.mkdir()
+    p['dir1'].mkdir()
+    p['dir1']['sub'].mkdir()
+    d = Directories()
+    d.add_path(p)
+    w = Watcher(d, poll_interval=3600)
+    start_watcher(w)
+
+    def kernel_watch_count():
+        with open('/proc/self/fdinfo/{}'.format(w._fd)) as fp:
+            return sum(1 for line in fp if line.startswith('inotify'))
+    try:
+        eq_(kernel_watch_count(), 3)
+        p['dir1'].rename(root['moved'])
+        for _ in range(50):
+            if p['dir1'] in w.take_journal().removed:
+                break
+            time.sleep(0.1)
+        eq_(kernel_watch_count(), 1)
+        eq_(set(w._path2wd), {p})
+    finally:
+        w.stop()
@@ -0,0 +1,352 @@
+# Copyright 2016 Virgil Dupras
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+import logging
+import select
+import struct
+import threading
+from collections import defaultdict
+
+# Seconds between two passes of the polling fallback
+POLL_INTERVAL = 60
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Changes in a folder's entries, and the folder itself being removed
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+WATCH_MASK |= IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+class Journal:
+    """Folders in which something changed since a :class:`Watcher` started or was last asked.
+
+    .. attribute:: dirty
+
+        set of folder paths whose direct contents changed. Their files have to be listed again.
+
+    .. attribute:: added
+
+        set of folder paths that were created or moved in. They have to be walked entirely.
+
+    .. attribute:: removed
+
+        set of folder paths that were deleted or moved away. Nothing under them exists anymore.
+
+    .. attribute:: overflow
+
+        bool. Some changes were lost and only a full walk can tell what's there now.
+    """
+    def __init__(self):
+        self.dirty = set()
+        self.added = set()
+        self.removed = set()
+        self.overflow = False
+
+    def __bool__(self):
+        return bool(self.dirty or self.added or self.removed or self.overflow)
+
+
+def _load_libc():
+    # inotify is only available on Linux and, since we don't want a dependency for it, we access
+    # it through ctypes.
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class Watcher:
+    """Keeps a :class:`Journal` of changes in the folders a :class:`~core.directories.Directories`
+    would scan.
+
+    On Linux, folders are watched with inotify. When inotify isn't available, or when we reach the
+    maximum number of watches, the remaining folders are polled every ``poll_interval`` seconds:
+    we compare the name, size and mtime of their entries with the ones of the previous pass. This
+    reads the stats of every entry of these folders on each pass, so it's only done when a
+    ``poll_interval`` is given. Otherwise, journals of a watcher with folders it couldn't watch
+    always :attr:`overflow <Journal.overflow>`.
+
+    The journal is only meaningful for the folder selection the watcher was started with.
+    """
+    def __init__(self, directories, poll_interval=None):
+        self.directories = directories
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._journal = Journal()
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._libc = _load_libc()
+        self._fd = None
+        self._watch_limit_reached = False
+        # Folders that are neither watched nor polled: we can't tell what changes in them.
+        self._has_unwatched_folders = False
+        self._wd2path = {}
+        self._path2wd = {}
+        # {path: signature} of polled folders
+        self._polled = {}
+        # {path: set of paths} of watched or polled folders directly under a folder
+        self._children = defaultdict(set)
+
+    #--- Private
+    def _walk_folders(self, from_path):
+        # Yields all folders under `from_path` (included) that can contain scanned files.
+        paths = [from_path]
+        while paths:
+            path = paths.pop()
+            if self.directories.is_pruned(path):
+                continue
+            yield path
+            try:
+                paths += [
+                    path + entry.name for entry in os.scandir(str(path))
+                    if entry.is_dir() and not entry.is_symlink()
+                ]
+            except OSError:
+                pass
+
+    def _watch_tree(self, from_path):
+        # Must be called without holding the lock: walking a big new tree takes a while, and we
+        # don't want to block take_journal() for that long.
+        for path in self._walk_folders(from_path):
+            self.watch_folder(path)
+
+    def _watch_folder(self, path):
+        if self._add_inotify_watch(path):
+            pass
+        elif not os.path.isdir(str(path)):
+            return # removed since it was walked
+        elif self.poll_interval is not None:
+            self._polled[path] = self._get_signature(path)
+        else:
+            self._has_unwatched_folders = True
+            return
+        self._children[path.parent()].add(path)
+
+    def _add_inotify_watch(self, path):
+        # Once we've reached the watch limit, we stop adding watches, but we keep the ones we have.
+        if self._fd is None or self._watch_limit_reached:
+            return False
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(str(path)), WATCH_MASK)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                logging.warning("inotify watch limit reached, polling remaining folders instead.")
+                self._watch_limit_reached = True
+            return False
+        self._wd2path[wd] = path
+        self._path2wd[path] = wd
+        return True
+
+    def _forget(self, path):
+        # Stop watching/polling `path` and everything under it.
+        self._discard_child(path)
+        paths = [path]
+        while paths:
+            path = paths.pop()
+            wd = self._path2wd.pop(path, None)
+            if wd is not None:
+                self._wd2path.pop(wd, None)
+                # A moved folder is still there, and so is its watch, unless we remove it.
+                if self._fd is not None:
+                    self._libc.inotify_rm_watch(self._fd, wd)
+            self._polled.pop(path, None)
+            paths += self._children.pop(path, ())
+
+    def _discard_child(self, path):
+        parent = path.parent()
+        children = self._children.get(parent)
+        if children is not None:
+            children.discard(path)
+            if not children:
+                del self._children[parent]
+
+    def _handle_event(self, wd, mask, name):
+        # Returns the path of a new folder tree to watch, if any, which the caller walks once
+        # it has released the lock.
+        if mask & IN_Q_OVERFLOW:
+            self._journal.overflow = True
+            return
+        path = self._wd2path.get(wd)
+        if path is None:
+            return
+        if mask & IN_IGNORED:
+            self._wd2path.pop(wd, None)
+            self._path2wd.pop(path, None)
+            if path not in self._polled:
+                self._discard_child(path)
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self._journal.removed.add(path)
+            self._forget(path)
+            return
+        self._journal.dirty.add(path)
+        if name and mask & IN_ISDIR:
+            subpath = path + name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._journal.added.add(subpath)
+                self._journal.removed.discard(subpath)
+                return subpath
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._journal.removed.add(subpath)
+                self._forget(subpath)
+
+    def _read_inotify_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError:
+            return
+        offset = 0
+        new_trees = []
+        with self._lock:
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset+length].rstrip(b'\0')
+                offset += length
+                new_tree = self._handle_event(wd, mask, os.fsdecode(name))
+                if new_tree is not None:
+                    new_trees.append(new_tree)
+        for path in new_trees:
+            self._watch_tree(path)
+
+    def _inotify_loop(self):
+        while not self._stop_event.is_set():
+            fd = self._fd
+            if fd is None:
+                break
+            try:
+                readable, _, _ = select.select([fd], [], [], 0.5)
+            except (OSError, ValueError):
+                break
+            if readable:
+                self._read_inotify_events()
+
+    @staticmethod
+    def _get_signature(path):
+        # Changes in a folder's entries change its signature. The folder's own mtime isn't enough
+        # because it doesn't change when a file in it is modified.
+        try:
+            entries = []
+            for entry in os.scandir(str(path)):
+                if entry.is_dir() and not entry.is_symlink():
+                    entries.append((entry.name, True, 0, 0))
+                else:
+                    stats = entry.stat(follow_symlinks=False)
+                    entries.append((entry.name, False, stats.st_size, stats.st_mtime_ns))
+            return hash(tuple(sorted(entries)))
+        except OSError:
+            return None
+
+    def _poll(self):
+        with self._lock:
+            polled = list(self._polled.items())
+        for path, signature in polled:
+            if self._stop_event.is_set():
+                return
+            new_signature = self._get_signature(path)
+            if new_signature == signature:
+                continue
+            try:
+                subpaths = [
+                    path + entry.name for entry in os.scandir(str(path))
+                    if entry.is_dir() and not entry.is_symlink()
+                ]
+            except OSError:
+                subpaths = []
+            with self._lock:
+                if path not in self._polled:
+                    continue # forgotten in the meantime
+                if new_signature is None:
+                    self._journal.removed.add(path)
+                    self._forget(path)
+                    continue
+                self._polled[path] = new_signature
+                self._journal.dirty.add(path)
+                known = set(self._polled) | set(self._path2wd)
+                new_trees = [
+                    subpath for subpath in subpaths
+                    if subpath not in known and not self.directories.is_pruned(subpath)
+                ]
+                self._journal.added.update(new_trees)
+            for subpath in new_trees:
+                self._watch_tree(subpath)
+            # Removed subfolders are found when their own signature is computed.
+
+    def _poll_loop(self):
+        while not self._stop_event.wait(self.poll_interval):
+            self._poll()
+
+    #--- Public
+    def start(self):
+        """Starts journaling changes in the folders we watch.
+
+        Folders are added with :meth:`watch_folder`, usually by passing it to
+        :meth:`Directories.get_files`, so that they're watched as they're walked.
+        """
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            self._fd = fd if fd >= 0 else None
+        if self._fd is not None:
+            self._threads.append(threading.Thread(target=self._inotify_loop, daemon=True))
+        if self.poll_interval is not None:
+            self._threads.append(threading.Thread(target=self._poll_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def watch_folder(self, path):
+        """Starts watching the folder at ``path`` (but not its subfolders).
+
+        Can be called from any thread.
+        """
+        with self._lock:
+            self._watch_folder(path)
+
+    def take_journal(self):
+        """Returns the :class:`Journal` of changes since the last call and starts a new one.
+        """
+        with self._lock:
+            result = self._journal
+            self._journal = Journal()
+            if self._has_unwatched_folders:
+                result.overflow = True
+        return result
+
+    def poll_now(self):
+        """Polls folders that aren't watched by inotify right away."""
+        self._poll()
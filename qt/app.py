@@ -20,6 +20,7 @@ from qtlib.util import createActions
 from qtlib.progress_window import ProgressWindow
 
 from core.app import AppMode, DupeGuru as DupeGuruModel
+from core.engine import DEFAULT_BYTEWISE_MAX_FILES
 import core.pe.photo
 from . import platform
 from .preferences import Preferences
@@ -84,6 +85,7 @@ class DupeGuru(QObject):
             ('actionPreferences', 'Ctrl+P', '', tr("Options"), self.preferencesTriggered),
             ('actionIgnoreList', '', '', tr("Ignore List"), self.ignoreListTriggered),
             ('actionClearPictureCache', 'Ctrl+Shift+P', '', tr("Clear Picture Cache"), self.clearPictureCacheTriggered),
+            ('actionClearHashCache', 'Ctrl+Shift+H', '', tr("Clear Hash Cache"), self.clearHashCacheTriggered),
             ('actionShowHelp', 'F1', '', tr("dupeGuru Help"), self.showHelpTriggered),
             ('actionAbout', '', '', tr("About dupeGuru"), self.showAboutBoxTriggered),
             ('actionOpenDebugLog', '', '', tr("Open Debug Log"), self.openDebugLogTriggered),
@@ -118,6 +120,17 @@ class DupeGuru(QObject):
         self.model.options['scanned_tags'] = scanned_tags
         self.model.options['match_scaled'] = self.prefs.match_scaled
         self.model.options['picture_cache_type'] = self.prefs.picture_cache_type
+        self.model.options['hash_algorithm'] = self.prefs.hash_algorithm
+        self.model.options['hash_thread_count'] = self.prefs.hash_thread_count
+        self.model.options['incremental_scan'] = self.prefs.incremental_scan
+        self.model.options['watch_directories'] = self.prefs.watch_directories
+        self.model.options['poll_directories'] = self.prefs.poll_directories
+        # Only the Standard mode offers approximate matching.
+        lsh_threshold = None
+        if self.model.app_mode == AppMode.Standard and self.prefs.approximate_matching:
+            lsh_threshold = self.prefs.lsh_threshold / 100
+        self.model.options['lsh_threshold'] = lsh_threshold
+        self.model.options['bytewise_max_files'] = DEFAULT_BYTEWISE_MAX_FILES if self.prefs.bytewise_compare else 0
 
     #--- Private
     def _get_details_dialog_class(self):
@@ -164,6 +177,7 @@ class DupeGuru(QObject):
         self.willSavePrefs.emit()
         self.prefs.save()
         self.model.save()
+        self.model.close()
         QApplication.quit()
 
     #--- Signals
@@ -187,6 +201,14 @@ class DupeGuru(QObject):
             active = QApplication.activeWindow()
             QMessageBox.information(active, title, tr("Picture cache cleared."))
 
+    def clearHashCacheTriggered(self):
+        title = tr("Clear Hash Cache")
+        msg = tr("Do you really want to remove all your cached file hashes?")
+        if self.confirm(title, msg, QMessageBox.No):
+            self.model.clear_hash_cache()
+            active = QApplication.activeWindow()
+            QMessageBox.information(active, title, tr("Hash cache cleared."))
+
     def ignoreListTriggered(self):
         self.model.ignore_list_dialog.show()
 
@@ -84,6 +84,7 @@ class DirectoriesDialog(QMainWindow):
         self.menuFile.addAction(self.menuLoadRecent.menuAction())
         self.menuFile.addSeparator()
         self.menuFile.addAction(self.app.actionClearPictureCache)
+        self.menuFile.addAction(self.app.actionClearHashCache)
         self.menuFile.addSeparator()
         self.menuFile.addAction(self.app.actionQuit)
         self.menuView.addAction(self.app.actionPreferences)
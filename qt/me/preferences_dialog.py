@@ -59,6 +59,8 @@ class PreferencesDialog(PreferencesDialogBase):
         self.widgetsVLayout.addWidget(self.removeEmptyFoldersBox)
         self._setupAddCheckbox('ignoreHardlinkMatches', tr("Ignore duplicates hardlinking to the same file"))
         self.widgetsVLayout.addWidget(self.ignoreHardlinkMatches)
+        self._setupAddCheckbox('incrementalScanBox', tr("Only rescan new and modified files"))
+        self.widgetsVLayout.addWidget(self.incrementalScanBox)
         self._setupAddCheckbox('debugModeBox', tr("Debug mode (restart required)"))
         self.widgetsVLayout.addWidget(self.debugModeBox)
         self._setupBottomPart()
@@ -72,6 +74,7 @@ class PreferencesDialog(PreferencesDialogBase):
         setchecked(self.tagYearBox, prefs.scan_tag_year)
         setchecked(self.matchSimilarBox, prefs.match_similar)
         setchecked(self.wordWeightingBox, prefs.word_weighting)
+        setchecked(self.incrementalScanBox, prefs.incremental_scan)
 
         # Update UI state based on selected scan type
         scan_type = prefs.get_scan_type(AppMode.Music)
@@ -83,6 +86,7 @@ class PreferencesDialog(PreferencesDialogBase):
         self.filterHardnessSlider.setEnabled(word_based)
         self.matchSimilarBox.setEnabled(word_based)
         self.wordWeightingBox.setEnabled(word_based)
+        self.incrementalScanBox.setEnabled(word_based)
         self.tagTrackBox.setEnabled(tag_based)
         self.tagArtistBox.setEnabled(tag_based)
         self.tagAlbumBox.setEnabled(tag_based)
@@ -99,4 +103,5 @@ class PreferencesDialog(PreferencesDialogBase):
         prefs.scan_tag_year = ischecked(self.tagYearBox)
         prefs.match_similar = ischecked(self.matchSimilarBox)
         prefs.word_weighting = ischecked(self.wordWeightingBox)
+        prefs.incremental_scan = ischecked(self.incrementalScanBox)
 
@@ -6,7 +6,23 @@
 # which should be included with this package. The terms are also available at
 # http://www.gnu.org/licenses/gpl-3.0.html
 
-from ._block_qt import getblocks # NOQA
+from ._block_qt import getblocks as _getblocks
+
+try:
+    from core.pe import npblock
+except ImportError:
+    npblock = None
+
+def getblocks(image, block_count_per_side):
+    """Returns a list of blocks (3 sized tuples) from ``image``, a ``QImage`` in ``RGB888`` format.
+    """
+    if npblock is None:
+        return _getblocks(image, block_count_per_side)
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    return npblock.getblocks_from_buffer(
+        bits, image.width(), image.height(), image.bytesPerLine(), block_count_per_side
+    )
 
 # Converted to C
 # def getblock(image):
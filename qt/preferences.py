@@ -8,6 +8,7 @@ from PyQt5.QtWidgets import QApplication
 
 from hscommon import trans
 from core.app import AppMode
+from core.engine import DEFAULT_LSH_THRESHOLD, HASH_THREAD_COUNT
 from core.scanner import ScanType
 from qtlib.preferences import Preferences as PreferencesBase
 
@@ -45,6 +46,14 @@ class Preferences(PreferencesBase):
         self.scan_tag_year = get('ScanTagYear', self.scan_tag_year)
         self.match_scaled = get('MatchScaled', self.match_scaled)
         self.picture_cache_type = get('PictureCacheType', self.picture_cache_type)
+        self.hash_algorithm = get('HashAlgorithm', self.hash_algorithm)
+        self.hash_thread_count = get('HashThreadCount', self.hash_thread_count)
+        self.incremental_scan = get('IncrementalScan', self.incremental_scan)
+        self.watch_directories = get('WatchDirectories', self.watch_directories)
+        self.poll_directories = get('PollDirectories', self.poll_directories)
+        self.approximate_matching = get('ApproximateMatching', self.approximate_matching)
+        self.lsh_threshold = get('LshThreshold', self.lsh_threshold)
+        self.bytewise_compare = get('BytewiseCompare', self.bytewise_compare)
 
     def reset(self):
         self.filter_hardness = 95
@@ -76,6 +85,14 @@ class Preferences(PreferencesBase):
         self.scan_tag_year = False
         self.match_scaled = False
         self.picture_cache_type = 'sqlite'
+        self.hash_algorithm = 'md5'
+        self.hash_thread_count = HASH_THREAD_COUNT
+        self.incremental_scan = False
+        self.watch_directories = False
+        self.poll_directories = False
+        self.approximate_matching = False
+        self.lsh_threshold = round(DEFAULT_LSH_THRESHOLD * 100) # percentage
+        self.bytewise_compare = False
 
     def _save_values(self, settings):
         set_ = self.set_value
@@ -108,6 +125,14 @@ class Preferences(PreferencesBase):
         set_('ScanTagYear', self.scan_tag_year)
         set_('MatchScaled', self.match_scaled)
         set_('PictureCacheType', self.picture_cache_type)
+        set_('HashAlgorithm', self.hash_algorithm)
+        set_('HashThreadCount', self.hash_thread_count)
+        set_('IncrementalScan', self.incremental_scan)
+        set_('WatchDirectories', self.watch_directories)
+        set_('PollDirectories', self.poll_directories)
+        set_('ApproximateMatching', self.approximate_matching)
+        set_('LshThreshold', self.lsh_threshold)
+        set_('BytewiseCompare', self.bytewise_compare)
 
     # scan_type is special because we save it immediately when we set it.
     def get_scan_type(self, app_mode):
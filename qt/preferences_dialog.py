@@ -13,6 +13,7 @@ from PyQt5.QtWidgets import (
 from hscommon.trans import trget
 from qtlib.util import horizontalWrap
 from qtlib.preferences import get_langnames
+from core import fs
 
 from .preferences import Preferences
 
@@ -23,6 +24,9 @@ SUPPORTED_LANGUAGES = [
     'nl',
 ]
 
+# Same order as the items of hashAlgorithmComboBox. BLAKE2b isn't available before Python 3.6.
+HASH_ALGORITHMS = [name for name in ['md5', 'blake2b', 'fast'] if name == 'fast' or name in fs.HASH_ALGORITHMS]
+
 class PreferencesDialogBase(QDialog):
     def __init__(self, parent, app, **kwargs):
         flags = Qt.CustomizeWindowHint | Qt.WindowTitleHint | Qt.WindowSystemMenuHint
@@ -95,6 +99,24 @@ class PreferencesDialogBase(QDialog):
         self.copyMoveDestinationComboBox.addItem(tr("Recreate relative path"))
         self.copyMoveDestinationComboBox.addItem(tr("Recreate absolute path"))
         self.widgetsVLayout.addWidget(self.copyMoveDestinationComboBox)
+        self.hashAlgorithmLabel = QLabel(tr("Hash algorithm:"), self)
+        self.hashAlgorithmComboBox = QComboBox(self)
+        hash_algorithm_names = {
+            'md5': tr("MD5"),
+            'blake2b': tr("BLAKE2b"),
+            'fast': tr("Fast (non-cryptographic)"),
+        }
+        for name in HASH_ALGORITHMS:
+            self.hashAlgorithmComboBox.addItem(hash_algorithm_names[name])
+        self.widgetsVLayout.addLayout(horizontalWrap([self.hashAlgorithmLabel, self.hashAlgorithmComboBox, None]))
+        self.hashThreadCountLabel = QLabel(tr("Files hashed at once:"), self)
+        self.hashThreadCountSpinBox = QSpinBox(self)
+        self.hashThreadCountSpinBox.setRange(1, 64)
+        self.widgetsVLayout.addLayout(horizontalWrap([self.hashThreadCountLabel, self.hashThreadCountSpinBox, None]))
+        self._setupAddCheckbox('watchDirectoriesBox', tr("Watch folders for changes between scans"))
+        self.widgetsVLayout.addWidget(self.watchDirectoriesBox)
+        self._setupAddCheckbox('pollDirectoriesBox', tr("Check folders that can't be watched every minute"))
+        self.widgetsVLayout.addWidget(self.pollDirectoriesBox)
         self.customCommandLabel = QLabel(self)
         self.customCommandLabel.setText(tr("Custom Command (arguments: %d for dupe, %r for ref):"))
         self.widgetsVLayout.addWidget(self.customCommandLabel)
@@ -144,7 +166,15 @@ class PreferencesDialogBase(QDialog):
         setchecked(self.removeEmptyFoldersBox, prefs.remove_empty_folders)
         setchecked(self.ignoreHardlinkMatches, prefs.ignore_hardlink_matches)
         setchecked(self.debugModeBox, prefs.debug_mode)
+        setchecked(self.watchDirectoriesBox, prefs.watch_directories)
+        setchecked(self.pollDirectoriesBox, prefs.poll_directories)
         self.copyMoveDestinationComboBox.setCurrentIndex(prefs.destination_type)
+        try:
+            hashindex = HASH_ALGORITHMS.index(prefs.hash_algorithm)
+        except ValueError:
+            hashindex = 0
+        self.hashAlgorithmComboBox.setCurrentIndex(hashindex)
+        self.hashThreadCountSpinBox.setValue(prefs.hash_thread_count)
         self.customCommandEdit.setText(prefs.custom_command)
         self.fontSizeSpinBox.setValue(prefs.tableFontSize)
         try:
@@ -163,7 +193,11 @@ class PreferencesDialogBase(QDialog):
         prefs.remove_empty_folders = ischecked(self.removeEmptyFoldersBox)
         prefs.ignore_hardlink_matches = ischecked(self.ignoreHardlinkMatches)
         prefs.debug_mode = ischecked(self.debugModeBox)
+        prefs.watch_directories = ischecked(self.watchDirectoriesBox)
+        prefs.poll_directories = ischecked(self.pollDirectoriesBox)
         prefs.destination_type = self.copyMoveDestinationComboBox.currentIndex()
+        prefs.hash_algorithm = HASH_ALGORITHMS[self.hashAlgorithmComboBox.currentIndex()]
+        prefs.hash_thread_count = self.hashThreadCountSpinBox.value()
         prefs.custom_command = str(self.customCommandEdit.text())
         prefs.tableFontSize = self.fontSizeSpinBox.value()
         lang = self.supportedLanguages[self.languageComboBox.currentIndex()]
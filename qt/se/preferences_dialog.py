@@ -4,9 +4,9 @@
 # which should be included with this package. The terms are also available at
 # http://www.gnu.org/licenses/gpl-3.0.html
 
-from PyQt5.QtCore import QSize
+from PyQt5.QtCore import Qt, QSize
 from PyQt5.QtWidgets import (
-    QVBoxLayout, QHBoxLayout, QLabel, QSizePolicy, QSpacerItem, QWidget, QLineEdit
+    QVBoxLayout, QHBoxLayout, QLabel, QSizePolicy, QSpacerItem, QWidget, QLineEdit, QSlider
 )
 
 from hscommon.trans import trget
@@ -58,6 +58,28 @@ class PreferencesDialog(PreferencesDialogBase):
             tr("Ignore duplicates hardlinking to the same file"), self.widget
         )
         self.verticalLayout_4.addWidget(self.ignoreHardlinkMatches)
+        self._setupAddCheckbox('incrementalScanBox', tr("Only rescan new and modified files"), self.widget)
+        self.verticalLayout_4.addWidget(self.incrementalScanBox)
+        self._setupAddCheckbox(
+            'approximateMatchingBox', tr("Approximate matching (faster on very large scans)"), self.widget
+        )
+        self.approximateMatchingHLayout = QHBoxLayout()
+        self.approximateMatchingHLayout.addWidget(self.approximateMatchingBox)
+        self.lshThresholdSlider = QSlider(self.widget)
+        self.lshThresholdSlider.setMinimum(10)
+        self.lshThresholdSlider.setMaximum(90)
+        self.lshThresholdSlider.setOrientation(Qt.Horizontal)
+        self.lshThresholdSlider.setToolTip(tr("Lower values find more duplicates, but are slower."))
+        self.approximateMatchingHLayout.addWidget(self.lshThresholdSlider)
+        self.lshThresholdLabel = QLabel(self.widget)
+        self.lshThresholdLabel.setMinimumSize(QSize(21, 0))
+        self.approximateMatchingHLayout.addWidget(self.lshThresholdLabel)
+        self.lshThresholdSlider.valueChanged['int'].connect(self.lshThresholdLabel.setNum)
+        self.verticalLayout_4.addLayout(self.approximateMatchingHLayout)
+        self._setupAddCheckbox(
+            'bytewiseCompareBox', tr("Compare small groups of files byte by byte"), self.widget
+        )
+        self.verticalLayout_4.addWidget(self.bytewiseCompareBox)
         self._setupAddCheckbox('debugModeBox', tr("Debug mode (restart required)"), self.widget)
         self.verticalLayout_4.addWidget(self.debugModeBox)
         self.widgetsVLayout.addWidget(self.widget)
@@ -68,6 +90,11 @@ class PreferencesDialog(PreferencesDialogBase):
         setchecked(self.wordWeightingBox, prefs.word_weighting)
         setchecked(self.ignoreSmallFilesBox, prefs.ignore_small_files)
         self.sizeThresholdEdit.setText(str(prefs.small_file_threshold))
+        setchecked(self.incrementalScanBox, prefs.incremental_scan)
+        setchecked(self.approximateMatchingBox, prefs.approximate_matching)
+        self.lshThresholdSlider.setValue(prefs.lsh_threshold)
+        self.lshThresholdLabel.setNum(prefs.lsh_threshold)
+        setchecked(self.bytewiseCompareBox, prefs.bytewise_compare)
 
         # Update UI state based on selected scan type
         scan_type = prefs.get_scan_type(AppMode.Standard)
@@ -75,10 +102,18 @@ class PreferencesDialog(PreferencesDialogBase):
         self.filterHardnessSlider.setEnabled(word_based)
         self.matchSimilarBox.setEnabled(word_based)
         self.wordWeightingBox.setEnabled(word_based)
+        self.incrementalScanBox.setEnabled(word_based)
+        self.approximateMatchingBox.setEnabled(word_based)
+        self.lshThresholdSlider.setEnabled(word_based)
+        self.bytewiseCompareBox.setEnabled(scan_type == ScanType.Contents)
 
     def _save(self, prefs, ischecked):
         prefs.match_similar = ischecked(self.matchSimilarBox)
         prefs.word_weighting = ischecked(self.wordWeightingBox)
         prefs.ignore_small_files = ischecked(self.ignoreSmallFilesBox)
         prefs.small_file_threshold = tryint(self.sizeThresholdEdit.text())
+        prefs.incremental_scan = ischecked(self.incrementalScanBox)
+        prefs.approximate_matching = ischecked(self.approximateMatchingBox)
+        prefs.lsh_threshold = self.lshThresholdSlider.value()
+        prefs.bytewise_compare = ischecked(self.bytewiseCompareBox)
 